@@ -0,0 +1,394 @@
+import numpy as np
+import tensorflow as tf
+from datasets import data_loader
+import librosa
+import soundfile as sf
+import argparse
+import threading
+import queue
+import time
+import io
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from train_utils import *
+from ncsn.utils import *
+from run_basis_sep import build_models, restore_models, basis_outer_loop, basis_inner_loop_fn, \
+    mixing_process, post_processing_fn, set_melspec_params, preprocess_mixture, min_steps, apply_precision, \
+    build_model_banks
+from run_basis_stream import reuse_phase_inversion
+
+
+"""
+Local BASIS separation server
+
+The score networks are built, restored and traced once at start-up.
+Concurrent requests are batched together along the n_mixed dimension up to a latency deadline.
+
+POST /separate with a wav file (Content-Type: audio/wav) or a .npy array of melspectrograms
+[n, height, width] in the scale of the training data (Content-Type: application/x-npy).
+Add ?audio=1 to also get the separated audio (wav requests only).
+The response is a .npz file with the separated melspectrograms x1, ..., xK (and audio1, ..., audioK).
+GET /health returns ok when the server is ready.
+"""
+
+
+class SeparationRequest(object):
+    """
+    Melspectrograms of one request, completed when every extract went through BASIS
+    """
+
+    def __init__(self, mel):
+        self.mel = mel
+        self.arrival = time.time()
+        self.separated = [None] * len(mel)
+        self.n_done = 0
+        self.error = None
+        self._done = threading.Event()
+
+    def items(self):
+        return [(self, i) for i in range(len(self.mel))]
+
+    def add(self, extract_idx, x):
+        self.separated[extract_idx] = x
+        self.n_done += 1
+        if self.n_done == len(self.mel):
+            self._done.set()
+
+    def fail(self, error):
+        self.error = error
+        self._done.set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return np.stack(self.separated, axis=1)
+
+
+class SeparationService(object):
+    """
+    Warm BASIS engine with dynamic batching
+
+    Requests are split into extracts and packed into batches of args.n_mixed extracts.
+    A batch is separated when it is full or when the oldest waiting request reaches args.max_latency seconds.
+    Only the worker thread runs TensorFlow.
+    """
+
+    def __init__(self, args, models, optimizer, sigmas, ckpts, model_banks=None):
+        self.args = args
+        self.models = models
+        self.optimizer = optimizer
+        self.sigmas = sigmas
+        self.ckpts = ckpts
+        self.model_banks = model_banks
+        self.n_sources = len(models)
+        self.post_processing = post_processing_fn(args)
+        self.mixing_op = mixing_process(args)
+        self.inner_loop = basis_inner_loop_fn(models, sigmas, self.mixing_op, model_type=args.model_type, delta=2e-5, T=args.T,
+                                              monitor=args.debug,
+                                              adaptive=args.adaptive, min_T=min_steps(args), tol=args.tol)
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, mel):
+        """
+        mel: ndarray [n, height, width], melspectrograms of the mixture
+
+        Returns:
+            SeparationRequest
+
+        Raise a ValueError if mel is malformed: it is rejected before joining a batch
+        """
+        shape = (self.args.height, self.args.width)
+        if mel.ndim != 3 or mel.shape[1:] != shape or mel.dtype.kind not in 'fiu':
+            raise ValueError("melspectrograms should be a numeric array [n, {}, {}], got {} {}".format(
+                *shape, mel.dtype, list(mel.shape)))
+        if len(mel) == 0:
+            raise ValueError("no melspectrogram to separate")
+        request = SeparationRequest(mel)
+        self.requests.put(request)
+        return request
+
+    def _run(self):
+        pending = []
+        while True:
+            if len(pending) == 0:
+                pending += self.requests.get().items()
+
+            deadline = pending[0][0].arrival + self.args.max_latency
+            while len(pending) < self.args.n_mixed:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending += self.requests.get(timeout=timeout).items()
+                except queue.Empty:
+                    break
+
+            batch, pending = pending[:self.args.n_mixed], pending[self.args.n_mixed:]
+            try:
+                self._separate(batch)
+            except Exception as error:
+                for request in set([request for request, _ in batch]):
+                    request.fail(error)
+                pending = [(request, i) for request, i in pending if request.error is None]
+
+    def _separate(self, batch):
+        t0 = time.time()
+        n_valid = len(batch)
+        mel_batch = np.array([request.mel[i] for request, i in batch])
+        # pad the batch to keep the same shape (and the same trace)
+        if n_valid < self.args.n_mixed:
+            padding = np.repeat(mel_batch[-1:], self.args.n_mixed - n_valid, axis=0)
+            mel_batch = np.concatenate((mel_batch, padding), axis=0)
+
+        mixed = preprocess_mixture(tf.cast(np.expand_dims(mel_batch, axis=-1), tf.float32), self.args)
+        x = tf.random.uniform([self.n_sources] + list(mixed.shape), dtype=tf.float32)
+        x, _ = basis_outer_loop(mixed, x, self.models, self.optimizer, self.sigmas, self.ckpts, self.args, None,
+                                return_arr=False, inner_loop=self.inner_loop, model_banks=self.model_banks,
+                                mixing_op=self.mixing_op)
+        x = self.post_processing(x.numpy().squeeze(axis=-1))
+
+        for j, (request, i) in enumerate(batch):
+            request.add(i, x[:, j])
+        print("{} extracts separated in {} seconds".format(n_valid, round(time.time() - t0, 3)))
+
+
+def wav_to_extracts(wav_bytes, spec_params):
+    """
+    Decode a wav file and cut it into extracts of length_sec seconds (the last one is zero-padded)
+
+    Returns:
+        extracts: ndarray [n, length]
+        n_samples: length of the song
+    """
+    song, rate = sf.read(io.BytesIO(wav_bytes), dtype='float32', always_2d=True)
+    song = np.mean(song, axis=1)
+    if rate != spec_params['sr']:
+        song = librosa.resample(song, rate, spec_params['sr'])
+    length = int(spec_params['length_sec'] * spec_params['sr'])
+    n_extract = int(np.ceil(len(song) / length))
+    song_padded = np.pad(song, (0, n_extract * length - len(song)))
+    return np.reshape(song_padded, (n_extract, length)), len(song)
+
+
+def make_handler(service, spec_params):
+
+    class SeparationHandler(BaseHTTPRequestHandler):
+
+        def _send(self, code, body, content_type='application/octet-stream'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/health':
+                self._send(200, b'ok', 'text/plain')
+            else:
+                self._send(404, b'not found', 'text/plain')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != '/separate':
+                self._send(404, b'not found', 'text/plain')
+                return
+            return_audio = parse_qs(url.query).get('audio', ['0'])[0] == '1'
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            content_type = self.headers.get('Content-Type', '')
+
+            # a malformed upload is rejected alone, before it joins a batch
+            try:
+                stft_mixture = None
+                if content_type.startswith('audio/'):
+                    extracts, n_samples = wav_to_extracts(body, spec_params)
+                    mel, stft_mixture = data_loader.extracts_to_melspec(extracts, **spec_params)
+                else:
+                    mel = np.load(io.BytesIO(body), allow_pickle=False)
+                    if mel.ndim == 4 and mel.shape[-1] == 1:
+                        mel = mel.squeeze(axis=-1)
+                request = service.submit(np.asarray(mel))
+            except Exception as error:
+                self._send(400, str(error).encode(), 'text/plain')
+                return
+
+            try:
+                x = request.wait()
+            except Exception as error:
+                self._send(500, str(error).encode(), 'text/plain')
+                return
+
+            results = {'x{}'.format(k + 1): x[k] for k in range(len(x))}
+            if return_audio and stft_mixture is not None:
+                length = extracts.shape[1]
+                for k in range(len(x)):
+                    audio = reuse_phase_inversion(x[k], stft_mixture, length, **spec_params)
+                    results['audio{}'.format(k + 1)] = np.concatenate(audio)[:n_samples]
+            buf = io.BytesIO()
+            np.savez(buf, **results)
+            self._send(200, buf.getvalue())
+
+        def log_message(self, format, *args):
+            print("%s - %s" % (self.address_string(), format % args))
+
+    return SeparationHandler
+
+
+def main(args):
+
+    n_sources = len(args.RESTORE)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.host = args.host
+        new_args.port = args.port
+        new_args.debug = args.debug
+        new_args.eager = args.eager
+        new_args.adaptive = args.adaptive
+        new_args.min_T = args.min_T
+        new_args.tol = args.tol
+        new_args.learned_gains = args.learned_gains
+        new_args.gain_steps = args.gain_steps
+        new_args.n_levels = args.n_levels
+        new_args.spacing = args.spacing
+        new_args.max_step_scale = args.max_step_scale
+        new_args.precision = args.precision
+        new_args.model_type = args.model_type
+        new_args.n_mixed = args.n_mixed
+        new_args.max_latency = args.max_latency
+        new_args.bank_size = args.bank_size
+        new_args.prefetch = args.prefetch
+        args = new_args
+
+    sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+    if args.model_type == "glow":
+        args.restore_dicts = [{sigma: os.path.join(os.path.abspath(restore_path), "sigma_" + str(round(sigma, 2)), "tf_ckpts")
+                               for sigma in sigmas} for restore_path in args.RESTORE]
+    elif args.model_type == "ncsn":
+        args.restore_dicts = None
+    else:
+        raise ValueError("model_type should be 'ncsn' or 'glow'")
+    args.dataset = "melspec"
+    args.data_type = "melspec"
+    args.data_shape = [args.height, args.width, 1]
+    spec_params = set_melspec_params(args)
+
+    t0 = time.time()
+    models = build_models(args, sigmas)
+    optimizer = setUp_optimizer(None, args)
+    ckpts = restore_models(models, optimizer, args)
+    models = apply_precision(models, args, sigmas)
+    model_banks = build_model_banks(models, args, sigmas)
+
+    service = SeparationService(args, models, optimizer, sigmas, ckpts, model_banks=model_banks)
+    service.start()
+    # trace the inner loop before accepting requests
+    service.submit(np.full([1, args.height, args.width], args.minval, dtype=np.float32)).wait()
+    print("{} models ready in {} seconds".format(n_sources, round(time.time() - t0, 3)))
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service, spec_params))
+    print("Serving BASIS separation on http://{}:{}".format(args.host, args.port))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='BASIS Separation Server')
+    parser.add_argument('RESTORE', type=str, nargs='+',
+                        help='directories of the saved models: one per source')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--eager', action="store_true",
+                        help="Run the inner loop eagerly instead of the graph-compiled tf.while_loop")
+
+    # Model type
+    parser.add_argument("--model_type", type=str, default="ncsn")
+
+    # Batching parameters
+    parser.add_argument('--n_mixed', type=int, default=32,
+                        help="number of extracts separated at once (shared between requests)")
+    parser.add_argument('--max_latency', type=float, default=0.5,
+                        help="maximum time in seconds a request waits for other requests before its batch starts")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # BASIS hyperparameters
+    parser.add_argument("--T", type=int, default=100,
+                        help="Number of iteration in the inner loop")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Move to the next noise level once the residual and the update norm plateau")
+    parser.add_argument("--min_T", type=int, default=None,
+                        help="Minimum number of iterations per noise level with --adaptive (default: T // 10)")
+    parser.add_argument("--tol", type=float, default=1e-3,
+                        help="Relative change under which the statistics are considered on a plateau with --adaptive")
+    parser.add_argument("--learned_gains", action="store_true",
+                        help="Mix the sources with one gain per source, fitted to the mixture after every noise level")
+    parser.add_argument("--gain_steps", type=int, default=100,
+                        help="Number of Adam steps fitting the mixing gains after every noise level with --learned_gains")
+
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # inference schedule
+    parser.add_argument("--n_levels", type=int, default=None,
+                        help="Number of noise levels visited (sub-sampled from the training schedule). By default all of them")
+    parser.add_argument("--spacing", type=str, default="uniform",
+                        help="uniform or quadratic (denser at the low noise levels)")
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedule (default: no bound)")
+
+    # Model hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--precision', type=str, default='float32',
+                        help="float32, bfloat16 or int8 (RESTORE paths are TFLite files from quantize_ncsn.py)")
+
+    # Glow hyperparameters
+    parser.add_argument('--L', default=3, type=int,
+                        help='Depth level')
+    parser.add_argument('--K', type=int, default=32,
+                        help="Number of Step of Flow in each Block")
+    parser.add_argument('--l2_reg', type=float, default=None,
+                        help="L2 regularization for the coupling layer")
+    parser.add_argument("--bank_size", type=int, default=None,
+                        help="Number of noise levels kept in memory per model. By default every level is loaded at start")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Load the weights of the next noise level on a background thread")
+
+    # Optimization parameters
+    parser.add_argument("--optimizer", type=str,
+                        default="adam", help="adam or adamax")
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=10**(-6),
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
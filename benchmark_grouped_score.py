@@ -0,0 +1,84 @@
+import numpy as np
+import tensorflow as tf
+import argparse
+import time
+import csv
+import os
+from ncsn.utils import get_sigmas, get_uncompiled_model_v2
+from run_basis_sep import stacked_score_fn
+
+
+"""
+Benchmark of the stacked score of K distinct NCSN v2 models: per-model Conv2D calls versus the grouped network
+
+The models are built with random weights (the cost does not depend on the weights).
+For each batch size, both versions are traced once, then timed over n_runs calls on the same sources.
+The maximum absolute difference between the two scores checks that they compute the same function.
+"""
+
+
+def time_score(score, x, cond, n_runs):
+    score_fn = tf.function(score)
+    score_fn(x, cond).numpy()
+    t0 = time.time()
+    for _ in range(n_runs):
+        scores = score_fn(x, cond)
+    scores = scores.numpy()
+    return (time.time() - t0) / n_runs, scores
+
+
+def main(args):
+    args.data_shape = [args.height, args.width, 1]
+    sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+    sigmas_tf = tf.constant(sigmas, dtype=tf.float32)
+    models = [get_uncompiled_model_v2(args, sigmas=sigmas_tf, name="model{}".format(k + 1)) for k in range(args.n_sources)]
+
+    rows = []
+    for batch_size in args.batch_sizes:
+        tf.random.set_seed(args.seed)
+        x = tf.random.uniform([args.n_sources, batch_size] + args.data_shape, dtype=tf.float32)
+        results = {}
+        for grouped in [False, True]:
+            score, conditioning = stacked_score_fn(models, model_type='ncsn', grouped=grouped)
+            cond = conditioning(tf.constant(0), batch_size)
+            results[grouped] = time_score(score, x, cond, args.n_runs)
+        rows.append({'n_sources': args.n_sources, 'batch_size': batch_size,
+                     'per_model': round(results[False][0], 4), 'grouped': round(results[True][0], 4),
+                     'max_abs_diff': float(np.max(np.abs(results[False][1] - results[True][1])))})
+        print("batch size {batch_size}: per model {per_model} s, grouped {grouped} s "
+              "(max abs diff {max_abs_diff})".format(**rows[-1]))
+
+    output = os.path.abspath(args.output)
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Results saved at {}".format(output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the grouped evaluation of the NCSN v2 score networks')
+    parser.add_argument('--n_sources', type=int, default=2)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 10, 30])
+    parser.add_argument('--n_runs', type=int, default=10, help="Number of timed calls per configuration")
+    parser.add_argument('--output', type=str, default='benchmark_grouped_score.csv',
+                        help='csv file of the results')
+    parser.add_argument('--seed', type=int, default=1234)
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+
+    # Model hyperparameters
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+    parser.add_argument('--use_logit', action="store_true")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,171 @@
+import numpy as np
+import tensorflow as tf
+import librosa
+from datasets import data_loader
+import argparse
+import time
+import os
+import csv
+from train_utils import *
+from ncsn.utils import *
+from ncsn.schedule import inference_schedule
+from run_basis_sep import build_models, restore_models, basis_outer_loop, basis_inner_loop_fn, \
+    mixing_process, post_processing_fn, set_melspec_params, preprocess_mixture
+
+
+"""
+Benchmark of the BASIS inference schedules: separation quality versus wall time
+
+The models are built, restored and traced once. The same mixture and initialization are separated with
+the full training schedule and with sub-sampled schedules (ncsn.schedule).
+Quality is the SDR in the melspectrogram domain (power) with respect to the ground truth sources.
+"""
+
+
+def melspec_sdr(reference, estimate):
+    """
+    SDR (in dB) between reference and estimated dB melspectrograms, computed on the power melspectrograms
+    """
+    reference = librosa.db_to_power(reference)
+    estimate = librosa.db_to_power(estimate)
+    return 10. * np.log10(np.sum(reference ** 2) / (np.sum((reference - estimate) ** 2) + 1e-12))
+
+
+def main(args):
+
+    song_dir_abspath = os.path.abspath(args.song_dir)
+    n_sources = len(args.RESTORE)
+    n_levels_list = args.n_levels_list
+    spacings = args.spacings
+    output = os.path.abspath(args.output)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.sources = args.sources
+        new_args.n_mixed = args.n_mixed
+        new_args.max_step_scale = args.max_step_scale
+        new_args.seed = args.seed
+        args = new_args
+
+    if len(args.sources) != n_sources:
+        raise ValueError("{} sources given for {} models".format(len(args.sources), n_sources))
+
+    args.model_type = "ncsn"
+    args.precision = "float32"
+    args.restore_dicts = None
+    args.debug = False
+    args.eager = False
+    args.adaptive = False
+    args.min_T = None
+    args.tol = 1e-3
+    args.dataset = "melspec"
+    args.data_type = "melspec"
+    args.data_shape = [args.height, args.width, 1]
+    spec_params = set_melspec_params(args)
+    sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+
+    mix_path = os.path.join(song_dir_abspath, 'mix.wav')
+    source_paths = [os.path.join(song_dir_abspath, source + '.wav') for source in args.sources]
+    mel_spec, _, _ = data_loader.get_song_extract(mix_path, source_paths, 2.04 * args.n_mixed, **spec_params)
+    mixed = preprocess_mixture(mel_spec[0], args)
+    gt = [gt_k.numpy().squeeze(axis=-1) for gt_k in mel_spec[1:]]
+    if not args.use_dB:
+        # the separated sources are post-processed in dB
+        gt = [librosa.power_to_db(gt_k) for gt_k in gt]
+    post_processing = post_processing_fn(args)
+
+    models = build_models(args, sigmas)
+    optimizer = setUp_optimizer(None, args)
+    ckpts = restore_models(models, optimizer, args)
+    mixing_op = mixing_process(args)
+    inner_loop = basis_inner_loop_fn(models, sigmas, mixing_op, model_type=args.model_type, delta=2e-5, T=args.T)
+
+    tf.random.set_seed(args.seed)
+    x_init = tf.random.uniform([n_sources] + list(mixed.shape), dtype=tf.float32)
+    # trace the inner loop before timing
+    inner_loop(mixed, x_init, tf.constant(0, dtype=tf.int32), tf.constant(1., dtype=tf.float32))
+
+    rows = []
+    configs = [(None, 'uniform')] + [(n_levels, spacing) for n_levels in n_levels_list for spacing in spacings]
+    for n_levels, spacing in configs:
+        args.n_levels, args.spacing = n_levels, spacing
+        sigma_indices, _ = inference_schedule(sigmas, n_levels=n_levels, spacing=spacing, max_scale=args.max_step_scale)
+        tf.random.set_seed(args.seed)
+        t0 = time.time()
+        x, _ = basis_outer_loop(mixed, x_init, models, optimizer, sigmas, ckpts, args, None,
+                                return_arr=False, inner_loop=inner_loop, mixing_op=mixing_op)
+        x = x.numpy()
+        duration = time.time() - t0
+
+        x = post_processing(x.squeeze(axis=-1))
+        sdr = [melspec_sdr(gt[k], x[k]) for k in range(n_sources)]
+        rows.append({'n_levels': len(sigma_indices), 'spacing': spacing, 'duration': round(duration, 3),
+                     **{'sdr_{}'.format(source): round(sdr_k, 3) for source, sdr_k in zip(args.sources, sdr)},
+                     'sdr_mean': round(float(np.mean(sdr)), 3)})
+        print("{n_levels} levels ({spacing}): {duration} seconds, mean SDR = {sdr_mean} dB".format(**rows[-1]))
+
+    with open(output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Results saved at {}".format(output))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the BASIS inference schedules')
+    parser.add_argument('RESTORE', type=str, nargs='+',
+                        help='directories of the saved NCSN models: one per source')
+    parser.add_argument("--song_dir", type=str, required=True,
+                        help="song directory path to separate: should contain mix.wav and one wav file per source")
+    parser.add_argument("--sources", type=str, nargs='+', default=['piano', 'violin'],
+                        help="names of the sources (wav files in song_dir), in the order of the models")
+    parser.add_argument('--n_mixed', type=int, default=10,
+                        help="number of extracts to separate")
+    parser.add_argument('--output', type=str, default='benchmark_schedule.csv',
+                        help='csv file of the results')
+    parser.add_argument('--seed', type=int, default=1234)
+
+    # schedules to compare with the full training schedule
+    parser.add_argument("--n_levels_list", type=int, nargs='+', default=[100, 50, 20],
+                        help="Number of noise levels of the sub-sampled schedules")
+    parser.add_argument("--spacings", type=str, nargs='+', default=['uniform', 'quadratic'])
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedules (default: no bound)")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # BASIS hyperparameters
+    parser.add_argument("--T", type=int, default=100,
+                        help="Number of iteration in the inner loop")
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # Model hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+
+    # Optimization parameters
+    parser.add_argument("--optimizer", type=str,
+                        default="adam", help="adam or adamax")
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=10**(-6),
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -1,10 +1,13 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
-from .preprocessing import load_tf_records, load_wav
+from .preprocessing import load_tf_records, count_tf_records, frame_audio, tf_mel_spectrogram_fn
+from .spectral import get_spectral_transform
+from . import spec_store
 import os
 import re
 import numpy as np
 import librosa
+import soundfile as sf
 
 
 def load_toydata(dataset='mnist', batch_size=256, mirrored_strategy=None, reshuffle=True):
@@ -66,33 +69,143 @@ def get_mixture_toydata(dataset='mnist', n_mixed=10, use_logit=False, alpha=None
     return mixed, x1, x2, gt1, gt2, minibatch
 
 
-def load_melspec_ds(train_dirpath, test_dirpath, batch_size=256, shuffle=True, mirrored_strategy=None):
+def list_melspec_files(dirpath):
+    """
+    Walk through dirpath (and sub-directories)
 
-    train_melspec_files = []
-    train_dirpath = os.path.abspath(train_dirpath)
-    for root, dirs, files in os.walk(train_dirpath):
-        current_path = os.path.join(train_dirpath, root)
+    Returns:
+        tfrecord_files: list of the TFRecords
+        store_files: list of the spectrogram store shards (see spec_store.py)
+    """
+    tfrecord_files = []
+    store_files = []
+    dirpath = os.path.abspath(dirpath)
+    for root, dirs, files in os.walk(dirpath):
+        current_path = os.path.join(dirpath, root)
         if len(files) > 0:
-            train_melspec_files += [os.path.join(current_path, f) for f in files if re.match(".*(.)tfrecord$", f)]
+            tfrecord_files += [os.path.join(current_path, f) for f in files if re.match(".*(.)tfrecord$", f)]
+            store_files += [os.path.join(current_path, f) for f in files if f.endswith(spec_store.EXTENSION)]
+    return tfrecord_files, store_files
+
+
+def load_melspec_files(tfrecord_files, store_files, shuffle=True):
+    """
+    Dataset of the spectrograms of the TFRecords and of the spectrogram store shards
+    """
+    datasets = []
+    if len(tfrecord_files) > 0:
+        datasets.append(load_tf_records(tfrecord_files))
+    if len(store_files) > 0:
+        datasets.append(spec_store.load_spec_store(store_files, shuffle=shuffle, seed=0 if shuffle else None))
+    if len(datasets) == 0:
+        raise ValueError("no tfrecord or spectrogram store file found")
+    ds = datasets[0]
+    for other_ds in datasets[1:]:
+        ds = ds.concatenate(other_ds)
+    return ds
+
+
+def count_melspec_files(tfrecord_files, store_files):
+    """
+    Number of spectrograms of the files, read from the TFRecords sidecar indexes and the spectrogram store headers
+    (the TFRecords without index are scanned without parsing)
+    """
+    return count_tf_records(tfrecord_files) + spec_store.store_size(store_files)
 
-    test_melspec_files = []
-    test_dirpath = os.path.abspath(test_dirpath)
-    for root, dirs, files in os.walk(test_dirpath):
-        current_path = os.path.join(test_dirpath, root)
-        if len(files) > 0:
-            test_melspec_files += [os.path.join(current_path, f) for f in files if re.match(".*(.)tfrecord$", f)]
+
+def load_melspec_split(tfrecord_files, store_files, batch_size=256, shuffle=True, buffer_size=2048):
+    """
+    Dataset of the spectrograms [H, W, 1] of one split, by batches of batch_size (drop remainder) if batch_size is not None
+
+    If every file is a spectrogram store shard, the batches are sliced directly from the memory maps
+    (shuffled by the store, see spec_store.load_spec_store) instead of being read one spectrogram at a time and batched again.
+    """
+    if batch_size is not None and len(tfrecord_files) == 0 and len(store_files) > 0:
+        ds = spec_store.load_spec_store(store_files, batch_size=batch_size, shuffle=shuffle, seed=0 if shuffle else None,
+                                        drop_remainder=True)
+        return ds.map(lambda x: tf.expand_dims(x, axis=-1))
+
+    ds = load_melspec_files(tfrecord_files, store_files, shuffle=shuffle)
+    if shuffle:
+        ds = ds.shuffle(buffer_size, reshuffle_each_iteration=False)
+    ds = ds.map(lambda x: tf.expand_dims(x, axis=-1))
+    if batch_size is not None:
+        ds = ds.batch(batch_size, drop_remainder=True)
+    return ds
+
+
+def load_melspec_ds(train_dirpath, test_dirpath, batch_size=256, shuffle=True, mirrored_strategy=None):
+
+    train_melspec_files, train_store_files = list_melspec_files(train_dirpath)
+    test_melspec_files, test_store_files = list_melspec_files(test_dirpath)
+
+    ds_train = load_melspec_split(train_melspec_files, train_store_files, batch_size=batch_size, shuffle=shuffle)
+    n_train = count_melspec_files(train_melspec_files, train_store_files)
+    ds_test = load_melspec_split(test_melspec_files, test_store_files, batch_size=batch_size, shuffle=shuffle)
+    n_test = count_melspec_files(test_melspec_files, test_store_files)
+
+    minibatch = list(ds_train.take(1).as_numpy_iterator())[0]
+
+    if mirrored_strategy is not None:
+        ds_train_dist = mirrored_strategy.experimental_distribute_dataset(ds_train)
+        ds_test_dist = mirrored_strategy.experimental_distribute_dataset(ds_test)
+        return ds_train, ds_test, ds_train_dist, ds_test_dist, minibatch, n_train, n_test
+
+    else:
+        return ds_train, ds_test, minibatch, n_train, n_test
+
+
+def load_wav_extracts(dirpath, length_sec, sr=16000):
+    """
+    Walk through dirpath (and sub-directories) and cut every wav file into consecutive extracts of length_sec seconds
+
+    Returns:
+        ndarray float32 [n_extract, length]
+    """
+    dirpath = os.path.abspath(dirpath)
+    extracts = []
+    for root, dirs, files in os.walk(dirpath):
+        for f in sorted(files):
+            if re.match(".*(.)wav$", f):
+                song, rate = librosa.core.load(os.path.join(root, f), sr=sr, mono=True)
+                extracts.append(frame_audio(song, int(rate * length_sec)))
+    if len(extracts) == 0:
+        raise ValueError("no wav file found in {}".format(dirpath))
+    return np.concatenate(extracts).astype(np.float32)
+
+
+def load_wav_melspec_ds(train_dirpath, test_dirpath, spec_params, batch_size=256, shuffle=True, mirrored_strategy=None,
+                        augment_fn=None):
+    """
+    Same as load_melspec_ds, but the spectrograms are computed on the fly from the wav files
+    (no offline preprocessing) by tensorflow ops in parallel calls of the tf.data pipeline (see tf_mel_spectrogram_fn)
+
+    spec_params: dict of length_sec, sr, n_fft, hop_length, n_mels, fmin, fmax, dbmin, dbmax and use_dB
+    augment_fn: function applied to the audio extracts of the training set before the spectrograms
+        (for instance a random gain). Made of tensorflow ops, it draws new augmentations at every epoch
+    """
+    mel_spectrogram = tf_mel_spectrogram_fn(spec_params['sr'], n_fft=spec_params['n_fft'],
+                                            hop_length=spec_params['hop_length'], n_mels=spec_params['n_mels'],
+                                            fmin=spec_params['fmin'], fmax=spec_params['fmax'],
+                                            dbmin=spec_params['dbmin'], dbmax=spec_params['dbmax'],
+                                            use_dB=spec_params['use_dB'])
+    train_extracts = load_wav_extracts(train_dirpath, spec_params['length_sec'], sr=spec_params['sr'])
+    test_extracts = load_wav_extracts(test_dirpath, spec_params['length_sec'], sr=spec_params['sr'])
+    n_train, n_test = len(train_extracts), len(test_extracts)
 
     buffer_size = 2048
-    ds_train = load_tf_records(train_melspec_files)
-    ds_test = load_tf_records(test_melspec_files)
+    ds_train = tf.data.Dataset.from_tensor_slices(train_extracts)
+    ds_test = tf.data.Dataset.from_tensor_slices(test_extracts)
     if shuffle:
         ds_train = ds_train.shuffle(buffer_size, reshuffle_each_iteration=False)
         ds_test = ds_test.shuffle(buffer_size, reshuffle_each_iteration=False)
 
-    ds_train = ds_train.map(lambda x: tf.expand_dims(x, axis=-1))
-    n_train = len(list(ds_train.as_numpy_iterator()))
-    ds_test = ds_test.map(lambda x: tf.expand_dims(x, axis=-1))
-    n_test = len(list(ds_test.as_numpy_iterator()))
+    if augment_fn is not None:
+        ds_train = ds_train.map(augment_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds_train = ds_train.map(lambda x: tf.expand_dims(mel_spectrogram(x), axis=-1),
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    ds_test = ds_test.map(lambda x: tf.expand_dims(mel_spectrogram(x), axis=-1),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
     if batch_size is not None:
 
@@ -110,71 +223,143 @@ def load_melspec_ds(train_dirpath, test_dirpath, batch_size=256, shuffle=True, m
         return ds_train, ds_test, minibatch, n_train, n_test
 
 
-def get_song_extract(mix_path, piano_path, violin_path, duration, **kwargs):
+def extracts_to_melspec(extracts, chunk_size=64, **kwargs):
     """
-    Load a mixture song and its sources.
-    Take the first duration seconds
-    Convert the mixture into spectrograms with parameters in **kwargs
+    Compute the melspectrograms and the STFT of audio extracts with parameters in **kwargs
+
+    The STFT and the mel projection of all the extracts are computed as batched matrix operations
+    (by chunks of chunk_size extracts), with the shared operators of spectral.get_spectral_transform.
+    Same outputs as librosa.stft and librosa.feature.melspectrogram on each extract.
+
+    extracts: list or ndarray [n_extract, length] of n_extract audio extracts
+
+    Returns:
+        mel_extracts: ndarray [n_extract, n_mels, frames]
+        stfts: ndarray complex64 [n_extract, 1 + n_fft // 2, frames] of the n_extract STFT
     """
-    length_sec = kwargs['length_sec']
     fmin, fmax = kwargs['fmin'], kwargs['fmax']
     sr = kwargs['sr']
     dbmin, dbmax = kwargs['dbmin'], kwargs['dbmax']
     n_fft, hop_length, n_mels = kwargs['n_fft'], kwargs['hop_length'], kwargs['n_mels']
     use_dB = kwargs['use_dB']
 
-    mix_ds, _ = load_wav(mix_path, length_sec, sr=sr)
-    piano_ds, _ = load_wav(piano_path, length_sec, sr=sr)
-    violin_ds, _ = load_wav(violin_path, length_sec, sr=sr)
+    extracts = np.asarray(extracts, dtype=np.float32)
+    transform = get_spectral_transform(sr, n_fft, hop_length, n_mels, fmin, fmax)
+    n_windows = 1 + extracts.shape[1] // hop_length
+    stfts = np.empty((len(extracts), 1 + n_fft // 2, n_windows), dtype=np.complex64)
+    mel_extracts = np.empty((len(extracts), n_mels, n_windows), dtype=np.float32)
+    for start in range(0, len(extracts), chunk_size):
+        stop = min(start + chunk_size, len(extracts))
+        stfts[start:stop] = transform.stft(extracts[start:stop])
+        mel_extracts[start:stop] = transform.mel(np.abs(stfts[start:stop]) ** 2)
+
+    if use_dB:
+        # librosa.power_to_db: amin=1e-10, ref=1. and top_db=80 below the maximum of each extract
+        mel_extracts = 10. * np.log10(np.maximum(mel_extracts, 1e-10))
+        mel_extracts = np.maximum(mel_extracts, np.max(mel_extracts, axis=(1, 2), keepdims=True) - 80.)
+        mel_extracts = np.clip(mel_extracts, dbmin, dbmax)
+    else:
+        powermin = np.exp(dbmin * np.log(10.) / 10.)
+        powermax = np.exp(dbmax * np.log(10.) / 10.)
+        mel_extracts = np.clip(mel_extracts, powermin, powermax)
+
+    return mel_extracts, stfts
+
+
+def load_song_extracts(path, length_sec, sr=16000, n_extract=-1, skip=2):
+    """
+    Load a song and cut it into consecutive extracts of length_sec seconds
+
+    n_extract: number of extracts to keep (-1 keeps every extract)
+    skip: number of extracts skipped at the beginning of the song
+
+    Returns:
+        ndarray [n_extract, length] (a view of the song)
+    """
+    song, rate = librosa.core.load(path, sr=sr, mono=True)
+    extracts = frame_audio(song, int(rate * length_sec))[skip:]
+    return extracts if n_extract < 0 else extracts[:n_extract]
+
+
+def get_song_extract(mix_path, source_paths, duration, **kwargs):
+    """
+    Load a mixture song and its sources.
+    Take the first duration seconds
+    Convert the mixture into spectrograms with parameters in **kwargs
+
+    The extracts of the K + 1 signals are stacked into one array [K + 1, n_extract, length]
+    and converted in a single batched call of extracts_to_melspec.
+
+    source_paths: list of the wav paths of the K sources
+
+    Returns:
+        mel_spec: list of K + 1 tensors [n_extract, n_mels, frames, 1]: the mixture then the sources
+        raw_audio: list of K + 1 ndarray
+        stft_mixture: ndarray complex [n_extract, 1 + n_fft // 2, frames] of the STFT of the mixture extracts
+    """
+    length_sec = kwargs['length_sec']
+    sr = kwargs['sr']
 
     n_extract = int(round(duration / length_sec, 0))
-    # skip 2 first frames
-    mix_raw = list(mix_ds.skip(2).take(n_extract).as_numpy_iterator())
-    piano_raw = list(piano_ds.skip(2).take(n_extract).as_numpy_iterator())
-    violin_raw = list(violin_ds.skip(2).take(n_extract).as_numpy_iterator())
-
-    mix_raw_concat = np.concatenate(mix_raw)
-    piano_raw_concat = np.concatenate(piano_raw)
-    violin_raw_concat = np.concatenate(violin_raw)
-    raw_audio = [mix_raw_concat, piano_raw_concat, violin_raw_concat]
-
-    mel_mix, mel_piano, mel_violin = [], [], []
-    stft_mixture = []
-    for k in range(n_extract):
-        mix_extract, piano_extract, violin_extract = mix_raw[k], piano_raw[k], violin_raw[k]
-
-        stft_mix = librosa.stft(mix_extract, n_fft=n_fft, hop_length=hop_length, win_length=None,
-                                window='hann', center=True, dtype=None, pad_mode='reflect')
-        stft_mixture.append(stft_mix)
-        stft_piano = librosa.stft(piano_extract, n_fft=n_fft, hop_length=hop_length, win_length=None,
-                                  window='hann', center=True, dtype=None, pad_mode='reflect')
-        stft_violin = librosa.stft(violin_extract, n_fft=n_fft, hop_length=hop_length, win_length=None,
-                                   window='hann', center=True, dtype=None, pad_mode='reflect')
-
-        mel_mix_extract = librosa.feature.melspectrogram(S=np.abs(stft_mix)**2, sr=sr, fmin=fmin, fmax=fmax,
-                                                         n_mels=n_mels, power=2.0)
-        mel_piano_extract = librosa.feature.melspectrogram(S=np.abs(stft_piano)**2, sr=sr, fmin=fmin, fmax=fmax,
-                                                           n_mels=n_mels, power=2.0)
-        mel_violin_extract = librosa.feature.melspectrogram(S=np.abs(stft_violin)**2, sr=sr, fmin=fmin, fmax=fmax,
-                                                            n_mels=n_mels, power=2.0)
-
-        if use_dB:
-            mel_mix_extract = np.clip(librosa.power_to_db(mel_mix_extract), dbmin, dbmax)
-            mel_piano_extract = np.clip(librosa.power_to_db(mel_piano_extract), dbmin, dbmax)
-            mel_violin_extract = np.clip(librosa.power_to_db(mel_violin_extract), dbmin, dbmax)
-        else:
-            powermin = np.exp(dbmin * np.log(10.) / 10.)
-            powermax = np.exp(dbmax * np.log(10.) / 10.)
-            mel_mix_extract = np.clip(mel_mix_extract, powermin, powermax)
-            mel_piano_extract = np.clip(mel_piano_extract, powermin, powermax)
-            mel_violin_extract = np.clip(mel_violin_extract, powermin, powermax)
-
-        mel_mix.append(mel_mix_extract)
-        mel_piano.append(mel_piano_extract)
-        mel_violin.append(mel_violin_extract)
-
-    mel_spec = [tf.cast(tf.expand_dims(mel_mix, axis=-1), tf.float32),
-                tf.cast(tf.expand_dims(mel_piano, axis=-1), tf.float32),
-                tf.cast(tf.expand_dims(mel_violin, axis=-1), tf.float32)]
+    raw = [load_song_extracts(path, length_sec, sr=sr, n_extract=n_extract) for path in [mix_path] + list(source_paths)]
+    # every signal is cut to the extracts shared by all of them
+    n_extract = min(len(extracts) for extracts in raw)
+    raw = np.stack([extracts[:n_extract] for extracts in raw])
+
+    raw_audio = [np.reshape(extracts, [-1]) for extracts in raw]
+
+    mel_extracts, stfts = extracts_to_melspec(np.reshape(raw, (-1, raw.shape[-1])), **kwargs)
+    mel_extracts = np.reshape(mel_extracts, raw.shape[:2] + mel_extracts.shape[1:])
+    stft_mixture = stfts[:n_extract]
+    mel_spec = [tf.cast(tf.expand_dims(mel, axis=-1), tf.float32) for mel in mel_extracts]
 
     return mel_spec, raw_audio, stft_mixture
+
+
+def stream_song_extracts(path, length_sec, n_extract, sr=16000, overlap_sec=0., block_sec=60.):
+    """
+    Read a wav file of any length by blocks and cut it in overlapping extracts
+    Only about one block of audio is kept in memory
+
+    path (str): path of the wav file
+    length_sec (float): length of each extract in seconds
+    n_extract (int): number of extracts yielded at each iteration
+    sr (int): sampling rate of the extracts. Blocks are resampled if the file has another rate
+    overlap_sec (float): overlap between consecutive extracts in seconds
+    block_sec (float): length of the blocks read from the file in seconds
+
+    Yields:
+        extracts: ndarray [n_extract, length]. Extract i of chunk c starts at sample (c * n_extract + i) * hop
+        n_samples: number of samples of the song in the chunk (the end of the last chunk is zero-padded)
+    """
+    length = int(sr * length_sec)
+    hop = length - int(sr * overlap_sec)
+    assert hop > 0, "overlap_sec should be smaller than length_sec"
+    chunk_size = (n_extract - 1) * hop + length
+    chunk_hop = n_extract * hop
+
+    buffer = np.zeros(0, dtype=np.float32)
+    with sf.SoundFile(path) as f:
+        native_sr = f.samplerate
+        eof = False
+        n_seen = 0
+        while True:
+            while not eof and len(buffer) < chunk_size:
+                block = f.read(int(block_sec * native_sr), dtype='float32', always_2d=True)
+                if len(block) == 0:
+                    eof = True
+                    break
+                block = np.mean(block, axis=1)
+                if native_sr != sr:
+                    block = librosa.resample(block, native_sr, sr)
+                buffer = np.concatenate((buffer, block))
+
+            # stop when the samples left have all been yielded with the previous chunk
+            if eof and len(buffer) <= n_seen:
+                break
+            n_samples = min(len(buffer), chunk_size)
+            chunk = np.pad(buffer[:chunk_size], (0, chunk_size - n_samples))
+            yield np.stack([chunk[i * hop: i * hop + length] for i in range(n_extract)]), n_samples
+
+            n_seen = chunk_size - chunk_hop
+            buffer = buffer[chunk_hop:]
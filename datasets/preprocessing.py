@@ -1,9 +1,14 @@
 import tensorflow as tf
-from librosa.feature import melspectrogram
 import librosa
 import os
 import numpy as np
 import re
+import json
+try:
+    from .spectral import get_spectral_transform
+except ImportError:
+    # imported as a top-level module by wav_to_spec.py
+    from spectral import get_spectral_transform
 
 
 def load_wav(path, length_sec, sr=None):
@@ -57,6 +62,41 @@ def load_multiple_wav(path, length_sec):
     return dataset
 
 
+def tf_mel_spectrogram_fn(sr, n_fft=2048, hop_length=512, n_mels=128, fmin=125, fmax=7600, dbmin=-100, dbmax=20,
+                          use_dB=False):
+    """
+    Graph-native mel spectrogram, numerically equal (up to float32 precision) to librosa.feature.melspectrogram
+    followed by the clipping and the dB conversion of the preprocessing: reflect padding of n_fft // 2 samples
+    on each side (center=True), periodic Hann window of n_fft samples, power STFT and Slaney mel filterbank
+    of spectral.get_spectral_transform
+
+    Only tensorflow ops: the function can be mapped on a tf.data pipeline with num_parallel_calls
+    and composed with random augmentations of the raw audio.
+
+    Returns:
+        function: audio tensor [..., length] -> tensor [..., n_mels, 1 + length // hop_length]
+    """
+    mel_basis = tf.constant(get_spectral_transform(sr, n_fft, hop_length, n_mels, fmin, fmax).mel_basis)
+    powermin = float(np.exp(dbmin * np.log(10.) / 10.))
+    powermax = float(np.exp(dbmax * np.log(10.) / 10.))
+
+    def mel_spectrogram(x):
+        x = tf.convert_to_tensor(x, dtype=tf.float32)
+        paddings = [[0, 0]] * (x.shape.rank - 1) + [[n_fft // 2, n_fft // 2]]
+        x = tf.pad(x, paddings, mode='REFLECT')
+        stft = tf.signal.stft(x, frame_length=n_fft, frame_step=hop_length, fft_length=n_fft,
+                              window_fn=tf.signal.hann_window, pad_end=False)
+        power = tf.square(tf.abs(stft))
+        # [..., frames, 1 + n_fft // 2] x [n_mels, 1 + n_fft // 2]^T -> [..., n_mels, frames]
+        mel_spect = tf.linalg.matrix_transpose(tf.matmul(power, mel_basis, transpose_b=True))
+        mel_spect = tf.clip_by_value(mel_spect, powermin, powermax)
+        if use_dB:
+            mel_spect = 10. * tf.math.log(mel_spect) / tf.math.log(10.)
+        return mel_spect
+
+    return mel_spectrogram
+
+
 def mel_spectrograms_from_ds(song_ds, sr, n_fft=2048, hop_length=512,
                              n_mels=128, fmin=125, fmax=7600, dbmin=-100, dbmax=20,
                              use_dB=False):
@@ -64,6 +104,7 @@ def mel_spectrograms_from_ds(song_ds, sr, n_fft=2048, hop_length=512,
     Take as input a dataset of raw audio:
 
     Compute the mel spectrogram for each element
+    The spectrograms are computed by tensorflow ops (tf_mel_spectrogram_fn) in parallel calls
 
     Inputs:
     song_ds: tensorflow dataset
@@ -75,54 +116,57 @@ def mel_spectrograms_from_ds(song_ds, sr, n_fft=2048, hop_length=512,
     Outputs:
     tensorflow datasets
     """
+    map_fn = tf_mel_spectrogram_fn(sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, fmin=fmin, fmax=fmax,
+                                   dbmin=dbmin, dbmax=dbmax, use_dB=use_dB)
+    return song_ds.map(map_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    def get_mel_spectrograms_fn(sr, n_fft, hop_length, n_mels, fmin, fmax):
 
-        def get_mel_spectrograms(x):
-            mel_spect = melspectrogram(y=np.asfortranarray(x), sr=sr, S=None, n_fft=n_fft,
-                                       hop_length=hop_length, win_length=None, window='hann', center=True,
-                                       pad_mode='reflect', power=2.0, n_mels=n_mels, fmin=fmin, fmax=fmax)
-            return mel_spect
-
-        return get_mel_spectrograms
+def frame_audio(song, length):
+    """
+    Cut a song into consecutive frames of length samples (the remainder is dropped)
 
-    map_fn = get_mel_spectrograms_fn(sr, n_fft, hop_length, n_mels, fmin, fmax)
+    Returns:
+        ndarray [n_frames, length] (a view of song)
+    """
+    n_frames = len(song) // length
+    return np.reshape(song[:n_frames * length], (n_frames, length))
 
-    spect_dataset = song_ds.map(
-        lambda x: tf.py_function(map_fn, inp=[x], Tout=tf.float32))
 
-    powermin = np.exp(dbmin * np.log(10.) / 10.)
-    powermax = np.exp(dbmax * np.log(10.) / 10.)
-    spect_dataset = spect_dataset.map(lambda x: tf.clip_by_value(x, powermin, powermax))
-
-    if use_dB:
-        spect_dataset = spect_dataset.map(lambda x: 10. * tf.math.log(x) / tf.math.log(10.))
+def mel_spectrograms_from_frames(frames, sr, n_fft=2048, hop_length=512, n_mels=128, fmin=125, fmax=7600,
+                                 dbmin=-100, dbmax=20, use_dB=False, chunk_size=64):
+    """
+    Vectorized version of mel_spectrograms_from_ds: mel spectrograms of every frame of a song
 
-    return spect_dataset
+    The frames are processed by chunks of chunk_size to bound the memory of the STFT.
 
+    frames: ndarray [n_frames, length]
 
-def mel_spectrograms_from_ds_tfSignal(song_ds, sr, frame_length, n_fft=2048, hop_length=512, n_mels=128):
+    Returns:
+        ndarray float32 [n_frames, n_mels, 1 + length // hop_length]
+    """
+    transform = get_spectral_transform(sr, n_fft, hop_length, n_mels, fmin, fmax)
+    powermin = np.exp(dbmin * np.log(10.) / 10.)
+    powermax = np.exp(dbmax * np.log(10.) / 10.)
+    n_windows = 1 + frames.shape[1] // hop_length
+    mel_spects = np.empty((frames.shape[0], n_mels, n_windows), dtype=np.float32)
+    for start in range(0, frames.shape[0], chunk_size):
+        stop = min(start + chunk_size, frames.shape[0])
+        mel_spect = np.clip(transform.melspectrogram(frames[start:stop]), powermin, powermax)
+        if use_dB:
+            mel_spect = 10. * np.log10(mel_spect)
+        mel_spects[start:stop] = mel_spect
+    return mel_spects
+
+
+def mel_spectrograms_from_ds_tfSignal(song_ds, sr, frame_length=None, n_fft=2048, hop_length=512, n_mels=128,
+                                      fmin=125, fmax=7600, dbmin=-100, dbmax=20, use_dB=False):
     """
-    Same function as above but use the tf.signal package
+    Same function as above, kept for wav_to_spec.py --use_signal
 
-    Need to specify the frame_length (length_sec * rate)
+    frame_length is not used anymore: the STFT windows are n_fft samples as in librosa
     """
-    ds_stft = song_ds.map(lambda x: tf.signal.stft(x,
-                                                   frame_length=frame_length,
-                                                   frame_step=hop_length,
-                                                   fft_length=n_fft,
-                                                   window_fn=tf.signal.hann_window,
-                                                   pad_end=True, name=None))
-    ds_stft_power = ds_stft.map(lambda x: tf.cast(tf.abs(x)**2, tf.float32))
-    num_spectrogram_bins = (n_fft // 2) + 1
-    A = tf.signal.linear_to_mel_weight_matrix(num_mel_bins=n_mels,
-                                              num_spectrogram_bins=num_spectrogram_bins,
-                                              sample_rate=sr,
-                                              lower_edge_hertz=0.,
-                                              upper_edge_hertz=float(sr) / 2,
-                                              dtype=tf.dtypes.float32, name=None)
-    ds_mel = ds_stft_power.map(lambda x: tf.matmul(x, A))
-    return ds_mel
+    return mel_spectrograms_from_ds(song_ds, sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, fmin=fmin,
+                                    fmax=fmax, dbmin=dbmin, dbmax=dbmax, use_dB=use_dB)
 
 
 def save_mel_spectrograms(mel_spectrograms_ds, filename):
@@ -244,6 +288,106 @@ def save_tf_records(dataset, filename):
     return 0
 
 
+INDEX_SUFFIX = '.index.json'
+
+
+def write_tf_records_index(filename, arrays):
+    """
+    Write the sidecar index of the TFRecords filename holding arrays (ndarray [N, ...]) into filename.index.json:
+    number of records, shape and value statistics (min, max, mean, std)
+    """
+    arrays = np.asarray(arrays)
+    index = {'count': int(arrays.shape[0]), 'shape': list(arrays.shape[1:])}
+    if arrays.shape[0] > 0:
+        index.update({'min': float(np.min(arrays)), 'max': float(np.max(arrays)),
+                      'mean': float(np.mean(arrays, dtype=np.float64)), 'std': float(np.std(arrays, dtype=np.float64))})
+    with open(filename + INDEX_SUFFIX + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(filename + INDEX_SUFFIX + '.tmp', filename + INDEX_SUFFIX)
+
+
+def read_tf_records_index(filename):
+    """
+    Returns:
+        dict: sidecar index of the TFRecords filename (see write_tf_records_index), None if there is none
+            or if it is older than the TFRecords
+    """
+    index_path = filename + INDEX_SUFFIX
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(filename):
+        return None
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def count_tf_records(filenames):
+    """
+    Number of records of the TFRecords filenames
+
+    The counts are read from the sidecar indexes. The files without index are scanned
+    without parsing the records (count only).
+    """
+    count = 0
+    unindexed = []
+    for filename in filenames:
+        index = read_tf_records_index(filename)
+        if index is None:
+            unindexed.append(filename)
+        else:
+            count += index['count']
+    if len(unindexed) > 0:
+        count += int(tf.data.TFRecordDataset(unindexed).reduce(np.int64(0), lambda n, _: n + 1))
+    return count
+
+
+def tf_records_statistics(filenames):
+    """
+    Value statistics (count, min, max, mean, std) of the TFRecords filenames, from their sidecar indexes
+
+    Returns:
+        dict, None if a file has no index
+    """
+    indexes = [read_tf_records_index(filename) for filename in filenames]
+    if any(index is None for index in indexes):
+        return None
+    indexes = [index for index in indexes if index['count'] > 0]
+    if len(indexes) == 0:
+        return {'count': 0}
+    sizes = np.array([index['count'] * np.prod(index['shape']) for index in indexes], dtype=np.float64)
+    means = np.array([index['mean'] for index in indexes])
+    second_moments = np.array([index['std'] ** 2 + index['mean'] ** 2 for index in indexes])
+    mean = np.sum(sizes * means) / np.sum(sizes)
+    return {'count': int(sum(index['count'] for index in indexes)),
+            'min': min(index['min'] for index in indexes),
+            'max': max(index['max'] for index in indexes),
+            'mean': float(mean),
+            'std': float(np.sqrt(max(np.sum(sizes * second_moments) / np.sum(sizes) - mean ** 2, 0.)))}
+
+
+def save_tf_records_shards(arrays, prefix, shard_size_mb=100.):
+    """
+    Save arrays (ndarray [N, ...]) as TFRecords shards of about shard_size_mb megabytes
+
+    The shards are written as prefix-00000.tfrecord, prefix-00001.tfrecord, ... A shard is first written
+    under a temporary name and renamed once complete, so an interrupted run leaves no truncated shard.
+    Each shard gets its sidecar index (see write_tf_records_index).
+
+    Returns:
+        list of the shards filenames
+    """
+    example_size = arrays[0].size * 4 if len(arrays) > 0 else 1
+    shard_length = max(1, int(shard_size_mb * 2 ** 20 // example_size))
+    filenames = []
+    for i, start in enumerate(range(0, len(arrays), shard_length)):
+        filename = '{}-{:05d}.tfrecord'.format(prefix, i)
+        with tf.io.TFRecordWriter(filename + '.tmp') as writer:
+            for array in arrays[start:start + shard_length]:
+                writer.write(serialize_example(array))
+        os.replace(filename + '.tmp', filename)
+        write_tf_records_index(filename, arrays[start:start + shard_length])
+        filenames.append(filename)
+    return filenames
+
+
 def load_tf_records(filenames, dtype=tf.float32):
     """
     Load tf.records (saved with the above function) into a tensorflow dataset
@@ -0,0 +1,153 @@
+import tensorflow as tf
+import numpy as np
+import json
+import os
+
+
+"""
+Binary spectrogram store
+
+A shard holds N spectrograms of the same shape as one raw little-endian float16 or float32 array [N, ...]
+after a header of HEADER_SIZE bytes: the magic string then a JSON index {"count", "shape", "dtype"}.
+The spectrograms are read through np.memmap without any parsing: only the slices of the batches are copied.
+Shards use the extension .spec and live next to (or instead of) the TFRecords of a dataset.
+"""
+
+MAGIC = b'SPECSTORE1'
+HEADER_SIZE = 4096
+EXTENSION = '.spec'
+DTYPES = {'float16': '<f2', 'float32': '<f4'}
+
+
+def write_shard(filename, arrays, dtype='float32'):
+    """
+    Write arrays (ndarray [N, ...]) into the shard filename
+
+    The shard is written under a temporary name and renamed once complete.
+    """
+    if dtype not in DTYPES:
+        raise ValueError("dtype should be one of {}".format(list(DTYPES.keys())))
+    arrays = np.ascontiguousarray(arrays, dtype=DTYPES[dtype])
+    header = MAGIC + json.dumps({'count': int(arrays.shape[0]), 'shape': list(arrays.shape[1:]),
+                                 'dtype': dtype}).encode('utf-8')
+    if len(header) > HEADER_SIZE:
+        raise ValueError("header of {} bytes larger than {}".format(len(header), HEADER_SIZE))
+
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        f.write(arrays.tobytes())
+    os.replace(filename + '.tmp', filename)
+
+
+def save_spec_store_shards(arrays, prefix, shard_size_mb=100., dtype='float32'):
+    """
+    Save arrays (ndarray [N, ...]) as shards of about shard_size_mb megabytes: prefix-00000.spec, prefix-00001.spec, ...
+
+    Returns:
+        list of the shards filenames
+    """
+    example_size = arrays[0].size * np.dtype(DTYPES[dtype]).itemsize if len(arrays) > 0 else 1
+    shard_length = max(1, int(shard_size_mb * 2 ** 20 // example_size))
+    filenames = []
+    for i, start in enumerate(range(0, len(arrays), shard_length)):
+        filename = '{}-{:05d}{}'.format(prefix, i, EXTENSION)
+        write_shard(filename, arrays[start:start + shard_length], dtype=dtype)
+        filenames.append(filename)
+    return filenames
+
+
+def read_header(filename):
+    """
+    Returns:
+        dict: count, shape and dtype of the shard
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+        raise ValueError("{} is not a spectrogram store shard".format(filename))
+    return json.loads(header[len(MAGIC):].rstrip(b'\0').decode('utf-8'))
+
+
+def open_shard(filename):
+    """
+    Memory map of the spectrograms of a shard
+
+    Returns:
+        read-only np.memmap [count, ...]
+    """
+    header = read_header(filename)
+    return np.memmap(filename, dtype=DTYPES[header['dtype']], mode='r', offset=HEADER_SIZE,
+                     shape=tuple([header['count']] + header['shape']))
+
+
+def store_size(filenames):
+    """
+    Number of spectrograms of the shards (read from the headers)
+    """
+    return sum(read_header(filename)['count'] for filename in filenames)
+
+
+def _batches(filenames, batch_size, shuffle, seed):
+    """
+    Batches of batch_size spectrograms gathered from the memory maps of the shards
+
+    With shuffle, the spectrograms are drawn in a random order across all the shards:
+    each batch gathers its spectrograms from the shards they belong to (sorted reads in each memory map).
+    Without shuffle, the batches are consecutive slices of the shards.
+    """
+    rng = np.random.RandomState(seed)
+    shards = [open_shard(filename) for filename in filenames]
+    # global index of the first spectrogram of each shard
+    offsets = np.cumsum([0] + [len(data) for data in shards])
+    order = rng.permutation(offsets[-1]) if shuffle else np.arange(offsets[-1])
+    for start in range(0, len(order), batch_size):
+        indices = np.sort(order[start:start + batch_size])
+        bounds = np.searchsorted(indices, offsets)
+        parts = []
+        for data, offset, lo, hi in zip(shards, offsets, bounds[:-1], bounds[1:]):
+            if hi > lo:
+                local = indices[lo:hi] - offset
+                parts.append(data[local] if shuffle else np.asarray(data[local[0]:local[-1] + 1]))
+        yield np.concatenate(parts)
+
+
+def load_spec_store(filenames, batch_size=None, shuffle=False, seed=None, drop_remainder=False, block_size=256):
+    """
+    Load the shards filenames into a tensorflow dataset of float32 spectrograms
+
+    The batches are sliced from the memory maps of the shards and converted to float32 in the tf.data pipeline.
+
+    Parameters:
+        batch_size: size of the batches. If None, the dataset yields single spectrograms
+            (read by blocks of block_size spectrograms)
+        shuffle: shuffle the spectrograms across all the shards (new order at every epoch)
+
+    Returns:
+        tensorflow dataset
+    """
+    filenames = list(filenames)
+    if len(filenames) == 0:
+        raise ValueError("no spectrogram store shard given")
+    headers = [read_header(filename) for filename in filenames]
+    shape = headers[0]['shape']
+    if any(header['shape'] != shape for header in headers):
+        raise ValueError("every shard should hold spectrograms of the same shape")
+    dtype = tf.float16 if all(header['dtype'] == 'float16' for header in headers) else tf.float32
+
+    read_size = block_size if batch_size is None else batch_size
+    epoch = [0]
+
+    def generator():
+        # a different order at each epoch, reproducible from seed
+        epoch_seed = None if seed is None else seed + epoch[0]
+        epoch[0] += 1
+        for batch in _batches(filenames, read_size, shuffle, epoch_seed):
+            yield batch
+
+    ds = tf.data.Dataset.from_generator(generator, output_types=dtype,
+                                        output_shapes=tf.TensorShape([None] + shape))
+    if batch_size is None:
+        ds = ds.unbatch()
+    elif drop_remainder:
+        ds = ds.filter(lambda x: tf.shape(x)[0] == batch_size)
+    return ds.map(lambda x: tf.cast(x, tf.float32), num_parallel_calls=tf.data.experimental.AUTOTUNE)
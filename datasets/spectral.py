@@ -0,0 +1,220 @@
+import functools
+import numpy as np
+import librosa
+import scipy.optimize
+
+
+"""
+Spectral front-end shared by the preprocessing, the separation and the inversion
+
+A SpectralTransform holds the operators of one set of parameters (sr, n_fft, hop_length, n_mels, fmin, fmax):
+the Hann window, the window sum-square envelopes, the mel basis, its pseudo-inverse and the state of the NNLS solver
+of the mel inversion. They are built once, on first use. get_spectral_transform memoizes the transforms
+process wide, so the code paths that use the same parameters share the same operators.
+Every operator works on batches: the last two axes are (frequencies, frames), the leading axes are batch axes.
+"""
+
+
+def hann_window(n_fft):
+    """
+    Periodic Hann window (same as scipy.signal.get_window('hann', n_fft))
+    """
+    return (0.5 - 0.5 * np.cos(2. * np.pi * np.arange(n_fft) / n_fft)).astype(np.float32)
+
+
+def _nnls_obj(x, shape, A, B):
+    """
+    Objective 0.5 * ||A x - B||^2 and its gradient for scipy.optimize.fmin_l_bfgs_b
+    """
+    x = x.reshape(shape)
+    diff = np.dot(A, x) - B
+    return 0.5 * np.sum(diff ** 2), np.dot(A.T, diff).flatten()
+
+
+class SpectralTransform(object):
+    """
+    STFT and mel operators of one set of parameters (use get_spectral_transform to share them)
+
+    Parameters:
+        sr (int): sampling rate
+        n_fft (int): window size of the STFT
+        hop_length (int): jump between each window of the STFT
+        n_mels (int): number of mel frequencies
+        fmin, fmax (float): frequency range of the mel filters (fmax = sr / 2 if None)
+    """
+
+    def __init__(self, sr=16000, n_fft=2048, hop_length=512, n_mels=128, fmin=0., fmax=None):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.fmin = fmin
+        self.fmax = float(sr) / 2 if fmax is None else fmax
+        self.window = hann_window(n_fft)
+        self.window.setflags(write=False)
+        self._envelopes = {}
+        self._mel_basis = None
+        self._mel_pinv = None
+
+    @property
+    def n_freqs(self):
+        return 1 + self.n_fft // 2
+
+    @property
+    def mel_basis(self):
+        """
+        Slaney mel filterbank [n_mels, 1 + n_fft // 2] (same as librosa.filters.mel)
+        """
+        if self._mel_basis is None:
+            mel_basis = librosa.filters.mel(sr=self.sr, n_fft=self.n_fft, n_mels=self.n_mels, fmin=self.fmin,
+                                            fmax=self.fmax).astype(np.float32)
+            mel_basis.setflags(write=False)
+            self._mel_basis = mel_basis
+        return self._mel_basis
+
+    @property
+    def mel_pinv(self):
+        """
+        Pseudo-inverse [1 + n_fft // 2, n_mels] of the mel basis: least squares start of the NNLS solver
+        """
+        if self._mel_pinv is None:
+            mel_pinv = np.linalg.pinv(self.mel_basis).astype(np.float32)
+            mel_pinv.setflags(write=False)
+            self._mel_pinv = mel_pinv
+        return self._mel_pinv
+
+    def stft(self, frames):
+        """
+        STFT of a batch of signals, same as librosa.stft(y, n_fft, hop_length, window='hann', center=True,
+        pad_mode='reflect') on each signal
+
+        frames: ndarray [..., length]
+
+        Returns:
+            ndarray complex64 [..., 1 + n_fft // 2, 1 + length // hop_length]
+        """
+        frames = np.asarray(frames, dtype=np.float32)
+        batch_shape = frames.shape[:-1]
+        frames = np.reshape(frames, (-1, frames.shape[-1]))
+        padded = np.pad(frames, [(0, 0), (self.n_fft // 2, self.n_fft // 2)], mode='reflect')
+        n_windows = 1 + (padded.shape[1] - self.n_fft) // self.hop_length
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(padded.shape[0], n_windows, self.n_fft),
+                                                  strides=(padded.strides[0], padded.strides[1] * self.hop_length,
+                                                           padded.strides[1]),
+                                                  writeable=False)
+        stfts = np.swapaxes(np.fft.rfft(windows * self.window, axis=-1).astype(np.complex64), 1, 2)
+        return np.reshape(stfts, batch_shape + stfts.shape[1:])
+
+    def envelope(self, n_frames):
+        """
+        Window sum-square of n_frames overlapping windows (cached for each number of frames)
+        """
+        if n_frames not in self._envelopes:
+            envelope = np.zeros(self.n_fft + self.hop_length * (n_frames - 1), dtype=np.float32)
+            for t in range(n_frames):
+                envelope[t * self.hop_length: t * self.hop_length + self.n_fft] += self.window ** 2
+            envelope = np.maximum(envelope, np.finfo(np.float32).tiny)
+            envelope.setflags(write=False)
+            self._envelopes[n_frames] = envelope
+        return self._envelopes[n_frames]
+
+    def istft(self, stfts, length=None):
+        """
+        ISTFT of a batch of STFT, same as librosa.istft(stft, hop_length, window='hann', center=True, length=length)
+
+        stfts: ndarray complex [..., 1 + n_fft // 2, frames]
+
+        Returns:
+            ndarray float32 [..., length] (length = hop_length * (frames - 1) if None)
+        """
+        batch_shape = stfts.shape[:-2]
+        stfts = np.reshape(stfts, (-1,) + stfts.shape[-2:])
+        n_batch, _, n_frames = stfts.shape
+        frames = (np.fft.irfft(stfts, n=self.n_fft, axis=1) * self.window[:, None]).astype(np.float32)
+        audio = np.zeros((n_batch, self.n_fft + self.hop_length * (n_frames - 1)), dtype=np.float32)
+        if self.n_fft % self.hop_length == 0:
+            # the frames are added by blocks of hop_length samples: n_fft // hop_length vectorized additions
+            blocks = np.reshape(frames, (n_batch, self.n_fft // self.hop_length, self.hop_length, n_frames))
+            for j in range(blocks.shape[1]):
+                audio[:, j * self.hop_length: (j + n_frames) * self.hop_length] += np.reshape(
+                    np.swapaxes(blocks[:, j], 1, 2), (n_batch, -1))
+        else:
+            for t in range(n_frames):
+                audio[:, t * self.hop_length: t * self.hop_length + self.n_fft] += frames[:, :, t]
+        audio /= self.envelope(n_frames)
+
+        audio = audio[:, self.n_fft // 2:]
+        if length is None:
+            length = self.hop_length * (n_frames - 1)
+        if audio.shape[1] < length:
+            audio = np.pad(audio, [(0, 0), (0, length - audio.shape[1])])
+        return np.reshape(audio[:, :length], batch_shape + (length,))
+
+    def mel(self, power):
+        """
+        Mel projection of power spectrograms [..., 1 + n_fft // 2, frames] -> [..., n_mels, frames]
+        """
+        return np.matmul(self.mel_basis, power)
+
+    def melspectrogram(self, frames):
+        """
+        Power mel spectrograms of a batch of signals [..., length], same as librosa.feature.melspectrogram
+        with the parameters of the transform
+
+        Returns:
+            ndarray float32 [..., n_mels, 1 + length // hop_length]
+        """
+        return self.mel(np.abs(self.stft(frames)) ** 2)
+
+    def nnls(self, B):
+        """
+        Non-negative least squares min ||mel_basis x - B|| s.t. x >= 0, same as librosa.util.nnls(mel_basis, B)
+
+        The columns are solved by blocks with L-BFGS-B, started from the pseudo-inverse solution clipped at 0.
+
+        B: ndarray [n_mels, N]
+
+        Returns:
+            ndarray float32 [1 + n_fft // 2, N]
+        """
+        A = self.mel_basis
+        x = np.clip(np.dot(self.mel_pinv, B), 0, None).astype(np.float32)
+        n_columns = max(1, librosa.util.MAX_MEM_BLOCK // (A.shape[-1] * A.itemsize))
+        for start in range(0, B.shape[-1], n_columns):
+            block = slice(start, start + n_columns)
+            x_init = x[:, block]
+            solution, _, _ = scipy.optimize.fmin_l_bfgs_b(_nnls_obj, x_init, args=(x_init.shape, A, B[:, block]),
+                                                          bounds=[(0, None)] * x_init.size, m=A.shape[1])
+            x[:, block] = np.reshape(solution, x_init.shape)
+        return x
+
+    def mel_to_stft(self, melspecs, power=2.):
+        """
+        Magnitude STFT of mel spectrograms, same as librosa.feature.inverse.mel_to_stft on each spectrogram.
+        The frames of the whole batch are solved as one NNLS problem
+
+        melspecs: ndarray [..., n_mels, frames] of power (power=2) or amplitude (power=1) mel spectrograms
+
+        Returns:
+            ndarray float32 [..., 1 + n_fft // 2, frames]
+        """
+        melspecs = np.asarray(melspecs)
+        batch_shape, n_frames = melspecs.shape[:-2], melspecs.shape[-1]
+        columns = np.reshape(np.moveaxis(melspecs, -2, 0), (self.n_mels, -1))
+        magnitudes = np.power(self.nnls(columns), 1. / power)
+        return np.moveaxis(np.reshape(magnitudes, (self.n_freqs,) + batch_shape + (n_frames,)), 0, -2)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_spectral_transform(sr, n_fft, hop_length, n_mels, fmin, fmax):
+    return SpectralTransform(sr=sr, n_fft=n_fft, hop_length=hop_length, n_mels=n_mels, fmin=fmin, fmax=fmax)
+
+
+def get_spectral_transform(sr=16000, n_fft=2048, hop_length=512, n_mels=128, fmin=0., fmax=None):
+    """
+    SpectralTransform of the parameters, memoized process wide (the 16 last sets of parameters)
+
+    The parameters are normalized so that the same transform is returned whatever the types of the arguments.
+    """
+    fmax = float(sr) / 2 if fmax is None else float(fmax)
+    return _get_spectral_transform(int(sr), int(n_fft), int(hop_length), int(n_mels), float(fmin), fmax)
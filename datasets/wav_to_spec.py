@@ -1,19 +1,125 @@
 from preprocessing import *
+from spec_store import save_spec_store_shards
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import collections
+import json
 import time
 import argparse
 import warnings
 warnings.filterwarnings("ignore")
 
 
+SPEC_PARAMS = ['length_sec', 'sr', 'n_fft', 'hop_length', 'n_mels', 'fmin', 'fmax', 'dbmin', 'dbmax', 'use_dB', 'tfrecords',
+               'spec_store', 'store_dtype', 'shard_size']
+
+
+def manifest_path(prefix):
+    return prefix + '.manifest.json'
+
+
+def is_up_to_date(wav_file, prefix, params):
+    """
+    True if the spectrograms of wav_file were already saved at prefix with the same parameters
+    and the wav file has not been modified since
+    """
+    try:
+        with open(manifest_path(prefix), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return (manifest['params'] == params and manifest['mtime'] >= os.path.getmtime(wav_file)
+            and all(os.path.exists(os.path.join(os.path.dirname(prefix), output)) for output in manifest['outputs']))
+
+
+def remove_previous_outputs(prefix):
+    """
+    Delete the outputs listed by the manifest of a previous run at prefix, with their sidecar indexes,
+    so that shards of another shard size or format are not loaded with the new ones.
+    The manifest is deleted first: an interrupted run is never seen as up to date.
+    """
+    try:
+        with open(manifest_path(prefix), 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    os.remove(manifest_path(prefix))
+    for output in manifest['outputs']:
+        output = os.path.join(os.path.dirname(prefix), output)
+        for filename in [output, output + INDEX_SUFFIX]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+def process_wav(wav_file, prefix, params):
+    """
+    Compute the mel spectrograms of every frame of wav_file in one vectorized call and save them at prefix.
+    Run in a worker process.
+
+    The outputs of the previous run at prefix are deleted first. The manifest (source modification time, parameters
+    and outputs) is written last: a file is only skipped by the next runs once all its outputs are complete.
+
+    Returns:
+        number of spectrograms
+    """
+    mtime = os.path.getmtime(wav_file)
+    song, rate = librosa.core.load(wav_file, sr=params['sr'], mono=True)
+    frames = frame_audio(song, int(rate * params['length_sec']))
+    mel_spects = mel_spectrograms_from_frames(frames, rate, params['n_fft'], params['hop_length'], params['n_mels'],
+                                              fmin=params['fmin'], fmax=params['fmax'], dbmin=params['dbmin'],
+                                              dbmax=params['dbmax'], use_dB=params['use_dB'])
+
+    remove_previous_outputs(prefix)
+    if params['spec_store']:
+        outputs = save_spec_store_shards(mel_spects, prefix, shard_size_mb=params['shard_size'], dtype=params['store_dtype'])
+    elif params['tfrecords']:
+        outputs = save_tf_records_shards(mel_spects, prefix, shard_size_mb=params['shard_size'])
+    else:
+        outputs = []
+        for i, mel_spect in enumerate(mel_spects):
+            np.save(prefix + '_{}'.format(i), mel_spect)
+            outputs.append(prefix + '_{}.npy'.format(i))
+
+    manifest = {'source': wav_file, 'mtime': mtime, 'params': params, 'count': len(mel_spects),
+                'outputs': [os.path.basename(output) for output in outputs]}
+    with open(manifest_path(prefix) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path(prefix) + '.tmp', manifest_path(prefix))
+    return len(mel_spects)
+
+
+def process_wav_tfSignal(wav_file, prefix, args):
+    # load the wav file
+    song_ds, rate = load_wav(wav_file, args.length_sec, sr=args.sr)
+    print('{} Loaded...'.format(wav_file))
+    melspectrograms_ds = mel_spectrograms_from_ds_tfSignal(song_ds, rate, n_fft=args.n_fft, hop_length=args.hop_length,
+                                                           n_mels=args.n_mels, fmin=args.fmin, fmax=args.fmax,
+                                                           dbmin=args.dbmin, dbmax=args.dbmax, use_dB=args.use_dB)
+    print("\t Mel Spectrograms computed using tf.signal")
+    remove_previous_outputs(prefix)
+    if args.tfrecords:
+        save_tf_records(melspectrograms_ds, prefix)
+        print('\t Saved as tfrecords at {}'.format(prefix))
+    else:
+        N = save_mel_spectrograms(melspectrograms_ds, prefix)
+        print("\tSaved into {} spectrograms as npy".format(N))
+
+
 def main(args):
     """
     Walk the input folder
     For each wav file:
             Save spectrograms as tfrecords files into output directory
 
+    The wav files are distributed across n_workers processes. Files whose spectrograms are up to date
+    (same parameters, wav file not modified since) are skipped, so an interrupted run can be resumed.
     """
     t0 = time.time()
 
+    if args.store_dtype is None:
+        # power spectrograms span 1e-10 to 1e2: float16 would flush the low energy bins to zero
+        args.store_dtype = 'float16' if args.use_dB else 'float32'
+
     input_dirpath = os.path.abspath(args.INPUT)
     output_dirpath = os.path.abspath(args.OUTPUT)
 
@@ -22,7 +128,7 @@ def main(args):
     except FileExistsError:
         pass
 
-    logfile = open(os.path.join(output_dirpath, "out.log"), 'w')
+    logfile = open(os.path.join(output_dirpath, "out.log"), 'a')
     params_dict = vars(args)
     template = ''
     for k, v in params_dict.items():
@@ -36,40 +142,39 @@ def main(args):
         if len(files) > 0:
             wav_files += [os.path.join(current_path, f)
                           for f in files if re.match(".*(.)wav$", f)]
+    # the relative path of the wav files is kept in the prefixes: same-named files of different subdirectories
+    # must not write the same shards
+    prefixes = [os.path.join(output_dirpath, os.path.relpath(wav_file, input_dirpath)[:-4].replace(os.sep, '_'))
+                for wav_file in wav_files]
+    duplicates = [prefix for prefix, count in collections.Counter(prefixes).items() if count > 1]
+    if len(duplicates) > 0:
+        raise ValueError("Several wav files would be saved at the same prefixes: {}".format(duplicates))
+
+    if args.use_signal and args.spec_store:
+        raise ValueError("--spec_store is not available with --use_signal")
+    if args.use_signal:
+        for wav_file, prefix in zip(wav_files, prefixes):
+            process_wav_tfSignal(wav_file, prefix, args)
+        n_skipped = 0
+    else:
+        params = {k: params_dict[k] for k in SPEC_PARAMS}
+        todo = [(wav_file, prefix) for wav_file, prefix in zip(wav_files, prefixes)
+                if args.overwrite or not is_up_to_date(wav_file, prefix, params)]
+        n_skipped = len(wav_files) - len(todo)
+        print("{} wav files up to date, {} to process with {} workers".format(n_skipped, len(todo), args.n_workers))
 
-    for wav_file in wav_files:
-        # load the wav file
-        song_ds, rate = load_wav(wav_file, args.length_sec, sr=args.sr)
-        print('{} Loaded...'.format(wav_file))
-        # compute the spectrograms
-        if args.use_signal:
-            melspectrograms_ds = mel_spectrograms_from_ds_tfSignal(song_ds, rate,
-                                                                   int(rate * args.length_sec),
-                                                                   args.n_fft, args.hop_length, args.n_mels)
-            print("\t Mel Spectrograms computed using tf.signal")
-        else:
-            melspectrograms_ds = mel_spectrograms_from_ds(
-                song_ds, rate, args.n_fft, args.hop_length, args.n_mels,
-                fmin=args.fmin, fmax=args.fmax, dbmin=args.dbmin, dbmax=args.dbmax, use_dB=args.use_dB)
-            print("\t Mel Spectrograms computed using librosa")
-
-        # save the spectrograms
-        filename_dirpath = os.path.join(output_dirpath, os.path.split(wav_file)[1])
-        filename_dirpath = filename_dirpath[:-4]
-        print
-        if args.tfrecords:
-            save_tf_records(melspectrograms_ds, filename_dirpath)
-            print('\t Saved as tfrecords at {}'.format(filename_dirpath))
-        else:
-            N = save_mel_spectrograms(melspectrograms_ds, filename_dirpath)
-            print("\tSaved into {} spectrograms as npy".format(N))
+        # TensorFlow is not fork safe: the workers are spawned
+        with ProcessPoolExecutor(max_workers=args.n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(process_wav, wav_file, prefix, params): wav_file for wav_file, prefix in todo}
+            for future in as_completed(futures):
+                print("{}: {} spectrograms saved".format(futures[future], future.result()))
 
     print("-" * 40)
     deltaT = np.round(time.time() - t0, 2)
-    print("{} wav files saved as spectrograms in {} seconds.".format(
-        len(wav_files), deltaT))
-    logfile.write("{} wav files saved as spectrograms in {} seconds.".format(
-        len(wav_files), deltaT))
+    print("{} wav files saved as spectrograms in {} seconds ({} up to date).".format(
+        len(wav_files) - n_skipped, deltaT, n_skipped))
+    logfile.write("{} wav files saved as spectrograms in {} seconds ({} up to date).\n".format(
+        len(wav_files) - n_skipped, deltaT, n_skipped))
     logfile.close()
 
 
@@ -98,9 +203,20 @@ if __name__ == '__main__':
     parser.add_argument("--use_dB", action="store_true", help="Compute the dB spectrograms instead of the power spectrograms")
 
     parser.add_argument('--use_signal', action="store_true",
-                        help='Either to use tf.signal or not (otherwise use librosa)')
+                        help='Either to use tf.signal or not (otherwise use librosa). The files are processed sequentially')
 
     parser.add_argument('--tfrecords', action="store_true",
                         help="Either to save as tfrecords or not (otherwise as npy)")
+    parser.add_argument('--spec_store', action="store_true",
+                        help="Save as binary spectrogram store shards (datasets/spec_store.py) instead of tfrecords or npy")
+    parser.add_argument('--store_dtype', type=str, default=None,
+                        help="float16 or float32 data type of the spectrogram store. By default float16 with --use_dB, "
+                             "float32 otherwise (float16 flushes powers below 6e-8 to zero)")
+    parser.add_argument('--shard_size', type=float, default=100.,
+                        help="Target size in MB of the tfrecords and spectrogram store shards")
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count(),
+                        help="Number of processes computing the spectrograms")
+    parser.add_argument('--overwrite', action="store_true",
+                        help="Recompute the spectrograms of the files already up to date")
     args = parser.parse_args()
     main(args)
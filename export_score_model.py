@@ -0,0 +1,120 @@
+import tensorflow as tf
+from ncsn.utils import *
+from ncsn.export import export_model
+from flow_models import flow_builder
+import argparse
+import time
+import os
+from train_utils import get_config
+
+
+"""
+Script to export a trained NCSN or Glow model into a frozen SavedModel for inference
+
+Only the model variables are restored (the optimizer slots of the checkpoint are ignored) and folded into constants.
+The exported directory can be given instead of the checkpoint to the BASIS scripts (NCSN and Glow) and ncsn_generate_samples.py.
+An exported Glow model is frozen with the weights of one noise level: BASIS only accepts it with a single noise level.
+"""
+
+
+def main(args):
+
+    abs_restore_path = os.path.abspath(args.RESTORE)
+    export_path = os.path.abspath(args.output)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.output = args.output
+        new_args.model_type = args.model_type
+        new_args.batch_size = args.batch_size
+        args = new_args
+
+    args.data_shape = [args.height, args.width, 1]
+    sigmas = None
+
+    t0 = time.time()
+    if args.model_type == 'ncsn':
+        sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+        if args.version == 'v1':
+            model = get_uncompiled_model(args)
+        else:
+            model = get_uncompiled_model_v2(args, sigmas=tf.constant(sigmas, dtype=tf.float32))
+        checkpoint_path = abs_restore_path
+    elif args.model_type == 'glow':
+        if args.scale == 'power':
+            minval, maxval = 1e-10, 100.
+        elif args.scale == 'dB':
+            minval, maxval = -100., 20.
+        else:
+            raise ValueError("scale should be 'power' or 'dB'")
+        # build_glow runs the data dependent init of the ActNorm layers on a minibatch:
+        # a dummy one is enough since the variables are restored from the checkpoint afterwards
+        minibatch = tf.random.uniform([8] + args.data_shape, minval=minval, maxval=maxval, dtype=tf.float32)
+        model = flow_builder.build_glow(minibatch, args.data_shape, L=args.L, K=args.K, n_filters=args.n_filters,
+                                        l2_reg=args.l2_reg, mirrored_strategy=None, learntop=getattr(args, 'learntop', True),
+                                        data_type='melspec', minval=minval, maxval=maxval,
+                                        use_logit=args.use_logit, alpha=args.alpha)
+        checkpoint_path = tf.train.latest_checkpoint(abs_restore_path) if os.path.isdir(abs_restore_path) else abs_restore_path
+    else:
+        raise ValueError("model_type should be 'ncsn' or 'glow'")
+
+    # the optimizer slots of the checkpoint are not restored
+    ckpt = tf.train.Checkpoint(variables=model.variables)
+    status = ckpt.restore(checkpoint_path)
+    status.expect_partial()
+    status.assert_existing_objects_matched()
+    print("Weights loaded from {} in {} seconds".format(checkpoint_path, round(time.time() - t0, 3)))
+
+    t0 = time.time()
+    export_model(model, export_path, args.model_type, args.data_shape, sigmas=sigmas, batch_size=args.batch_size,
+                 version=getattr(args, 'version', None), scale=args.scale, use_logit=args.use_logit)
+    print("Model exported at {} in {} seconds".format(export_path, round(time.time() - t0, 3)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export a trained score model into a frozen SavedModel')
+
+    parser.add_argument('RESTORE', type=str,
+                        help='checkpoint of the trained model (NCSN) or directory of the checkpoints (Glow)')
+    parser.add_argument('--output', type=str, required=True,
+                        help='directory of the exported SavedModel')
+    parser.add_argument("--model_type", type=str, default="ncsn", help="ncsn or glow")
+    parser.add_argument('--batch_size', type=int, default=None,
+                        help="fixed batch size of the exported signatures. By default any batch size is accepted")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # NCSN hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # Glow hyperparameters
+    parser.add_argument('--L', default=3, type=int,
+                        help='Depth level')
+    parser.add_argument('--K', type=int, default=32,
+                        help="Number of Step of Flow in each Block")
+    parser.add_argument('--l2_reg', type=float, default=None,
+                        help="L2 regularization for the coupling layer")
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=1e-6,
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
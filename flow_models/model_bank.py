@@ -0,0 +1,104 @@
+import tensorflow as tf
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""
+In-memory bank of the weights of a noise conditioned model
+
+The checkpoints saved at every noise level (see train_noisy_glow.py) are read once into memory
+and swapped into the live model with assign ops instead of restoring the checkpoint at every use.
+"""
+
+
+class ModelBank(object):
+    """
+    LRU-bounded store of variable snapshots of a model, one snapshot per noise level
+
+    Parameters:
+        model: model whose variables are swapped (tf.Module or tfd.TransformedDistribution)
+        restore_dict: dict sigma -> directory of the checkpoints at this noise level
+            checkpoints are expected to be saved by train_utils.setUp_checkpoint (variables=model.variables)
+        max_size: maximum number of snapshots kept in memory. None keeps every snapshot
+        prefetch: if True, snapshots can be loaded on a background thread with prefetch()
+    """
+
+    def __init__(self, model, restore_dict, max_size=None, prefetch=False):
+        self.variables = list(model.variables)
+        self.restore_dict = restore_dict
+        self.max_size = max_size
+        self._snapshots = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+        @tf.function
+        def assign_fn(values):
+            for variable, value in zip(self.variables, values):
+                variable.assign(value)
+
+        self._assign_fn = assign_fn
+
+    def _load(self, sigma):
+        """
+        Read the variables of the latest checkpoint at noise level sigma without touching the live model
+        """
+        checkpoint_path = tf.train.latest_checkpoint(self.restore_dict[sigma])
+        assert checkpoint_path is not None, self.restore_dict[sigma]
+        reader = tf.train.load_checkpoint(checkpoint_path)
+        snapshot = []
+        for i, variable in enumerate(self.variables):
+            value = reader.get_tensor('variables/{}/.ATTRIBUTES/VARIABLE_VALUE'.format(i))
+            assert tuple(value.shape) == tuple(variable.shape), (variable.name, value.shape, variable.shape)
+            snapshot.append(tf.constant(value, dtype=variable.dtype))
+        return snapshot
+
+    def _insert(self, sigma, snapshot):
+        with self._lock:
+            self._snapshots[sigma] = snapshot
+            self._snapshots.move_to_end(sigma)
+            while self.max_size is not None and len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+    def get(self, sigma):
+        """
+        Return the snapshot at noise level sigma, loading it if needed
+        """
+        with self._lock:
+            if sigma in self._snapshots:
+                self._snapshots.move_to_end(sigma)
+                return self._snapshots[sigma]
+            future = self._pending.pop(sigma, None)
+
+        snapshot = future.result() if future is not None else self._load(sigma)
+        self._insert(sigma, snapshot)
+        return snapshot
+
+    def prefetch(self, sigma):
+        """
+        Start loading the snapshot at noise level sigma on the background thread
+        """
+        if self._executor is None:
+            return
+        with self._lock:
+            if sigma in self._snapshots or sigma in self._pending:
+                return
+            self._pending[sigma] = self._executor.submit(self._load, sigma)
+
+    def preload(self, sigmas):
+        """
+        Load the snapshots of every noise level in sigmas (at most max_size are kept)
+        """
+        for sigma in sigmas:
+            self.get(sigma)
+
+    def assign(self, sigma):
+        """
+        Swap the weights at noise level sigma into the live model
+        """
+        self._assign_fn(self.get(sigma))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,147 @@
+import numpy as np
+from datasets.spectral import get_spectral_transform
+
+
+"""
+Batched Griffin-Lim phase reconstruction
+
+The magnitude spectrograms are stacked in one array [B, 1 + n_fft // 2, frames] and every iteration
+runs one vectorized STFT and ISTFT for the whole batch, with the shared window and window sum-square envelopes
+of datasets/spectral.py. With momentum > 0, the iterations are those of the fast Griffin-Lim algorithm
+(Perraudin et al., 2013). The phase can be initialized from the STFT of the mixture instead of random phases.
+Long spectrograms are cut into overlapping chunks inverted in the same batch and stitched by overlap-add.
+"""
+
+
+class GriffinLim(object):
+    """
+    Parameters:
+        n_fft: window size of the STFT
+        hop_length: jump between each window of the STFT
+        n_iter: maximum number of iterations
+        momentum: 0 for the Griffin-Lim algorithm, the fast Griffin-Lim algorithm otherwise (0.99 as librosa)
+        tol: an element of the batch has converged once its spectral convergence
+            || |STFT(x)| - S || / || S || improves by less than tol (relative) between two iterations
+        chunk_frames: spectrograms longer than chunk_frames frames are inverted by chunks (None: no chunks)
+        overlap_frames: number of frames shared by consecutive chunks
+        transform: SpectralTransform of the STFT (get_spectral_transform(n_fft=n_fft, hop_length=hop_length) if None)
+    """
+
+    def __init__(self, n_fft=2048, hop_length=512, n_iter=32, momentum=0.99, tol=1e-4,
+                 chunk_frames=None, overlap_frames=16, transform=None):
+        if chunk_frames is not None and chunk_frames <= overlap_frames:
+            raise ValueError("chunk_frames should be larger than overlap_frames")
+        self.transform = get_spectral_transform(n_fft=n_fft, hop_length=hop_length) if transform is None else transform
+        self.n_fft = self.transform.n_fft
+        self.hop_length = self.transform.hop_length
+        self.n_iter = n_iter
+        self.momentum = momentum
+        self.tol = tol
+        self.chunk_frames = chunk_frames
+        self.overlap_frames = overlap_frames
+
+    def invert(self, magnitudes, init_phase=None, seed=None):
+        """
+        Griffin-Lim iterations on a batch of magnitude spectrograms
+
+        Parameters:
+            magnitudes: ndarray [B, 1 + n_fft // 2, frames]
+            init_phase: ndarray [B, 1 + n_fft // 2, frames] (or broadcastable) of initial phases, for instance
+                np.angle of the STFT of the mixture. If None, the phases are drawn at random
+
+        Returns:
+            audio: ndarray [B, hop_length * (frames - 1)]
+            n_iter: ndarray [B] of the number of iterations before convergence of each spectrogram
+        """
+        magnitudes = np.asarray(magnitudes, dtype=np.float32)
+        if init_phase is None:
+            init_phase = np.random.RandomState(seed).uniform(-np.pi, np.pi, size=magnitudes.shape)
+        angles = np.exp(1j * np.broadcast_to(init_phase, magnitudes.shape)).astype(np.complex64)
+
+        norms = np.maximum(np.sqrt(np.sum(magnitudes ** 2, axis=(1, 2))), 1e-10)
+        n_iter = np.full(len(magnitudes), self.n_iter)
+        active = np.ones(len(magnitudes), dtype=bool)
+        previous_error = np.full(len(magnitudes), np.inf)
+        rebuilt = np.zeros_like(angles)
+        for i in range(self.n_iter):
+            previous = rebuilt
+            rebuilt = self.transform.stft(self.transform.istft(magnitudes * angles))
+            angles = rebuilt - (self.momentum / (1. + self.momentum)) * previous
+            angles /= np.abs(angles) + 1e-16
+
+            error = np.sqrt(np.sum((np.abs(rebuilt) - magnitudes) ** 2, axis=(1, 2))) / norms
+            converged = active & (i > 0) & (np.abs(previous_error - error) <= self.tol * previous_error)
+            n_iter[converged] = i + 1
+            active &= ~converged
+            previous_error = error
+            if not np.any(active):
+                break
+        return self.transform.istft(magnitudes * angles), n_iter
+
+    def chunk_starts(self, n_frames):
+        """
+        First frame of each chunk of chunk_frames frames (the last chunk ends at the last frame)
+        """
+        if self.chunk_frames is None or n_frames <= self.chunk_frames:
+            return [0]
+        starts = list(range(0, n_frames - self.chunk_frames, self.chunk_frames - self.overlap_frames))
+        return starts + [n_frames - self.chunk_frames]
+
+    def __call__(self, magnitudes, init_phase=None, length=None, seed=None):
+        """
+        Invert a batch of magnitude spectrograms, by overlapping chunks for the long ones
+
+        The chunks of every spectrogram are inverted in one batch. The audio of the chunks is stitched
+        by overlap-add with linear cross-fades over the overlapping frames.
+
+        Parameters:
+            magnitudes: ndarray [B, 1 + n_fft // 2, frames]
+            init_phase: initial phases [B, 1 + n_fft // 2, frames] or [1 + n_fft // 2, frames]
+                (warm start from the STFT of the mixture). If None, random phases
+            length: length of the audio (hop_length * (frames - 1) if None)
+
+        Returns:
+            audio: ndarray [B, length]
+            n_iter: ndarray [B] of the largest number of iterations of the chunks of each spectrogram
+        """
+        magnitudes = np.asarray(magnitudes, dtype=np.float32)
+        n_batch, _, n_frames = magnitudes.shape
+        if init_phase is not None:
+            init_phase = np.broadcast_to(init_phase, magnitudes.shape)
+        if length is None:
+            length = self.hop_length * (n_frames - 1)
+
+        starts = self.chunk_starts(n_frames)
+        chunk_frames = n_frames if len(starts) == 1 else self.chunk_frames
+        chunks = np.concatenate([magnitudes[:, :, start:start + chunk_frames] for start in starts])
+        if init_phase is not None:
+            init_phase = np.concatenate([init_phase[:, :, start:start + chunk_frames] for start in starts])
+        chunk_audio, chunk_iter = self.invert(chunks, init_phase=init_phase, seed=seed)
+        chunk_audio = np.reshape(chunk_audio, (len(starts), n_batch, -1))
+        chunk_iter = np.max(np.reshape(chunk_iter, (len(starts), n_batch)), axis=0)
+        if len(starts) == 1:
+            audio = chunk_audio[0]
+        else:
+            audio = self.overlap_add(chunk_audio, starts, n_frames)
+        if audio.shape[1] < length:
+            audio = np.pad(audio, [(0, 0), (0, length - audio.shape[1])])
+        return audio[:, :length], chunk_iter
+
+    def overlap_add(self, chunk_audio, starts, n_frames):
+        """
+        Stitch the audio of the chunks [n_chunks, B, chunk_length] with linear cross-fades over the overlaps
+        """
+        chunk_length = chunk_audio.shape[-1]
+        fade = np.linspace(0., 1., self.overlap_frames * self.hop_length + 2, dtype=np.float32)[1:-1]
+        audio = np.zeros((chunk_audio.shape[1], self.hop_length * (n_frames - 1)), dtype=np.float32)
+        weights = np.zeros(audio.shape[1], dtype=np.float32)
+        for c, start in enumerate(starts):
+            weight = np.ones(chunk_length, dtype=np.float32)
+            if c > 0:
+                weight[:len(fade)] = fade
+            if c < len(starts) - 1:
+                weight[-len(fade):] = np.minimum(weight[-len(fade):], fade[::-1])
+            offset = start * self.hop_length
+            audio[:, offset:offset + chunk_length] += weight * chunk_audio[c]
+            weights[offset:offset + chunk_length] += weight
+        return audio / np.maximum(weights, 1e-10)
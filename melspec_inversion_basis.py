@@ -4,8 +4,12 @@ import soundfile as sf
 import argparse
 import time
 import os
-import datetime
 import sys
+import re
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from griffin_lim import GriffinLim
+from datasets.spectral import get_spectral_transform
 
 
 """
@@ -18,105 +22,262 @@ def complex_array(amplitudes, angles):
     return amplitudes * np.exp(1j * angles)
 
 
-def griffin_inversion_fn(sr=16000, fmin=125, fmax=7600, n_fft=2048, hop_length=512, scale="dB"):
-    def griffin_inversion(melspecs):
-        """
-        Inverse melspectrograms with griffin algorithm
+_transform = None
 
-        Parameters:
-            melspecs: list of ndarray
 
-        Returns:
-            i_melspecs: list of ndarray
-        """
+def _init_worker(spectral_params):
+    """
+    Build the spectral transform (mel basis, pseudo-inverse) once in each worker process,
+    instead of sending it with every task
+    """
+    global _transform
+    _transform = get_spectral_transform(**spectral_params)
 
-        i_melspecs = []
-        for melspec in melspecs:
-            if args.scale == "dB":
-                melspec = librosa.db_to_power(melspec)
-            i_melspecs.append(librosa.feature.inverse.mel_to_audio(melspec, sr=sr, fmin=fmin, fmax=fmax, n_fft=n_fft, hop_length=hop_length))
-        return i_melspecs
-    return griffin_inversion
 
+def _nnls_block(power_block):
+    return _transform.nnls(power_block)
 
-def stft_inversion_fn(sr=16000, fmin=125, fmax=7600, n_fft=2048, hop_length=512, scale="dB", wiener_filter=False):
-    def stft_inversion(inputs):
-        """
-        Inverse melspectrograms by reusing the phase
 
-        Parameters:
-            inputs: tuple
-                (melspecs, stft_mixture)
-                melspecs: list of ndarray
-                    MelSpectrograms to invert
-                stft_mixture: ndarray
-                    STFT of the mixture to separate
+def _griffinlim(magnitudes, init_phase, griffin_lim=None):
+    return griffin_lim(magnitudes, init_phase=init_phase)
 
-        Returns:
-            i_melspecs: list of ndarray
-        """
-        melspecs, stft_mixture = inputs
-        n_src = len(melspecs)
-        use_wiener_filter = wiener_filter and (n_src > 1)
-        melspecs, stft_mixture = np.array(melspecs), np.array(stft_mixture)
-
-        mel_stfts = []
-        i_melspecs = []
-        if args.scale == "dB":
-            melspecs = librosa.db_to_power(melspecs)
 
-        for i in range(len(melspecs)):
-            mel_stft = librosa.feature.inverse.mel_to_stft(melspecs[i],
-                                                           sr=sr, fmin=fmin, fmax=fmax, n_fft=n_fft)
-            if use_wiener_filter:
-                mel_stft = mel_stft ** 2
-
-            mel_stfts.append(mel_stft)
+def mel_to_stft_batch(melspecs, transform, executor=None, n_blocks=1, min_columns=256):
+    """
+    Magnitude STFT of power melspectrograms, same as librosa.feature.inverse.mel_to_stft on each melspectrogram
 
-        mel_stfts = np.array(mel_stfts)
+    The frames of all the melspectrograms are concatenated into one NNLS problem against the shared mel basis.
+    The columns are split into n_blocks blocks solved in parallel by executor,
+    with at least min_columns columns per block so that the solves outweigh the transfers to the workers.
 
-        if use_wiener_filter:
-            stft_complexs = single_channel_wiener_filter(mel_stfts, stft_mixture)
+    Parameters:
+        melspecs: ndarray [S, n_mels, frames] of power melspectrograms
+        transform: SpectralTransform (see datasets/spectral.py)
+        executor: ProcessPoolExecutor initialized with _init_worker of the parameters of transform.
+            If None, the blocks are solved here
 
-        for i in range(len(melspecs)):
+    Returns:
+        ndarray [S, 1 + n_fft // 2, frames]
+    """
+    n_spec, n_mels, n_frames = melspecs.shape
+    columns = np.reshape(np.transpose(melspecs, (1, 0, 2)), (n_mels, n_spec * n_frames))
+    blocks = np.array_split(columns, max(1, min(n_blocks, columns.shape[1] // min_columns)), axis=1)
+    if executor is None:
+        solved = [transform.nnls(block) for block in blocks]
+    else:
+        solved = list(executor.map(_nnls_block, blocks))
+    magnitudes = np.sqrt(np.concatenate(solved, axis=1))
+    return np.transpose(np.reshape(magnitudes, (-1, n_spec, n_frames)), (1, 0, 2))
 
-            if use_wiener_filter:
-                stft_complex = stft_complexs[i]
-            else:
-                stft_complex = complex_array(mel_stfts[i], np.angle(stft_mixture))
 
-            istft = librosa.istft(stft_complex, hop_length=hop_length)
-            i_melspecs.append(istft)
+def invert_melspecs(melspecs, stft_mixture, n_sources, transform, algorithm='reuse_phase', scale='dB',
+                    wiener_filter=False, executor=None, n_blocks=1, griffin_lim=None, warm_start=False,
+                    wiener_iter=0, block_frames=256, block_columns=16384):
+    """
+    Inverse the melspectrograms of the K sources, of their ground truth and of the mixture in one batch
 
-        return i_melspecs
+    Parameters:
+        melspecs: ndarray [2 * K + 1, n_extract, n_mels, frames]: the K sources, the K ground truth then the mixture
+        stft_mixture: ndarray complex [n_extract, 1 + n_fft // 2, frames], STFT of the mixture (used by reuse_phase)
+        n_sources: number of sources K
+        transform: SpectralTransform of the melspectrograms (see datasets/spectral.py)
+        algorithm: griffin or reuse_phase
+        wiener_filter: with reuse_phase, filter the sources and the ground truth with a single channel Wiener filter
+            (StreamingWienerFilter with wiener_iter EM iterations)
+        block_frames, block_columns: with reuse_phase, the extracts are inverted by blocks of block_frames frames
+            of as many extracts as fit in block_columns NNLS columns (one column per frame of each signal).
+            Only the STFT of a block is in memory: the NNLS of a block is solved across its extracts,
+            then the Wiener filter and the overlap-add of the inverse STFT are streamed block after block
+        executor: process pool running the NNLS blocks and Griffin-Lim. If None, everything runs here
+        griffin_lim: GriffinLim (see griffin_lim.py) of the griffin algorithm, run on n_blocks batches
+        warm_start: with griffin, start from the phase of the mixture STFT instead of random phases
+
+    Returns:
+        ndarray [2 * K + 1, n_extract * extract_length]: the extracts inverted and concatenated for each signal
+    """
+    n_signals, n_extract = melspecs.shape[:2]
 
-    return stft_inversion
+    if algorithm == 'griffin':
+        if scale == 'dB':
+            melspecs = librosa.db_to_power(melspecs)
+        magnitudes = mel_to_stft_batch(np.reshape(melspecs, (-1,) + melspecs.shape[2:]), transform,
+                                       executor=executor, n_blocks=n_blocks)
+        if griffin_lim is None:
+            griffin_lim = GriffinLim(transform=transform)
+        n_batches = max(1, min(n_blocks, n_signals * n_extract))
+        batches = np.array_split(magnitudes, n_batches)
+        if warm_start:
+            # the extracts are flattened signal by signal: extract i starts from the phase of the mixture extract i % n_extract
+            mixture_phase = np.angle(stft_mixture)
+            phase_batches = [mixture_phase[indices % n_extract]
+                             for indices in np.array_split(np.arange(n_signals * n_extract), n_batches)]
+        else:
+            phase_batches = [None] * len(batches)
+        fn = functools.partial(_griffinlim, griffin_lim=griffin_lim)
+        if executor is None:
+            results = [fn(batch, phase) for batch, phase in zip(batches, phase_batches)]
+        else:
+            results = list(executor.map(fn, batches, phase_batches))
+        audio = np.concatenate([result[0] for result in results])
+        n_iter = np.concatenate([result[1] for result in results])
+        print("Griffin-Lim iterations to convergence: mean {}, max {}".format(np.mean(n_iter), np.max(n_iter)))
+        return np.reshape(audio, (n_signals, -1))
+    elif algorithm == 'reuse_phase':
+        # the sources and the ground truth are filtered as two groups of K sources, the mixture is not filtered
+        groups = [slice(0, n_sources), slice(n_sources, 2 * n_sources)] if wiener_filter and n_sources > 1 else []
+        wieners = [StreamingWienerFilter(n_sources, n_iter=wiener_iter, transform=transform) for _ in groups]
+        n_frames = melspecs.shape[-1]
+        block_frames = min(block_frames, n_frames)
+        extracts_per_block = max(1, block_columns // (n_signals * block_frames))
+        audio = []
+        for e_start in range(0, n_extract, extracts_per_block):
+            extracts = slice(e_start, e_start + extracts_per_block)
+            n_block_extracts = len(range(n_extract)[extracts])
+            # every signal of every extract is one row of the overlap-add: the STFT of each extract is inverted on its own
+            stream = StreamingWienerFilter(n_signals * n_block_extracts, transform=transform)
+            extracts_audio = []
+            for start in range(0, n_frames, block_frames):
+                block = slice(start, start + block_frames)
+                power = melspecs[:, extracts, :, block]
+                if scale == 'dB':
+                    power = librosa.db_to_power(power)
+                magnitudes = mel_to_stft_batch(np.reshape(power, (-1,) + power.shape[2:]), transform,
+                                               executor=executor, n_blocks=n_blocks)
+                magnitudes = np.reshape(magnitudes, power.shape[:2] + magnitudes.shape[1:])
+                stft_block = stft_mixture[extracts, :, block]
+                stfts = complex_array(magnitudes, np.angle(stft_block))
+                for group, wiener in zip(groups, wieners):
+                    stfts[group] = wiener.filter(magnitudes[group] ** 2, stft_block)
+                extracts_audio.append(stream.push(np.reshape(stfts, (-1,) + stfts.shape[2:])))
+            extracts_audio.append(stream.flush())
+            audio.append(np.reshape(np.concatenate(extracts_audio, axis=-1), (n_signals, n_block_extracts, -1)))
+        # the extracts of each signal are concatenated
+        return np.reshape(np.concatenate(audio, axis=1), (n_signals, -1))
+    else:
+        raise ValueError('algorithm should be griffin or reuse_phase')
 
 
-def single_channel_wiener_filter(psd_sources, stft_mixture):
+def single_channel_wiener_filter(psd_sources, stft_mixture, n_iter=0, out=None):
     """
     Perform Single Channel Wiener Filtering
 
     Parameters:
-        psd_sources: list of ndarray
+        psd_sources: ndarray [K, ..., 1 + n_fft // 2, frames]
             power spectrograms of the estimated sources
         stft_mixture: nd.array, complex
-            stft of the mixture
+            stft of the mixture, broadcastable to the shape of one source
+        n_iter: int
+            number of EM iterations refining the power spectrograms of the sources
+            from the posterior of the filtered sources
+        out: nd.array, complex
+            receives the stft of the estimated sources (allocated if None)
 
     Return:
         ndarray
             stft of the estimated sources
     """
-    psd_sources = np.array(psd_sources)
-    assert len(psd_sources.shape) == 3, psd_sources.shape
-    assert psd_sources.shape[0] > 1, psd_sources.shape[0]
+    psd_sources = np.asarray(psd_sources)
+    if psd_sources.ndim < 3 or psd_sources.shape[0] < 2:
+        raise ValueError("psd_sources should be [K, ..., frequencies, frames] with K > 1, got {}".format(psd_sources.shape))
     try:
-        stft_complexs = (psd_sources / (np.sum(psd_sources, axis=0) + 1e-10)) * stft_mixture
-        return stft_complexs
+        shape = np.broadcast(psd_sources[0], stft_mixture).shape
     except ValueError:
-        print(psd_sources.shape)
-        print(np.sum(psd_sources, axis=0).shape)
-        print(stft_mixture.shape)
+        shape = None
+    if shape != psd_sources.shape[1:]:
+        raise ValueError("stft_mixture of shape {} does not match the power spectrograms of shape {}".format(
+            np.shape(stft_mixture), psd_sources.shape))
+
+    if out is None:
+        out = np.empty(psd_sources.shape, dtype=np.complex64)
+    masks = np.empty(psd_sources.shape, dtype=np.float32)
+    for i in range(n_iter + 1):
+        np.divide(psd_sources, np.sum(psd_sources, axis=0) + 1e-10, out=masks)
+        np.multiply(masks, stft_mixture, out=out)
+        if i < n_iter:
+            # E-step: posterior power of each source, |E[s_k]|^2 + Var[s_k]
+            psd_sources = np.abs(out) ** 2 + psd_sources * (1. - masks)
+    return out
+
+
+class StreamingWienerFilter(object):
+    """
+    Streaming single channel Wiener filter and inverse STFT of K sources
+
+    The power spectrograms of the sources and the STFT of the mixture are given by blocks of frames.
+    The soft masks are only computed for the block and written in a buffer reused by the next blocks.
+    Each push returns the audio samples that no later frame overlaps: only the block and the last
+    n_fft - hop_length samples of the overlap-add are kept in memory. flush returns the end of the signal
+    and starts a new one. The audio of the concatenated pushes and flush is librosa.istft of the whole STFT.
+
+    Parameters:
+        n_sources: number of sources K
+        n_iter: number of EM iterations of the filter (see single_channel_wiener_filter)
+        transform: SpectralTransform of the STFT (get_spectral_transform(n_fft=n_fft, hop_length=hop_length) if None)
+    """
+
+    def __init__(self, n_sources, n_fft=2048, hop_length=512, n_iter=0, transform=None):
+        if transform is None:
+            transform = get_spectral_transform(n_fft=n_fft, hop_length=hop_length)
+        self.n_sources = n_sources
+        self.n_fft = transform.n_fft
+        self.hop_length = transform.hop_length
+        self.n_iter = n_iter
+        self.window = transform.window
+        self._buffer = None
+        self.reset()
+
+    def reset(self):
+        self._audio = np.zeros((self.n_sources, self.n_fft - self.hop_length), dtype=np.float32)
+        self._envelope = np.zeros(self.n_fft - self.hop_length, dtype=np.float32)
+        self._n_frames = 0
+        self._n_emitted = 0
+
+    def filter(self, psd_sources, stft_mixture):
+        """
+        Filtered STFT [K, 1 + n_fft // 2, frames] of a block. The output buffer is reused by the next calls
+        """
+        if self._buffer is None or self._buffer.shape != np.shape(psd_sources):
+            self._buffer = np.empty(np.shape(psd_sources), dtype=np.complex64)
+        return single_channel_wiener_filter(psd_sources, stft_mixture, n_iter=self.n_iter, out=self._buffer)
+
+    def push(self, stfts):
+        """
+        Overlap-add the inverse STFT of a block of frames [K, 1 + n_fft // 2, frames]
+
+        Returns:
+            ndarray [K, samples] of the samples completed by the block
+        """
+        n_frames = stfts.shape[-1]
+        frames = (np.fft.irfft(stfts, n=self.n_fft, axis=1) * self.window[:, None]).astype(np.float32)
+        audio = np.zeros((self.n_sources, n_frames * self.hop_length + self.n_fft - self.hop_length), dtype=np.float32)
+        envelope = np.zeros(audio.shape[1], dtype=np.float32)
+        audio[:, :self._audio.shape[1]] = self._audio
+        envelope[:len(self._envelope)] = self._envelope
+        for t in range(n_frames):
+            audio[:, t * self.hop_length: t * self.hop_length + self.n_fft] += frames[:, :, t]
+            envelope[t * self.hop_length: t * self.hop_length + self.n_fft] += self.window ** 2
+
+        completed = n_frames * self.hop_length
+        self._audio, self._envelope = audio[:, completed:], envelope[completed:]
+        self._n_frames += n_frames
+        return self._emit(audio[:, :completed], envelope[:completed])
+
+    def _emit(self, audio, envelope):
+        audio = audio / np.maximum(envelope, np.finfo(np.float32).tiny)
+        # the first n_fft // 2 samples are the padding of the centered STFT
+        trim = min(max(self.n_fft // 2 - self._n_emitted, 0), audio.shape[1])
+        self._n_emitted += audio.shape[1]
+        return audio[:, trim:]
+
+    def flush(self):
+        """
+        Returns:
+            ndarray [K, samples] of the last samples of the signal (hop_length * (frames - 1) samples in total)
+        """
+        remaining = self.n_fft // 2 + self.hop_length * (self._n_frames - 1) - self._n_emitted
+        audio = self._emit(self._audio[:, :max(remaining, 0)], self._envelope[:max(remaining, 0)])
+        self.reset()
+        return audio
 
 
 def main(args):
@@ -143,92 +304,57 @@ def main(args):
     if args.debug is False:
         sys.stdout = log_file
 
-    x1 = basis_results['x1']
-    x2 = basis_results['x2']
-    gt1 = basis_results['gt1']
-    gt2 = basis_results['gt2']
+    n_sources = len([key for key in basis_results.files if re.match(r"^x\d+$", key)])
+    x = [basis_results['x{}'.format(k + 1)] for k in range(n_sources)]
+    gt = [basis_results['gt{}'.format(k + 1)] for k in range(n_sources)]
     mix = basis_results['mixed']
     stft_mixture = basis_results['stft_mixture']
 
-    assert len(x1.shape) == len(x2.shape) == len(stft_mixture.shape) == 3, (x1.shape, x2.shape, stft_mixture.shape)
+    assert all(len(x_k.shape) == 3 for x_k in x) and len(stft_mixture.shape) == 3, (x[0].shape, stft_mixture.shape)
     if (args.scale != 'dB') and (args.scale != 'power'):
         raise ValueError('scale should be dB or power')
+    if args.algorithm not in ['griffin', 'reuse_phase']:
+        raise ValueError('algorithm should be griffin or reuse_phase')
 
-    args.shape = x1.shape
+    args.shape = x[0].shape
     params_dict = vars(args)
     template = 'Spectrograms \n\t '
     for k, v in params_dict.items():
         template += '{} = {} \n\t '.format(k, v)
     print(template)
 
+    # [2 * K + 1, n_extract, n_mels, frames]: the sources, the ground truth then the mixture
+    melspecs = np.array(x + gt + [mix])
     if args.method == 'whole':
-        x1 = np.concatenate(list(x1), axis=-1)
-        x2 = np.concatenate(list(x2), axis=-1)
-        mix = np.concatenate(list(mix), axis=-1)
-        gt1 = np.concatenate(list(gt1), axis=-1)
-        gt2 = np.concatenate(list(gt2), axis=-1)
-        stft_mixture = np.concatenate(list(stft_mixture), axis=-1)
-
-    if args.algorithm == 'griffin':
-        inversion_fn = griffin_inversion_fn(sr=sr, fmin=fmin, fmax=fmax, n_fft=n_fft, hop_length=hop_length, scale=args.scale)
-
-        if args.method == 'whole':
-            sources = [x1, x2]
-            ground_truth = [gt1, gt2]
-            mix = [mix]
-        else:
-            sources = [[x1[i], x2[i]] for i in range(len(x1))]
-            ground_truth = [[gt1[i], gt2[i]] for i in range(len(gt1))]
-            mix = [[mix[i]] for i in range(len(mix))]
-
-    elif args.algorithm == 'reuse_phase':
-        inversion_fn = stft_inversion_fn(sr=sr, fmin=fmin, fmax=fmax, n_fft=n_fft, hop_length=hop_length, scale=args.scale,
-                                         wiener_filter=args.wiener_filter)
-        if args.method == 'whole':
-            sources = [[x1, x2], stft_mixture]
-            ground_truth = [[x1, x2], stft_mixture]
-            mix = [[mix], stft_mixture]
-        else:
-            sources = [[[x1[i], x2[i]], stft_mixture[i]] for i in range(len(x1))]
-            ground_truth = [[[gt1[i], gt2[i]], stft_mixture[i]] for i in range(len(gt1))]
-            mix = [[[mix[i]], stft_mixture[i]] for i in range(len(mix))]
-    else:
-        raise ValueError('method should be griffin or reuse_phase')
+        melspecs = np.concatenate(list(np.moveaxis(melspecs, 1, 0)), axis=-1)[:, None]
+        stft_mixture = np.concatenate(list(stft_mixture), axis=-1)[None]
+
+    spectral_params = {'sr': sr, 'n_fft': n_fft, 'hop_length': hop_length, 'n_mels': melspecs.shape[-2],
+                       'fmin': fmin, 'fmax': fmax}
+    transform = get_spectral_transform(**spectral_params)
+    griffin_lim = GriffinLim(n_iter=args.n_iter, momentum=args.momentum, chunk_frames=args.chunk_frames,
+                             transform=transform)
 
     t_init = time.time()
-    if args.method == 'whole':
-        x1_inv, x2_inv = inversion_fn(sources)
-        gt1_inv, gt2_inv = inversion_fn(ground_truth)
-        mix_inv = inversion_fn(mix)[0]
-    else:
-        inv_spec = {'sources': [], 'ground_truth': [], 'mix': []}
-        for i in range(len(x1)):
-            spec_to_invert = {'sources': sources[i], 'ground_truth': ground_truth[i], 'mix': mix[i]}
-            print("Start inversing Spectrograms {} / {} at {}".format(i + 1, len(x1), datetime.datetime.now().strftime("%Y/%m/%d-%H:%M:%S")))
-            for n, spec in spec_to_invert.items():
-                t0 = time.time()
-                spec_inv_i = inversion_fn(spec)
-                inv_spec[n].append(spec_inv_i)
-                print("Done melspec {} in {} seconds".format(n, round(time.time() - t0, 3)))
-
-        x1_inv = np.concatenate(np.array(inv_spec['sources'])[:, 0], axis=-1)
-        x2_inv = np.concatenate(np.array(inv_spec['sources'])[:, 1], axis=-1)
-        gt1_inv = np.concatenate(np.array(inv_spec['ground_truth'])[:, 0], axis=-1)
-        gt2_inv = np.concatenate(np.array(inv_spec['ground_truth'])[:, 1], axis=-1)
-        mix_inv = np.concatenate(np.array(inv_spec['mix'])[:, 0], axis=-1)
-
-    t1 = time.time()
-    duration = round(t1 - t_init, 4)
+    with ProcessPoolExecutor(max_workers=args.n_workers, initializer=_init_worker,
+                             initargs=(spectral_params,)) as executor:
+        audio = invert_melspecs(melspecs, stft_mixture, n_sources, transform, algorithm=args.algorithm,
+                                scale=args.scale, wiener_filter=args.wiener_filter,
+                                executor=executor, n_blocks=4 * args.n_workers, griffin_lim=griffin_lim,
+                                warm_start=args.warm_start, wiener_iter=args.wiener_iter)
+    duration = round(time.time() - t_init, 4)
 
     print("Inversion duration: {} seconds".format(duration))
 
-    sf.write("sep1.wav", data=x1_inv, samplerate=sr)
-    sf.write("sep2.wav", data=x2_inv, samplerate=sr)
-    sf.write("gt1.wav", data=gt1_inv, samplerate=sr)
-    sf.write("gt2.wav", data=gt2_inv, samplerate=sr)
+    x_inv, gt_inv, mix_inv = audio[:n_sources], audio[n_sources:2 * n_sources], audio[-1]
+    for k in range(n_sources):
+        sf.write("sep{}.wav".format(k + 1), data=x_inv[k], samplerate=sr)
+        sf.write("gt{}.wav".format(k + 1), data=gt_inv[k], samplerate=sr)
     sf.write("mix.wav", data=mix_inv, samplerate=sr)
 
-    np.savez("inverse_spectrograms", x1_audio=x1_inv, x2_audio=x2_inv, gt1_audio=gt1_inv, gt2_audio=gt2_inv, mix_audio=mix_inv)
+    results = {'x{}_audio'.format(k + 1): x_inv[k] for k in range(n_sources)}
+    results.update({'gt{}_audio'.format(k + 1): gt_inv[k] for k in range(n_sources)})
+    np.savez("inverse_spectrograms", mix_audio=mix_inv, **results)
 
     log_file.close()
 
@@ -247,6 +373,18 @@ if __name__ == "__main__":
     parser.add_argument("--scale", type=str, default="dB")
     parser.add_argument('--wiener_filter', action="store_true", help="Use Single Channel Wiener Filter as post-processing")
 
+    parser.add_argument('--wiener_iter', type=int, default=0,
+                        help="Number of EM iterations of the Wiener filter (0: Wiener filter of the estimated spectrograms)")
+    parser.add_argument('--n_iter', type=int, default=32, help="Maximum number of Griffin-Lim iterations")
+    parser.add_argument('--momentum', type=float, default=0.99,
+                        help="Momentum of the fast Griffin-Lim algorithm (0: Griffin-Lim algorithm)")
+    parser.add_argument('--warm_start', action="store_true",
+                        help="Start Griffin-Lim from the phase of the mixture STFT instead of random phases")
+    parser.add_argument('--chunk_frames', type=int, default=512,
+                        help="Griffin-Lim inverts the spectrograms longer than chunk_frames frames by overlapping chunks")
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count(),
+                        help="Number of processes solving the NNLS blocks and inverting the STFT")
+
     parser.add_argument("--debug", action="store_true")
 
     args = parser.parse_args()
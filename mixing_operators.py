@@ -0,0 +1,195 @@
+import tensorflow as tf
+import numpy as np
+tfk = tf.keras
+
+
+"""
+Mixing operators of the BASIS algorithm
+
+A mixing operator maps the K sources stacked in one [K, N, H, W, C] tensor to their mixture [N, H, W, C].
+One call returns the mixture, the residual mixed - g(sources) and the gradient of the mixture with respect to
+each source [K, N, H, W, C]: the intermediates shared by the mixture and its gradient are computed once.
+The mixture of each time-frequency bin only depends on the sources at that bin, so the gradient is elementwise.
+
+- LinearMixing: average of the sources (images, or power spectrograms mixed in power)
+- AmplitudeMixing: power spectrograms mixed in amplitude, g = mean(sqrt(sources)) ** 2
+- DecibelMixing: dB spectrograms mixed in power or in amplitude (logsumexp)
+- LearnedGainMixing: weighted mixture with trainable gains, in the linear or the dB domain
+"""
+
+
+class MixingOperator(object):
+    """
+    Base class: subclasses implement __call__
+    """
+
+    def __call__(self, sources, mixed=None):
+        """
+        Parameters:
+            sources: [K, N, H, W, C] tensor
+            mixed: [N, H, W, C] tensor of mixtures (the residual is None if not given)
+
+        Returns:
+            mixture: g(sources) [N, H, W, C]
+            residual: mixed - mixture [N, H, W, C]
+            grad: d mixture / d sources [K, N, H, W, C]
+        """
+        raise NotImplementedError
+
+    def mix(self, sources):
+        return self(sources)[0]
+
+    def grad(self, sources):
+        return self(sources)[2]
+
+
+def _residual(mixed, mixture):
+    if mixed is None:
+        return None
+    return mixed - mixture
+
+
+class LinearMixing(MixingOperator):
+    """
+    g = mean(sources)
+    """
+
+    def __call__(self, sources, mixed=None):
+        K = tf.cast(tf.shape(sources)[0], sources.dtype)
+        mixture = tf.reduce_mean(sources, axis=0)
+        grad = tf.fill(tf.shape(sources), 1. / K)
+        return mixture, _residual(mixed, mixture), grad
+
+
+class AmplitudeMixing(MixingOperator):
+    """
+    Power spectrograms mixed in amplitude: g = mean(sqrt(sources)) ** 2
+
+    d g / d source_k = mean(sqrt(sources)) / (K * sqrt(source_k))
+    """
+
+    def __init__(self, epsilon=1e-8):
+        self.epsilon = epsilon
+
+    def __call__(self, sources, mixed=None):
+        K = tf.cast(tf.shape(sources)[0], sources.dtype)
+        amplitudes = tf.math.sqrt(sources)
+        mean_amplitude = tf.reduce_mean(amplitudes, axis=0, keepdims=True)
+        mixture = tf.squeeze(mean_amplitude, axis=0) ** 2
+        grad = mean_amplitude / (K * (amplitudes + self.epsilon))
+        return mixture, _residual(mixed, mixture), grad
+
+
+class DecibelMixing(MixingOperator):
+    """
+    dB spectrograms mixed in power (domain='power', 10 dB per decade) or in amplitude (domain='amplitude', 20 dB)
+
+    g = c * (logsumexp(sources / c) - log(K)), c = 10 / log(10) or 20 / log(10)
+    d g / d source_k = softmax(sources / c)_k
+    """
+
+    def __init__(self, domain='power'):
+        if domain == 'power':
+            self.db_factor = 10.
+        elif domain == 'amplitude':
+            self.db_factor = 20.
+        else:
+            raise ValueError("domain should be 'power' or 'amplitude'")
+        self.c = self.db_factor / np.log(10.)
+
+    def __call__(self, sources, mixed=None):
+        K = tf.cast(tf.shape(sources)[0], sources.dtype)
+        logits = sources / self.c
+        log_norm = tf.math.reduce_logsumexp(logits, axis=0, keepdims=True)
+        mixture = self.c * (tf.squeeze(log_norm, axis=0) - tf.math.log(K))
+        grad = tf.math.exp(logits - log_norm)
+        return mixture, _residual(mixed, mixture), grad
+
+
+class LearnedGainMixing(MixingOperator):
+    """
+    Mixture with one trainable gain per source
+
+    domain='linear': g = sum_k a_k * source_k
+    domain='power' or 'amplitude': dB sources, g = c * logsumexp(sources / c + log(a_k)) (see DecibelMixing)
+    The gains a = exp(log_gains) start at 1 / K (the mean mixture) and can be fitted to a mixture with fit.
+    The optimizer and the compiled fitting loop are created once: fit is traced once per shape of the sources.
+    """
+
+    def __init__(self, n_sources, domain='power', learning_rate=1e-2, name='mixing_gains'):
+        if domain not in ['linear', 'power', 'amplitude']:
+            raise ValueError("domain should be 'linear', 'power' or 'amplitude'")
+        self.domain = domain
+        self.n_sources = n_sources
+        if domain != 'linear':
+            self.c = (10. if domain == 'power' else 20.) / np.log(10.)
+        self.log_gains = tf.Variable(np.full([n_sources], -np.log(n_sources), dtype=np.float32), name=name)
+        self.optimizer = tfk.optimizers.Adam(learning_rate)
+        self._fit = tf.function(self._fit_steps)
+
+    @property
+    def variables(self):
+        return [self.log_gains]
+
+    @property
+    def gains(self):
+        return tf.math.exp(self.log_gains)
+
+    def __call__(self, sources, mixed=None):
+        # gains broadcast over [K, N, H, W, C]
+        log_gains = tf.reshape(self.log_gains, [-1, 1, 1, 1, 1])
+        if self.domain == 'linear':
+            gains = tf.math.exp(log_gains)
+            mixture = tf.reduce_sum(gains * sources, axis=0)
+            grad = tf.broadcast_to(gains, tf.shape(sources))
+        else:
+            logits = sources / self.c + log_gains
+            log_norm = tf.math.reduce_logsumexp(logits, axis=0, keepdims=True)
+            mixture = self.c * tf.squeeze(log_norm, axis=0)
+            grad = tf.math.exp(logits - log_norm)
+        return mixture, _residual(mixed, mixture), grad
+
+    def _fit_steps(self, sources, mixed, n_steps):
+        loss = tf.constant(0., dtype=tf.float32)
+        for _ in tf.range(n_steps):
+            with tf.GradientTape() as tape:
+                _, residual, _ = self(sources, mixed)
+                loss = tf.reduce_mean(residual ** 2)
+            self.optimizer.apply_gradients(zip(tape.gradient(loss, self.variables), self.variables))
+        return loss
+
+    def fit(self, sources, mixed, n_steps=100):
+        """
+        Fit the gains to mixed = g(sources) (least squares) with n_steps Adam steps, the sources being fixed
+
+        Returns:
+            loss after the last step
+        """
+        return self._fit(sources, mixed, tf.constant(n_steps, dtype=tf.int32))
+
+    def reset(self):
+        """
+        Gains back to 1 / K and fresh Adam moments, before separating other mixtures
+        """
+        self.log_gains.assign(np.full([self.n_sources], -np.log(self.n_sources), dtype=np.float32))
+        for variable in self.optimizer.variables():
+            variable.assign(tf.zeros_like(variable))
+
+
+def get_mixing_operator(data_type, scale, n_sources=None, learned_gains=False):
+    """
+    Mixing operator of the data: images are averaged, power spectrograms mixed in amplitude
+    and dB spectrograms mixed in power. With learned_gains, the spectrograms are mixed with trainable gains.
+    """
+    if learned_gains:
+        if n_sources is None:
+            raise ValueError("n_sources is required for the learned gains")
+        domain = 'power' if (data_type != 'image' and scale == 'dB') else 'linear'
+        return LearnedGainMixing(n_sources, domain=domain)
+    if data_type == 'image':
+        return LinearMixing()
+    if scale == 'power':
+        return AmplitudeMixing()
+    if scale == 'dB':
+        return DecibelMixing(domain='power')
+    raise ValueError("scale should be 'power' or 'dB'")
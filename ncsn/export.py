@@ -0,0 +1,126 @@
+import tensorflow as tf
+import json
+import os
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+
+
+"""
+Frozen SavedModels of the score networks for inference
+
+The variables of the trained model are folded into constants of a graph with fixed input signatures.
+The SavedModel holds no variables and no optimizer state: it is loaded without rebuilding the python layers.
+The parameters of the export (model type, data shape, sigmas) are saved in export_config.json next to it.
+"""
+
+CONFIG_FILENAME = 'export_config.json'
+
+
+def freeze(fn, input_signature):
+    """
+    Trace fn with input_signature and fold its variables into constants
+
+    Returns:
+        frozen ConcreteFunction
+    """
+    concrete_fn = tf.function(fn, input_signature=input_signature).get_concrete_function()
+    return convert_variables_to_constants_v2(concrete_fn)
+
+
+def _first_output(outputs):
+    if isinstance(outputs, (list, tuple)):
+        return outputs[0]
+    return outputs
+
+
+class FrozenNCSNModule(tf.Module):
+    """
+    score(x, sigma_idx): scores of the NCSN model
+    """
+
+    def __init__(self, model, data_shape, batch_size=None):
+        super(FrozenNCSNModule, self).__init__()
+        input_signature = [tf.TensorSpec([batch_size] + list(data_shape), dtype=tf.float32, name='x'),
+                           tf.TensorSpec([batch_size], dtype=tf.int32, name='sigma_idx')]
+        self._frozen_score = freeze(lambda x, sigma_idx: model([x, sigma_idx], training=True), input_signature)
+        self.score = tf.function(lambda x, sigma_idx: _first_output(self._frozen_score(x, sigma_idx)),
+                                 input_signature=input_signature)
+
+
+class FrozenGlowModule(tf.Module):
+    """
+    log_prob(x) and score(x) = grad_x log_prob(x) of a Glow model
+    """
+
+    def __init__(self, model, data_shape, batch_size=None):
+        super(FrozenGlowModule, self).__init__()
+        input_signature = [tf.TensorSpec([batch_size] + list(data_shape), dtype=tf.float32, name='x')]
+
+        def score(x):
+            with tf.GradientTape() as tape:
+                tape.watch(x)
+                log_prob = model.log_prob(x)
+            return tape.gradient(log_prob, x)
+
+        self._frozen_log_prob = freeze(model.log_prob, input_signature)
+        self._frozen_score = freeze(score, input_signature)
+        self.log_prob = tf.function(lambda x: _first_output(self._frozen_log_prob(x)), input_signature=input_signature)
+        self.score = tf.function(lambda x: _first_output(self._frozen_score(x)), input_signature=input_signature)
+
+
+def export_model(model, export_path, model_type, data_shape, sigmas=None, batch_size=None, **config):
+    """
+    Freeze a restored NCSN or Glow model and save it as a SavedModel in export_path
+
+    Parameters:
+        model_type: 'ncsn' or 'glow'
+        sigmas: noise levels of the NCSN model (saved in the export config)
+        batch_size: fixed batch size of the signatures (None for any batch size)
+        config: other parameters saved in the export config
+    """
+    if model_type == 'ncsn':
+        module = FrozenNCSNModule(model, data_shape, batch_size=batch_size)
+        signatures = {'serving_default': module.score}
+    elif model_type == 'glow':
+        module = FrozenGlowModule(model, data_shape, batch_size=batch_size)
+        signatures = {'serving_default': module.score, 'log_prob': module.log_prob}
+    else:
+        raise ValueError("model_type should be 'ncsn' or 'glow'")
+
+    tf.saved_model.save(module, export_path, signatures=signatures)
+    config.update({'model_type': model_type, 'data_shape': list(data_shape), 'batch_size': batch_size,
+                   'sigmas': None if sigmas is None else [float(sigma) for sigma in sigmas]})
+    with open(os.path.join(export_path, CONFIG_FILENAME), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def is_exported_model(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, CONFIG_FILENAME))
+
+
+class ExportedScoreModel(object):
+    """
+    Score network loaded from an exported SavedModel, called like the keras models
+
+    NCSN: model([x, sigma_idx]) -> scores
+    Glow: model.log_prob(x), model.score(x)
+    """
+
+    def __init__(self, export_path):
+        with open(os.path.join(export_path, CONFIG_FILENAME), 'r') as f:
+            self.config = json.load(f)
+        self.model_type = self.config['model_type']
+        self.data_shape = self.config['data_shape']
+        self.batch_size = self.config['batch_size']
+        self.sigmas = self.config['sigmas']
+        self.variables = []
+        self._module = tf.saved_model.load(export_path)
+
+    def __call__(self, inputs, training=True):
+        x, sigma_idx = inputs
+        return self._module.score(tf.convert_to_tensor(x, dtype=tf.float32), tf.cast(sigma_idx, tf.int32))
+
+    def score(self, x):
+        return self._module.score(x)
+
+    def log_prob(self, x):
+        return self._module.log_prob(x)
@@ -0,0 +1,213 @@
+import tensorflow as tf
+from . import score_network_v2
+tfk = tf.keras
+
+
+"""
+Grouped evaluation of K NCSN v2 score networks (RefineNetDilated) with the same architecture
+
+The weights of the K networks are stacked along a leading axis and the K networks run as one network
+on the sources packed into a [K * N, H, W, C] batch:
+- every convolution is a single batched matmul of the image patches of each source with the kernel of its network
+- the normalizations broadcast the stacked affine params of the networks over their sources
+- the weight-free ops (activations, pooling, resizing) run on the whole batch
+The weights are stacked at the first call: the grouped network must be built after the weights are restored.
+
+The patch matrices are kh * kw times larger than the activations (9 times for the 3x3 convolutions) and the matmuls
+do not use the Conv2D kernels of the backend: the grouped network is only used on request
+(run_basis_sep.py --grouped_score), compare it with the per-model calls with benchmark_grouped_score.py.
+"""
+
+
+def _find_network(model):
+    networks = [layer for layer in getattr(model, 'layers', []) if isinstance(layer, score_network_v2.RefineNetDilated)]
+    if len(networks) == 0:
+        return None
+    return networks[0]
+
+
+def grouped_score_fn(models):
+    """
+    Grouped evaluation of the K models (see GroupedRefineNet)
+
+    Returns:
+        score: function (x, labels) -> scores
+            x: [K, N, H, W, C] tensor, labels: [K, N] sigma indices
+        None if the models can not be grouped (not all float32 NCSN v2 models with the same architecture)
+    """
+    networks = [_find_network(model) for model in models]
+    if any([network is None for network in networks]):
+        return None
+    if any([network._compute_dtype != 'float32' for network in networks]):
+        return None
+    reference = networks[0]
+    for network in networks[1:]:
+        if list(network.data_shape) != list(reference.data_shape) or network.ngf != reference.ngf:
+            return None
+    return GroupedRefineNet(networks)
+
+
+class GroupedRefineNet(object):
+    """
+    K RefineNetDilated networks evaluated in one forward pass, called like stacked scores: grouped(x, labels)
+
+    Parameters:
+        networks: list of K RefineNetDilated layers with the same architecture
+    """
+
+    def __init__(self, networks):
+        self.networks = networks
+        self.K = len(networks)
+        self.sigmas = networks[0].sigmas
+        self._params = {}
+
+    def _stack(self, layers, name):
+        """
+        Stacked variable name of the K corresponding layers [K, ...], read once out of any traced function
+        """
+        key = (id(layers[0]), name)
+        if key not in self._params:
+            with tf.init_scope():
+                self._params[key] = tf.stack([tf.convert_to_tensor(getattr(layer, name)) for layer in layers], axis=0)
+        return self._params[key]
+
+    def _broadcast(self, params, x):
+        """
+        Repeat the params [K, C] of each network over its sources: [K * N, 1, 1, C]
+        """
+        params = tf.repeat(params, tf.shape(x)[0] // self.K, axis=0)
+        return tf.reshape(params, [-1, 1, 1, params.shape[-1]])
+
+    def _conv(self, x, convs):
+        kernel = self._stack(convs, 'kernel')
+        kh, kw, c_in, c_out = kernel.shape[1:]
+        rate = convs[0].dilation_rate
+        patches = tf.image.extract_patches(x, sizes=[1, kh, kw, 1], strides=[1, 1, 1, 1],
+                                           rates=[1, rate[0], rate[1], 1], padding='SAME')
+        output_shape = tf.concat([tf.shape(patches)[:3], [c_out]], axis=0)
+        patches = tf.reshape(patches, [self.K, -1, kh * kw * c_in])
+        outputs = tf.matmul(patches, tf.reshape(kernel, [self.K, kh * kw * c_in, c_out]))
+        if convs[0].use_bias:
+            outputs = outputs + self._stack(convs, 'bias')[:, None, :]
+        return tf.reshape(outputs, output_shape)
+
+    def _apply(self, x, layers):
+        """
+        Conv2D layers or Sequential of Conv2D and AveragePooling2D layers
+        """
+        if not isinstance(layers[0], tfk.Sequential):
+            return self._conv(x, layers)
+        for sublayers in zip(*[layer.layers for layer in layers]):
+            if isinstance(sublayers[0], tfk.layers.Conv2D):
+                x = self._conv(x, sublayers)
+            else:
+                x = sublayers[0](x)
+        return x
+
+    def _instance_norm(self, x, norms):
+        mean, variance = tf.nn.moments(x, axes=[1, 2], keepdims=True)
+        h = (x - mean) * tf.math.rsqrt(variance + norms[0].epsilon)
+        if norms[0].scale:
+            h = h * self._broadcast(self._stack(norms, 'gamma'), x)
+        if norms[0].center:
+            h = h + self._broadcast(self._stack(norms, 'beta'), x)
+        return h
+
+    def _norm_plus(self, x, norms):
+        means = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+        m, v = tf.nn.moments(means, axes=-1, keepdims=True)
+        means = (means - m) / tf.math.sqrt(v + 1e-5)
+        h = self._instance_norm(x, [norm.instance_norm for norm in norms])
+        out = self._broadcast(self._stack(norms, 'gamma'), x) * h + means * self._broadcast(self._stack(norms, 'alpha'), x)
+        if norms[0].bias:
+            out = out + self._broadcast(self._stack(norms, 'beta'), x)
+        return out
+
+    def _residual_block(self, x, blocks):
+        block = blocks[0]
+        output = self._norm_plus(x, [b.normalize1 for b in blocks])
+        output = block.act(output)
+        output = self._apply(output, [b.conv1 for b in blocks])
+        output = self._norm_plus(output, [b.normalize2 for b in blocks])
+        output = block.act(output)
+        output = self._apply(output, [b.conv2 for b in blocks])
+
+        if block.output_dim == block.input_dim and block.resample is None:
+            shortcut = tf.identity(x)
+        else:
+            shortcut = self._apply(x, [b.conv_shortcut for b in blocks])
+        return shortcut + output
+
+    def _rcu_block(self, x, blocks):
+        block = blocks[0]
+        for i in range(block.n_blocks):
+            residual = tf.identity(x)
+            for j in range(block.n_stages):
+                x = self._conv(x, [b.convs[i * block.n_stages + j] for b in blocks])
+            x += residual
+        return x
+
+    def _crp_block(self, x, blocks):
+        block = blocks[0]
+        x = block.act(x)
+        path = tf.identity(x)
+        for i in range(block.n_stages):
+            path = block.maxpool(path)
+            path = self._conv(path, [b.convs[i] for b in blocks])
+            x += path
+        return x
+
+    def _msf_block(self, xs, shape, blocks):
+        for i in range(len(blocks[0].convs)):
+            h = self._conv(xs[i], [b.convs[i] for b in blocks])
+            h = tf.cast(tf.image.resize(h, size=shape), h.dtype)
+            if i == 0:
+                sums = tf.identity(h)
+            else:
+                sums += h
+        return sums
+
+    def _refine_block(self, xs, output_shape, blocks):
+        hs = []
+        for i in range(len(xs)):
+            hs.append(self._rcu_block(xs[i], [b.adapt_convs[i] for b in blocks]))
+
+        if blocks[0].n_blocks > 1:
+            h = self._msf_block(hs, output_shape, [b.msf for b in blocks])
+        else:
+            h = hs[0]
+
+        h = self._crp_block(h, [b.crp for b in blocks])
+        h = self._rcu_block(h, [b.output_convs for b in blocks])
+        return h
+
+    def _cond_module(self, x, modules):
+        for blocks in zip(*modules):
+            x = self._residual_block(x, blocks)
+        return x
+
+    def __call__(self, x, labels):
+        nets = self.networks
+        x_flat = tf.reshape(x, tf.concat([[-1], tf.shape(x)[2:]], axis=0))
+        x_flat.set_shape([None] + list(x.shape[2:]))
+
+        res_input = self._conv(x_flat, [net.begin_conv for net in nets])
+
+        layer1 = self._cond_module(res_input, [net.res1 for net in nets])
+        layer2 = self._cond_module(layer1, [net.res2 for net in nets])
+        layer3 = self._cond_module(layer2, [net.res3 for net in nets])
+        layer4 = self._cond_module(layer3, [net.res4 for net in nets])
+
+        ref1 = self._refine_block([layer4], layer4.shape[1:3], [net.refine1 for net in nets])
+        ref2 = self._refine_block([layer3, ref1], layer3.shape[1:3], [net.refine2 for net in nets])
+        ref3 = self._refine_block([layer2, ref2], layer2.shape[1:3], [net.refine3 for net in nets])
+        output = self._refine_block([layer1, ref3], layer1.shape[1:3], [net.refine4 for net in nets])
+
+        output = self._norm_plus(output, [net.normalizer for net in nets])
+        output = nets[0].act(output)
+        output = self._conv(output, [net.end_conv for net in nets])
+
+        used_sigmas = tf.cast(tf.gather(params=self.sigmas, indices=tf.reshape(labels, [-1])), output.dtype)
+        output = output / tf.reshape(used_sigmas, shape=(-1, 1, 1, 1))
+
+        return tf.reshape(output, tf.shape(x))
@@ -0,0 +1,148 @@
+import tensorflow as tf
+import numpy as np
+import threading
+from .utils import get_uncompiled_model, get_uncompiled_model_v2
+tfk = tf.keras
+
+
+"""
+Reduced precision inference for the NCSN score networks
+
+- bfloat16: the network is rebuilt under the mixed_bfloat16 policy (float32 variables, bfloat16 computations)
+- int8: post-training quantization with TFLite, calibrated on noisy training spectrograms
+score_accuracy compares the score field of a reduced precision model with the float32 model at every noise level.
+"""
+
+
+def get_bfloat16_model(args, sigmas, float_model, name="ScoreNetwork_bfloat16"):
+    """
+    Build the score network of args under the mixed_bfloat16 policy with the weights of float_model
+    """
+    tfk.mixed_precision.experimental.set_policy('mixed_bfloat16')
+    try:
+        if args.version == 'v1':
+            model = get_uncompiled_model(args, name=name)
+        else:
+            model = get_uncompiled_model_v2(args, sigmas=sigmas, name=name)
+    finally:
+        tfk.mixed_precision.experimental.set_policy('float32')
+    model.set_weights(float_model.get_weights())
+    return model
+
+
+def representative_dataset_fn(ds, sigmas, n_samples, minval, maxval, use_logit=False, alpha=None, seed=None):
+    """
+    Calibration data for the int8 quantization
+
+    The spectrograms of ds (unbatched, as returned by data_loader.load_melspec_ds) are preprocessed as in train_ncsn.py
+    and perturbed with the noise of every noise level in turn, like the inputs of the network in the Langevin dynamics.
+
+    Returns:
+        representative_dataset: generator function of [x, sigma_idx] with a batch of one sample
+    """
+    sigmas = np.asarray(sigmas, dtype=np.float32)
+
+    def representative_dataset():
+        rng = np.random.RandomState(seed)
+        for i, X in enumerate(ds.take(n_samples).as_numpy_iterator()):
+            X = (X - minval) / (maxval - minval)
+            if use_logit:
+                X = X * (1. - 2 * alpha) + alpha
+                X = np.log(X) - np.log(1. - X)
+            sigma_idx = i % len(sigmas)
+            perturbed_X = X + sigmas[sigma_idx] * rng.normal(size=X.shape)
+            yield [perturbed_X[None].astype(np.float32), np.array([sigma_idx], dtype=np.int32)]
+
+    return representative_dataset
+
+
+def convert_to_int8(model, data_shape, representative_dataset, output_path=None):
+    """
+    Post-training quantization of a score network with TFLite
+
+    The weights are quantized per channel and the activations per tensor with the ranges observed
+    on representative_dataset. Operations without int8 kernel stay in float32.
+
+    Returns:
+        tflite_model: bytes of the TFLite model (also written into output_path if given)
+    """
+    @tf.function(input_signature=[tf.TensorSpec([None] + list(data_shape), dtype=tf.float32),
+                                  tf.TensorSpec([None], dtype=tf.int32)])
+    def score(x, sigma_idx):
+        return model([x, sigma_idx], training=True)
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([score.get_concrete_function()])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS]
+    tflite_model = converter.convert()
+
+    if output_path is not None:
+        with open(output_path, 'wb') as f:
+            f.write(tflite_model)
+    return tflite_model
+
+
+class TFLiteScoreModel(object):
+    """
+    Score network from a TFLite file, called like the keras models: model([x, sigma_idx])
+
+    The interpreter runs through tf.numpy_function so the model can be used inside tf.function.
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        input_details = self.interpreter.get_input_details()
+        self.x_index = [d['index'] for d in input_details if d['dtype'] == np.float32][0]
+        self.labels_index = [d['index'] for d in input_details if d['dtype'] == np.int32][0]
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+        self.variables = []
+        self._lock = threading.Lock()
+
+    def _invoke(self, x, labels):
+        with self._lock:
+            if x.shape[0] != self.batch_size:
+                self.interpreter.resize_tensor_input(self.x_index, list(x.shape))
+                self.interpreter.resize_tensor_input(self.labels_index, [x.shape[0]])
+                self.interpreter.allocate_tensors()
+                self.batch_size = x.shape[0]
+            self.interpreter.set_tensor(self.x_index, x)
+            self.interpreter.set_tensor(self.labels_index, labels)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+    def __call__(self, inputs, training=True):
+        x, labels = inputs
+        scores = tf.numpy_function(self._invoke, [x, tf.cast(labels, tf.int32)], tf.float32)
+        scores.set_shape(x.shape)
+        return scores
+
+
+def score_accuracy(reference_model, model, x, sigmas, seed=None):
+    """
+    Compare the scores of model with the scores of the float32 reference_model at every noise level
+
+    Parameters:
+        x: [N, H, W, C] clean preprocessed spectrograms, perturbed with the same noise for both models
+
+    Returns:
+        list of dict (one per noise level): sigma_idx, sigma, relative_error ||s - s_ref|| / ||s_ref||
+            and cosine_similarity between s and s_ref
+    """
+    rng = np.random.RandomState(seed)
+    n = x.shape[0]
+    results = []
+    for sigma_idx, sigma in enumerate(sigmas):
+        perturbed_x = x + sigma * rng.normal(size=x.shape).astype(np.float32)
+        labels = tf.ones(n, dtype=tf.int32) * sigma_idx
+        s_ref = reference_model([perturbed_x, labels], training=True).numpy().astype(np.float64)
+        s = model([perturbed_x, labels], training=True).numpy().astype(np.float64)
+        ref_norm = np.linalg.norm(s_ref)
+        results.append({'sigma_idx': sigma_idx,
+                        'sigma': float(sigma),
+                        'relative_error': float(np.linalg.norm(s - s_ref) / ref_norm),
+                        'cosine_similarity': float(np.sum(s * s_ref) / (np.linalg.norm(s) * ref_norm))})
+    return results
@@ -0,0 +1,352 @@
+import tensorflow as tf
+import numpy as np
+from .utils import fixed_sigma_score_fn
+
+
+"""
+Annealed samplers of the NCSN models for unconditional generation and BASIS separation
+
+A sampler moves the chains from one noise level to the next (level) and can end with a denoising step.
+It only sees a score object, so the same samplers run on:
+- ModelScore: score of a NCSN model, chains [N, H, W, C] (generation)
+- PosteriorScore: BASIS posterior score of K sources given their mixture, chains [K, N, H, W, C] (separation)
+
+Samplers:
+- AnnealedLangevinSampler: n_steps_each Langevin steps per noise level (the original algorithm)
+- PredictorCorrectorSampler: reverse diffusion predictor and n_corrector Langevin correctors with a signal to noise
+  ratio step size (Song et al. 2021, https://arxiv.org/abs/2011.13456)
+- ConsistentAnnealedSampler: one step per noise level with the noise rescaled to match the next level
+  (Jolicoeur-Martineau et al. 2020, https://arxiv.org/abs/2009.05475)
+n_evals gives the number of score network evaluations of each sampler.
+
+The levels run in a compiled tf.while_loop, traced once per sampler and score object. The chains are processed by batches
+and the trajectory (the chains after each visited level) is written into a preallocated buffer: an in-memory array
+or a .npy file opened with np.lib.format.open_memmap, so thousands of samples can be generated without holding
+the trajectory in memory. shard_ranges splits the chains between the worker processes of ncsn_generate_samples.py.
+"""
+
+
+class ModelScore(object):
+    """
+    Score of a NCSN model
+
+    conditioning(sigma_idx, x) is evaluated once per noise level
+    (normalization params of the v1 models, see fixed_sigma_score_fn, otherwise the sigma indices)
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fixed_sigma = fixed_sigma_score_fn(model)
+
+    def conditioning(self, sigma_idx, x):
+        if self.fixed_sigma is not None:
+            return self.fixed_sigma[0](sigma_idx)
+        return tf.ones([tf.shape(x)[0]], dtype=tf.int32) * sigma_idx
+
+    def __call__(self, x, cond, sigma, context=None):
+        if self.fixed_sigma is not None:
+            return self.fixed_sigma[1](x, cond)
+        return self.model([x, cond], training=True)
+
+
+class PosteriorScore(object):
+    """
+    BASIS posterior score of K sources x [K, N, H, W, C] given their mixture (context [N, H, W, C])
+
+    score(x) + grad_g(x) * (mixture - g(x)) / sigma ** 2
+
+    Parameters:
+        score, conditioning: stacked score of the K models (see run_basis_sep.stacked_score_fn)
+        mixing_op: mixing operator g (see mixing_operators)
+    """
+
+    def __init__(self, score, conditioning, mixing_op):
+        self.score = score
+        self._conditioning = conditioning
+        self.mixing_op = mixing_op
+
+    def conditioning(self, sigma_idx, x):
+        return self._conditioning(sigma_idx, tf.shape(x)[1])
+
+    def __call__(self, x, cond, sigma, context=None):
+        _, residual, grad_mixing = self.mixing_op(x, context)
+        return self.score(x, cond) + grad_mixing * residual / sigma ** 2
+
+
+def _noise_like(x):
+    return tf.random.normal(tf.shape(x), dtype=tf.float32)
+
+
+def _sample_norm(x):
+    # norm of each chain (the last 3 axes are H, W, C)
+    return tf.norm(tf.reshape(x, tf.concat([tf.shape(x)[:-3], [-1]], axis=0)), axis=-1)[..., None, None, None]
+
+
+class AnnealedSampler(object):
+    """
+    Base class of the samplers
+
+    Parameters:
+        sigmas: noise levels of the model
+        step_lr: step size at the last noise level (the step size of the level sigma_i is
+            step_scale_i * step_lr * (sigma_i / sigma_L) ** 2, for the v1 and v2 networks)
+        sigma_indices: levels to visit (see ncsn.schedule). By default every level
+        step_scales: step size scale of each visited level
+        denoise: if True, end with x + sigma ** 2 * score(x) at the last visited level (one more score evaluation)
+    """
+
+    def __init__(self, sigmas, step_lr=2e-5, sigma_indices=None, step_scales=None, denoise=False):
+        self.sigmas = np.asarray(sigmas, dtype=np.float32)
+        self.sigmas_tf = tf.constant(self.sigmas, dtype=tf.float32)
+        self.step_lr = step_lr
+        if sigma_indices is None:
+            sigma_indices = np.arange(len(sigmas))
+        if step_scales is None:
+            step_scales = np.ones(len(sigma_indices), dtype=np.float32)
+        self.sigma_indices = [int(i) for i in sigma_indices]
+        self.step_scales = [float(scale) for scale in step_scales]
+        self.denoise = denoise
+        self._compiled_level = tf.function(self._level_fn)
+        self._compiled_denoise = tf.function(self._denoise_fn)
+
+    @property
+    def n_levels(self):
+        return len(self.sigma_indices)
+
+    @property
+    def evals_per_level(self):
+        raise NotImplementedError
+
+    def n_evals(self, n_levels=None):
+        """
+        Number of score evaluations of one run (per chain)
+        """
+        if n_levels is None:
+            n_levels = self.n_levels
+        return n_levels * self.evals_per_level + int(self.denoise)
+
+    def step_size(self, sigma, step_scale):
+        return step_scale * self.step_lr * (sigma / self.sigmas_tf[-1]) ** 2
+
+    def update(self, score, x, cond, sigma, next_sigma, step_scale, context):
+        """
+        Move the chains x from the noise level sigma to next_sigma (0 after the last level). Traced in graph mode
+        """
+        raise NotImplementedError
+
+    def _level_fn(self, score, x, sigma_idx, next_sigma_idx, step_scale, context):
+        sigma = tf.gather(self.sigmas_tf, sigma_idx)
+        next_sigma = tf.where(next_sigma_idx >= 0, tf.gather(self.sigmas_tf, tf.maximum(next_sigma_idx, 0)), 0.)
+        # loop invariant: evaluated once per noise level
+        cond = score.conditioning(sigma_idx, x)
+        return self.update(score, x, cond, sigma, next_sigma, step_scale, context)
+
+    def _denoise_fn(self, score, x, sigma_idx, context):
+        sigma = tf.gather(self.sigmas_tf, sigma_idx)
+        return x + sigma ** 2 * score(x, score.conditioning(sigma_idx, x), sigma, context)
+
+    def level(self, score, x, sigma_idx, next_sigma_idx=-1, step_scale=1., context=None):
+        """
+        Run the noise level sigma_idx. next_sigma_idx is the next visited level (-1 after the last one)
+        """
+        return self._compiled_level(score, x, tf.constant(sigma_idx, dtype=tf.int32),
+                                    tf.constant(next_sigma_idx, dtype=tf.int32),
+                                    tf.constant(step_scale, dtype=tf.float32), context)
+
+    def denoise_step(self, score, x, sigma_idx=None, context=None):
+        if sigma_idx is None:
+            sigma_idx = self.sigma_indices[-1]
+        return self._compiled_denoise(score, x, tf.constant(sigma_idx, dtype=tf.int32), context)
+
+    def trajectory_shape(self, n_chains, data_shape):
+        return [self.n_levels + 1, n_chains] + list(data_shape)
+
+    def sample(self, score, x_mod, context=None, trajectory=None, transform=None, verbose=False):
+        """
+        Run the chains x_mod over every visited noise level
+
+        context: extra input of the score (the mixture for PosteriorScore)
+        trajectory: optional buffer of shape trajectory_shape(N, data_shape), filled with x_mod
+            and the chains after each level (the last entry is denoised if self.denoise)
+        transform: function applied to the chains written into trajectory (e.g. post processing)
+
+        Returns:
+            tensor, final chains
+        """
+        if transform is None:
+            transform = lambda x: x
+        x = tf.convert_to_tensor(x_mod, dtype=tf.float32)
+        if trajectory is not None:
+            trajectory[0] = transform(x.numpy())
+        for j, (sigma_idx, step_scale) in enumerate(zip(self.sigma_indices, self.step_scales)):
+            if verbose:
+                print("Sigma = {} ({} / {})".format(self.sigmas[sigma_idx], j + 1, self.n_levels))
+            next_sigma_idx = self.sigma_indices[j + 1] if j + 1 < self.n_levels else -1
+            x = self.level(score, x, sigma_idx, next_sigma_idx, step_scale, context=context)
+            if self.denoise and j + 1 == self.n_levels:
+                x = self.denoise_step(score, x, sigma_idx, context=context)
+            if trajectory is not None:
+                trajectory[j + 1] = transform(x.numpy())
+        return x
+
+    def sample_chains(self, score, init_fn, n_chains, batch_size, data_shape, trajectory=None, samples=None, transform=None,
+                      verbose=False):
+        """
+        Run n_chains chains by batches of batch_size chains
+
+        init_fn: function n -> initial chains [n, H, W, C]
+        trajectory: optional buffer of shape trajectory_shape(n_chains, data_shape)
+        transform: function applied to the chains written into trajectory
+        samples: optional buffer [n_chains, H, W, C] for the final chains
+
+        Returns:
+            samples
+        """
+        if samples is None:
+            samples = np.empty([n_chains] + list(data_shape), dtype=np.float32)
+        for start in range(0, n_chains, batch_size):
+            stop = min(start + batch_size, n_chains)
+            if verbose:
+                print("Chains {} - {} / {}".format(start, stop, n_chains))
+            batch_trajectory = None if trajectory is None else trajectory[:, start:stop]
+            samples[start:stop] = self.sample(score, init_fn(stop - start), trajectory=batch_trajectory,
+                                              transform=transform, verbose=verbose).numpy()
+        return samples
+
+
+class AnnealedLangevinSampler(AnnealedSampler):
+    """
+    Annealed Langevin dynamics: n_steps_each steps x <- x + eta * score(x) + sqrt(2 * eta) * z per noise level
+    """
+
+    def __init__(self, sigmas, n_steps_each=100, step_lr=2e-5, sigma_indices=None, step_scales=None, denoise=False):
+        super(AnnealedLangevinSampler, self).__init__(sigmas, step_lr=step_lr, sigma_indices=sigma_indices,
+                                                      step_scales=step_scales, denoise=denoise)
+        self.n_steps_each = n_steps_each
+
+    @property
+    def evals_per_level(self):
+        return self.n_steps_each
+
+    def update(self, score, x, cond, sigma, next_sigma, step_scale, context):
+        step_size = self.step_size(sigma, step_scale)
+
+        def body(t, x):
+            x = x + step_size * score(x, cond, sigma, context) + tf.math.sqrt(2. * step_size) * _noise_like(x)
+            return t + 1, x
+
+        _, x = tf.while_loop(lambda t, x: t < self.n_steps_each, body, [tf.constant(0), x])
+        return x
+
+
+class PredictorCorrectorSampler(AnnealedSampler):
+    """
+    Predictor-corrector sampler of the variance exploding SDE
+
+    corrector: n_corrector Langevin steps with step size 2 * (snr * ||z|| / ||score||) ** 2 (per chain)
+    predictor: reverse diffusion step from sigma to the next level,
+        x <- x + (sigma ** 2 - next_sigma ** 2) * score(x) + sqrt(sigma ** 2 - next_sigma ** 2) * z
+    The predictor covers the gap between the visited levels, so the step scales of sub-sampled schedules are not used.
+    """
+
+    def __init__(self, sigmas, n_corrector=1, snr=0.16, sigma_indices=None, step_scales=None, denoise=False):
+        super(PredictorCorrectorSampler, self).__init__(sigmas, sigma_indices=sigma_indices, step_scales=step_scales,
+                                                        denoise=denoise)
+        self.n_corrector = n_corrector
+        self.snr = snr
+
+    @property
+    def evals_per_level(self):
+        return self.n_corrector + 1
+
+    def update(self, score, x, cond, sigma, next_sigma, step_scale, context):
+        def corrector(t, x):
+            grad = score(x, cond, sigma, context)
+            noise = _noise_like(x)
+            step_size = 2. * (self.snr * _sample_norm(noise) / (_sample_norm(grad) + 1e-12)) ** 2
+            x = x + step_size * grad + tf.math.sqrt(2. * step_size) * noise
+            return t + 1, x
+
+        _, x = tf.while_loop(lambda t, x: t < self.n_corrector, corrector, [tf.constant(0), x])
+
+        variance = sigma ** 2 - next_sigma ** 2
+        x_mean = x + variance * score(x, cond, sigma, context)
+        # no noise after the last level
+        return tf.cond(next_sigma > 0., lambda: x_mean + tf.math.sqrt(variance) * _noise_like(x), lambda: x_mean)
+
+
+class ConsistentAnnealedSampler(AnnealedSampler):
+    """
+    Consistent annealed sampling: one step per noise level
+        x <- x + eta * score(x) + beta * next_sigma * z, beta = sqrt(1 - ((1 - eta / sigma ** 2) / gamma) ** 2)
+    where gamma = next_sigma / sigma, so the chains have the noise level next_sigma after the step.
+    beta is real only if eta / sigma ** 2 >= 1 - gamma.
+
+    By default (step_lr None) the step size follows the schedule: eta = sigma ** 2 - next_sigma ** 2,
+    so beta = sqrt(1 - gamma ** 2), and the last level is a denoising step (next_sigma = 0).
+    The step scales are not used, gamma already covers the gap between the visited levels.
+    With a step_lr, the step sizes are those of the Langevin dynamics and a ValueError is raised
+    if beta would be 0 (no noise injected) at one of the levels.
+    """
+
+    def __init__(self, sigmas, step_lr=None, sigma_indices=None, step_scales=None, denoise=False):
+        super(ConsistentAnnealedSampler, self).__init__(sigmas, step_lr=step_lr, sigma_indices=sigma_indices,
+                                                        step_scales=step_scales, denoise=denoise)
+        if step_lr is not None:
+            # eta / sigma ** 2 = step_scale * step_lr / sigma_L ** 2 should be >= 1 - gamma at every level but the last
+            levels = zip(self.sigma_indices[:-1], self.sigma_indices[1:], self.step_scales[:-1])
+            min_step_lr = max([(1. - self.sigmas[next_idx] / self.sigmas[idx]) * self.sigmas[-1] ** 2 / step_scale
+                               for idx, next_idx, step_scale in levels], default=0.)
+            if step_lr < min_step_lr:
+                raise ValueError("step_lr = {} injects no noise in consistent annealed sampling (beta = 0): use step_lr >= {:.3g} "
+                                 "or the step size of the schedule (step_lr None)".format(step_lr, min_step_lr))
+
+    @property
+    def evals_per_level(self):
+        return 1
+
+    def update(self, score, x, cond, sigma, next_sigma, step_scale, context):
+        if self.step_lr is None:
+            step_size = sigma ** 2 - next_sigma ** 2
+        else:
+            step_size = self.step_size(sigma, step_scale)
+        x_mean = x + step_size * score(x, cond, sigma, context)
+        gamma = next_sigma / sigma
+        beta = tf.math.sqrt(tf.maximum(1. - ((1. - step_size / sigma ** 2) / tf.maximum(gamma, 1e-12)) ** 2, 0.))
+        return tf.cond(next_sigma > 0., lambda: x_mean + beta * next_sigma * _noise_like(x), lambda: x_mean)
+
+
+SAMPLERS = ['ald', 'pc', 'cas']
+
+
+def get_sampler(name, sigmas, n_steps_each=100, step_lr=None, sigma_indices=None, step_scales=None, n_corrector=1,
+                snr=0.16, denoise=False):
+    """
+    Build a sampler by name: 'ald' (annealed Langevin dynamics), 'pc' (predictor-corrector)
+    or 'cas' (consistent annealed sampling)
+    step_lr: step size of the Langevin dynamics at the last noise level. If None, 2e-5 for 'ald'
+        and the step size of the schedule for 'cas' (see ConsistentAnnealedSampler)
+    """
+    if name == 'ald':
+        step_lr = 2e-5 if step_lr is None else step_lr
+        return AnnealedLangevinSampler(sigmas, n_steps_each=n_steps_each, step_lr=step_lr, sigma_indices=sigma_indices,
+                                       step_scales=step_scales, denoise=denoise)
+    elif name == 'pc':
+        return PredictorCorrectorSampler(sigmas, n_corrector=n_corrector, snr=snr, sigma_indices=sigma_indices,
+                                         step_scales=step_scales, denoise=denoise)
+    elif name == 'cas':
+        return ConsistentAnnealedSampler(sigmas, step_lr=step_lr, sigma_indices=sigma_indices, step_scales=step_scales,
+                                         denoise=denoise)
+    raise ValueError("sampler should be one of {}".format(SAMPLERS))
+
+
+def shard_ranges(n_chains, n_shards):
+    """
+    Split n_chains chains into n_shards contiguous ranges of (almost) equal size
+
+    Returns:
+        list of (start, stop)
+    """
+    n_shards = max(1, min(n_shards, n_chains))
+    bounds = np.linspace(0, n_chains, n_shards + 1).astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
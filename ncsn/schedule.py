@@ -0,0 +1,91 @@
+import numpy as np
+import warnings
+
+
+"""
+Inference schedules: visit a subset of the noise levels of a trained model
+
+The score networks are conditioned on the index of the noise level in the training schedule (get_sigmas),
+so an inference schedule is a list of indices into the training schedule, plus one step size scale per visited level.
+"""
+
+
+def subsample_schedule(sigmas, n_levels=None, spacing='uniform'):
+    """
+    Indices of the noise levels visited at inference. The first and last levels are always kept
+
+    Parameters:
+        sigmas: training schedule, decreasing
+        n_levels: number of levels to visit. None or >= len(sigmas) keeps every level
+        spacing: 'uniform' (every len(sigmas) / n_levels levels, i.e. geometric in sigma for the geometric schedules)
+            or 'quadratic' (denser at the low noise levels, where the details of the sources are refined)
+
+    Returns:
+        indices: ndarray of int, increasing
+    """
+    n_sigmas = len(sigmas)
+    if n_levels is None or n_levels >= n_sigmas:
+        return np.arange(n_sigmas)
+    if n_levels < 2:
+        raise ValueError("n_levels should be at least 2, got {}".format(n_levels))
+
+    if spacing == 'uniform':
+        positions = np.linspace(0., 1., n_levels)
+    elif spacing == 'quadratic':
+        positions = 1. - np.linspace(1., 0., n_levels) ** 2
+    else:
+        raise ValueError("spacing should be 'uniform' or 'quadratic'")
+
+    indices = np.unique(np.round(positions * (n_sigmas - 1)).astype(int))
+    # rounding can merge close levels of the quadratic spacing: fill up with the largest gaps
+    while len(indices) < n_levels:
+        gaps = np.diff(indices)
+        i = np.argmax(gaps)
+        indices = np.insert(indices, i + 1, indices[i] + gaps[i] // 2)
+    return indices
+
+
+def step_scales(sigmas, indices, max_scale=None):
+    """
+    Step size scales preserving the annealing of the training schedule
+
+    With the step size eta_i = step_lr * (sigma_i / sigma_L)^2 of anneal_langevin_dynamics and BASIS,
+    each visited level i_m stands for the skipped levels i_m, ..., i_{m+1} - 1.
+    Its step size is scaled so that the Langevin time T * sum(eta_j) spent over these levels is preserved.
+
+    Parameters:
+        sigmas: training schedule
+        indices: visited levels (from subsample_schedule)
+        max_scale: upper bound of the scales (None: no bound). Large steps can make the dynamics unstable,
+            but a bound below the scales drops part of the Langevin time of the skipped levels: a warning gives the
+            fraction of the total step size removed
+
+    Returns:
+        scales: ndarray of float32, one per visited level
+    """
+    sigmas = np.asarray(sigmas, dtype=np.float64)
+    bounds = list(indices[1:]) + [indices[-1] + 1]
+    scales = np.array([np.sum(sigmas[start:end] ** 2) / sigmas[start] ** 2 for start, end in zip(indices, bounds)])
+    if max_scale is not None and np.any(scales > max_scale):
+        steps = sigmas[indices] ** 2
+        clipped = np.minimum(scales, max_scale)
+        lost = 1. - np.sum(clipped * steps) / np.sum(scales * steps)
+        warnings.warn("max_scale = {} clips {} of the {} step size scales (largest {:.2f}): "
+                      "{:.1%} of the total step size of the schedule is dropped".format(
+                          max_scale, int(np.sum(scales > max_scale)), len(scales), np.max(scales), lost))
+        scales = clipped
+    return scales.astype(np.float32)
+
+
+def inference_schedule(sigmas, n_levels=None, spacing='uniform', rescale=True, max_scale=None):
+    """
+    Returns:
+        indices: visited levels
+        scales: step size scale of each visited level (ones if not rescale)
+    """
+    indices = subsample_schedule(sigmas, n_levels=n_levels, spacing=spacing)
+    if rescale:
+        scales = step_scales(sigmas, indices, max_scale=max_scale)
+    else:
+        scales = np.ones(len(indices), dtype=np.float32)
+    return indices, scales
@@ -71,7 +71,8 @@ class CondMSFBlock(tfk.layers.Layer):
         for i in range(len(self.convs)):
             h = self.norms[i](xs[i], y, training=training)
             h = self.convs[i](h)
-            h = tf.image.resize(h, size=shape)
+            # resize returns float32 for bilinear interpolation
+            h = tf.cast(tf.image.resize(h, size=shape), h.dtype)
             if i == 0:
                 sums = tf.identity(h)
             else:
@@ -200,22 +201,39 @@ class ConditionalInstanceNorm2dPlus(tfk.layers.Layer):
             assert weights.shape == (num_classes, 2 * num_features)
             self.embed.set_weights([weights])
 
-    def call(self, x, y, training=True):
-        means = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
-        m, v = tf.nn.moments(means, axes=-1, keepdims=True)
-        means = (means - m) / tf.math.sqrt(v + 1e-5)
-        h = self.instance_norm(x, training=True)
-
-        embed = self.embed(y)
+    def _split_embed(self, embed):
         if self.bias:
             gamma, alpha, beta = tf.split(embed, 3, axis=-1)
             beta = tf.reshape(beta, (-1, 1, 1, self.num_features))
         else:
             gamma, alpha = tf.split(embed, 2, axis=-1)
-            beta = 0.
+            beta = tf.zeros((1, 1, 1, self.num_features), dtype=embed.dtype)
 
         gamma = tf.reshape(gamma, (-1, 1, 1, self.num_features))
         alpha = tf.reshape(alpha, (-1, 1, 1, self.num_features))
+        return gamma, alpha, beta
+
+    def affine_params(self, sigma_idx):
+        """
+        gamma, alpha and beta of the noise level sigma_idx (scalar), broadcastable over the batch
+        """
+        embed = tf.gather(self.embed.embeddings, sigma_idx)
+        return self._split_embed(tf.reshape(embed, (1, -1)))
+
+    def call(self, x, y, training=True):
+        """
+        y: sigma indices [N] or, for a fixed noise level, dict of the affine params of every layer (see CondRefineNetDilated.norm_params)
+        """
+        means = tf.reduce_mean(x, axis=[1, 2], keepdims=True)
+        m, v = tf.nn.moments(means, axes=-1, keepdims=True)
+        means = (means - m) / tf.math.sqrt(v + 1e-5)
+        h = self.instance_norm(x, training=True)
+
+        if isinstance(y, dict):
+            gamma, alpha, beta = [tf.cast(param, x.dtype) for param in y[id(self)]]
+        else:
+            # the embedding stays float32 under a mixed precision policy
+            gamma, alpha, beta = self._split_embed(tf.cast(self.embed(y), x.dtype))
 
         out = gamma * h + means * alpha + beta
         return out
@@ -266,6 +284,19 @@ class CondRefineNetDilated(tfk.layers.Layer):
         self.refine3 = CondRefineBlock([2 * self.ngf, 2 * self.ngf], self.ngf, self.num_classes, self.norm, act=act, name="refine3")
         self.refine4 = CondRefineBlock([self.ngf, self.ngf], self.ngf, self.num_classes, self.norm, act=act, end=True, name="refine4")
 
+    def norm_params(self, sigma_idx):
+        """
+        Affine params of every conditional normalization layer at the noise level sigma_idx (scalar)
+
+        When the noise level is fixed for many calls (Langevin dynamics), the params can be computed once
+        and given as y instead of the sigma indices: self([x, self.norm_params(sigma_idx)])
+
+        Returns:
+            dict: id of the layer -> (gamma, alpha, beta)
+        """
+        return {id(layer): layer.affine_params(sigma_idx) for layer in self.submodules
+                if isinstance(layer, ConditionalInstanceNorm2dPlus)}
+
     def _compute_cond_module(self, module, x, y, training=True):
         for m in module:
             x = m(x, y, training=training)
@@ -293,7 +324,7 @@ class CondRefineNetDilated(tfk.layers.Layer):
         output = self.act(output)
         output = self.end_conv(output)
 
-        return output
+        return tf.cast(output, tf.float32)
 
     def get_config(self):
         return {"data_shape": self.data_shape,
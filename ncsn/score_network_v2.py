@@ -61,7 +61,8 @@ class MSFBlock(tfk.layers.Layer):
     def call(self, xs, shape):
         for i in range(len(self.convs)):
             h = self.convs[i](xs[i])
-            h = tf.image.resize(h, size=shape)
+            # resize returns float32 for bilinear interpolation
+            h = tf.cast(tf.image.resize(h, size=shape), h.dtype)
             if i == 0:
                 sums = tf.identity(h)
             else:
@@ -191,9 +192,10 @@ class InstanceNorm2dPlus(tfk.layers.Layer):
         means = (means - m) / tf.math.sqrt(v + 1e-5)
         h = self.instance_norm(x, training=True)
 
-        gamma = tf.reshape(self.gamma, (-1, 1, 1, self.num_features))
-        alpha = tf.reshape(self.alpha, (-1, 1, 1, self.num_features))
-        beta = tf.reshape(self.beta, (-1, 1, 1, self.num_features))
+        # the variables stay float32 under a mixed precision policy
+        gamma = tf.reshape(tf.cast(self.gamma, x.dtype), (-1, 1, 1, self.num_features))
+        alpha = tf.reshape(tf.cast(self.alpha, x.dtype), (-1, 1, 1, self.num_features))
+        beta = tf.reshape(tf.cast(self.beta, x.dtype), (-1, 1, 1, self.num_features))
 
         out = gamma * h + means * alpha + beta
         return out
@@ -272,10 +274,10 @@ class RefineNetDilated(tfk.layers.Layer):
         output = self.act(output)
         output = self.end_conv(output)
 
-        used_sigmas = tf.gather(params=self.sigmas, indices=y)
+        used_sigmas = tf.cast(tf.gather(params=self.sigmas, indices=y), output.dtype)
         output = output / tf.reshape(used_sigmas, shape=(-1, 1, 1, 1))
 
-        return output
+        return tf.cast(output, tf.float32)
 
     def get_config(self):
         return {"data_shape": self.data_shape,
@@ -365,10 +367,10 @@ class RefineNetDilatedDeeper(tfk.layers.Layer):
         output = self.act(output)
         output = self.end_conv(output)
 
-        used_sigmas = tf.gather(self.sigmas, y)
+        used_sigmas = tf.cast(tf.gather(self.sigmas, y), output.dtype)
         output = output / tf.reshape(used_sigmas, shape=(-1, 1, 1, 1))
 
-        return output
+        return tf.cast(output, tf.float32)
 
     def get_config(self):
         return {"data_shape": self.data_shape,
@@ -14,23 +14,64 @@ def get_sigmas(sigma1, sigmaL, num_classes, progression='geometric'):
     return sigmas.astype(np.float32)
 
 
-def anneal_langevin_dynamics(x_mod, data_shape, model, n_samples, sigmas, n_steps_each=100, step_lr=2e-5, return_arr=False, verbose=False):
+def fixed_sigma_score_fn(model):
+    """
+    Fixed-sigma specialization of a NCSN v1 model (CondRefineNetDilated)
+
+    The affine params of the conditional normalization layers only depend on the noise level:
+    they are computed once per noise level by prepare and reused by every score evaluation at that level.
+
+    Returns:
+        (prepare, score): prepare(sigma_idx) -> params, score(x, params) -> scores
+        None if the model has no conditional normalization (v2, Glow, TFLite or exported models)
+    """
+    networks = [layer for layer in getattr(model, 'layers', []) if isinstance(layer, score_network.CondRefineNetDilated)]
+    if len(networks) == 0:
+        return None
+    network = networks[0]
+
+    def prepare(sigma_idx):
+        return network.norm_params(sigma_idx)
+
+    def score(x, params):
+        return network([x, params], training=True)
+
+    return prepare, score
+
+
+def anneal_langevin_dynamics(x_mod, data_shape, model, n_samples, sigmas, n_steps_each=100, step_lr=2e-5, return_arr=False, verbose=False,
+                             sigma_indices=None, step_scales=None):
     """
     Anneal Langevin dynamics
+
+    sigma_indices: noise levels to visit (indices of sigmas, see ncsn.schedule). By default every level is visited
+    step_scales: step size scale of each visited level
     """
+    if sigma_indices is None:
+        sigma_indices = range(len(sigmas))
+    if step_scales is None:
+        step_scales = np.ones(len(sigma_indices), dtype=np.float32)
+    fixed_sigma = fixed_sigma_score_fn(model)
     if return_arr:
-        x_arr = tf.expand_dims(x_mod, axis=0).numpy()
-    for i, sigma in enumerate(sigmas):
+        x_arr = np.empty([len(sigma_indices) + 1] + list(x_mod.shape), dtype=np.float32)
+        x_arr[0] = x_mod.numpy()
+    for j, (i, scale) in enumerate(zip(sigma_indices, step_scales)):
+        sigma = sigmas[i]
         if verbose:
-            print("Sigma = {} ({} / {})".format(sigma, i + 1, len(sigmas)))
-        labels = tf.ones(n_samples, dtype=tf.int32) * i
-        step_size = tf.constant(step_lr * (sigma / sigmas[-1]) ** 2, dtype=tf.float32)
+            print("Sigma = {} ({} / {})".format(sigma, j + 1, len(sigma_indices)))
+        labels = tf.ones(n_samples, dtype=tf.int32) * int(i)
+        if fixed_sigma is not None:
+            params = fixed_sigma[0](int(i))
+        step_size = tf.constant(scale * step_lr * (sigma / sigmas[-1]) ** 2, dtype=tf.float32)
         for s in range(n_steps_each):
             noise = tf.random.normal([n_samples] + list(data_shape)) * tf.math.sqrt(step_size * 2)
-            grad = model([x_mod, labels], training=True)
+            if fixed_sigma is not None:
+                grad = fixed_sigma[1](x_mod, params)
+            else:
+                grad = model([x_mod, labels], training=True)
             x_mod = x_mod + step_size * grad + noise
         if return_arr:
-            x_arr = np.concatenate((x_arr, tf.expand_dims(x_mod, axis=0).numpy()), axis=0)
+            x_arr[j + 1] = x_mod.numpy()
 
     if return_arr:
         return x_arr
@@ -1,6 +1,11 @@
 import numpy as np
 import tensorflow as tf
 from ncsn.utils import *
+from ncsn.schedule import inference_schedule
+from ncsn.export import ExportedScoreModel, is_exported_model
+from ncsn.sampler import ModelScore, get_sampler, shard_ranges, SAMPLERS
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
 from train_utils import *
 import argparse
 import time
@@ -21,29 +26,7 @@ def setUp_optimizer(args):
     return optimizer
 
 
-def main(args):
-
-    if args.config is not None:
-        new_args = get_config(args.config)
-        new_args.dataset = args.dataset
-        new_args.filename = args.filename
-        new_args.RESTORE = args.RESTORE
-        new_args.n_samples = args.n_samples
-        args = new_args
-
-    # Print parameters
-    print("SAMPLING PARAMETERS")
-    params_dict = vars(args)
-    template = '\t '
-    for k, v in params_dict.items():
-        template += '{} = {} \n\t '.format(k, v)
-    print(template)
-    print("_" * 100)
-
-    sigmas_np = get_sigmas(args.sigma1, args.sigmaL, args.num_classes)
-    sigmas_tf = tf.constant(sigmas_np, dtype=tf.float32)
-
-    # data paramaters
+def set_data_params(args):
     if args.dataset == 'mnist':
         args.data_shape = [32, 32, 1]
         args.data_type = "image"
@@ -66,6 +49,8 @@ def main(args):
         else:
             raise ValueError("scale should be 'power' or 'dB'")
 
+
+def post_processing_fn(args):
     def post_processing(x):
         if args.use_logit:
             x = 1. / (1. + np.exp(-x))
@@ -78,8 +63,26 @@ def main(args):
             x = np.clip(x, args.minval, args.maxval)
         return x
 
-    # Restore Model
+    return post_processing
+
+
+def init_fn(args):
+    def init(n):
+        x_mod = tf.random.uniform(shape=[n] + args.data_shape)
+        if args.use_logit:
+            x_mod = (1. - 2 * args.alpha) * x_mod + args.alpha
+            x_mod = tf.math.log(x_mod) - tf.math.log(1. - x_mod)
+        return x_mod
+
+    return init
+
+
+def load_model(args, sigmas_tf):
     abs_restore_path = os.path.abspath(args.RESTORE)
+    if is_exported_model(abs_restore_path):
+        # frozen model from export_score_model.py
+        return ExportedScoreModel(abs_restore_path)
+
     if args.version == 'v2':
         model = get_uncompiled_model_v2(args, sigmas=sigmas_tf)
     else:
@@ -90,30 +93,105 @@ def main(args):
     ckpt = tf.train.Checkpoint(variables=model.variables, optimizer=optimizer)
     status = ckpt.restore(abs_restore_path)
     status.assert_existing_objects_matched()
-    print("Weights loaded")
+    return model
 
-    print("Start Generating {} samples....".format(args.n_samples))
-    t0 = time.time()
-    x_mod = tf.random.uniform(shape=[args.n_samples] + args.data_shape)
-    if args.use_logit:
-        x_mod = (1. - 2 * args.alpha) * x_mod + args.alpha
-        x_mod = tf.math.log(x_mod) - tf.math.log(1. - x_mod)
-    x_arr = anneal_langevin_dynamics(x_mod, args.data_shape, model, args.n_samples, sigmas_np,
-                                     n_steps_each=args.T, step_lr=args.step_lr,
-                                     return_arr=True, verbose=True)
-    x_arr = post_processing(x_arr)
-    print("Done. Duration: {} seconds".format(round(time.time() - t0, 2)))
-    print("Shape: {}".format(x_arr.shape))
+
+def generate_shard(args, start, stop, output_path, n_threads=None):
+    """
+    Generate the chains [start, stop) and write their trajectory into the .npy file output_path
+    Run in a worker process: the model is restored in the process and the graph is traced there.
+    """
+    if n_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    if args.seed is not None:
+        tf.random.set_seed(args.seed + start)
+
+    sigmas_np = get_sigmas(args.sigma1, args.sigmaL, args.num_classes)
+    model = load_model(args, tf.constant(sigmas_np, dtype=tf.float32))
+    sigma_indices, step_scales = inference_schedule(sigmas_np, n_levels=args.n_levels, spacing=args.spacing,
+                                                    max_scale=args.max_step_scale)
+    # step_lr is the step size of the Langevin dynamics: the consistent annealed sampling follows the noise schedule
+    step_lr = args.step_lr if args.sampler == 'ald' else None
+    sampler = get_sampler(args.sampler, sigmas_np, n_steps_each=args.T, step_lr=step_lr, sigma_indices=sigma_indices,
+                          step_scales=step_scales, n_corrector=args.n_corrector, snr=args.snr, denoise=args.denoise)
+
+    trajectory = np.load(output_path, mmap_mode='r+')
+    sampler.sample_chains(ModelScore(model), init_fn(args), stop - start, args.batch_size, args.data_shape,
+                          trajectory=trajectory[:, start:stop], transform=post_processing_fn(args),
+                          verbose=args.n_workers == 1)
+    trajectory.flush()
+    return start, stop
+
+
+def main(args):
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.dataset = args.dataset
+        new_args.filename = args.filename
+        new_args.RESTORE = args.RESTORE
+        new_args.n_samples = args.n_samples
+        new_args.n_levels = args.n_levels
+        new_args.spacing = args.spacing
+        new_args.max_step_scale = args.max_step_scale
+        new_args.batch_size = args.batch_size
+        new_args.n_workers = args.n_workers
+        new_args.seed = args.seed
+        new_args.sampler = args.sampler
+        new_args.n_corrector = args.n_corrector
+        new_args.snr = args.snr
+        new_args.denoise = args.denoise
+        args = new_args
+
+    # Print parameters
+    print("SAMPLING PARAMETERS")
+    params_dict = vars(args)
+    template = '\t '
+    for k, v in params_dict.items():
+        template += '{} = {} \n\t '.format(k, v)
+    print(template)
+    print("_" * 100)
+
+    sigmas_np = get_sigmas(args.sigma1, args.sigmaL, args.num_classes)
+
+    # data paramaters
+    set_data_params(args)
+
+    abs_restore_path = os.path.abspath(args.RESTORE)
+    args.RESTORE = abs_restore_path
+    if args.batch_size is None:
+        args.batch_size = args.n_samples
     if args.filename is None:
         args.filename, ckpt_name = os.path.split(abs_restore_path)
-
         args.filename = os.path.join(args.filename, "generated_samples" + '_' + ckpt_name)
-    try:
-        np.save(args.filename, x_arr)
-        print("Generated Samples saved at {}".format(args.filename + ".npy"))
-    except FileNotFoundError:
-        np.save("generated_samples", x_arr)
-        print("Generated Samples saved at {}".format("generated_samples.npy"))
+    output_path = args.filename + ".npy"
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output_path))):
+        output_path = "generated_samples.npy"
+
+    # the trajectory is written in place by the workers
+    sigma_indices, _ = inference_schedule(sigmas_np, n_levels=args.n_levels, spacing=args.spacing,
+                                          max_scale=args.max_step_scale)
+    trajectory_shape = [len(sigma_indices) + 1, args.n_samples] + args.data_shape
+    trajectory = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=tuple(trajectory_shape))
+    del trajectory
+
+    print("Start Generating {} samples with the {} sampler....".format(args.n_samples, args.sampler))
+    t0 = time.time()
+    shards = shard_ranges(args.n_samples, args.n_workers)
+    if len(shards) == 1:
+        generate_shard(args, 0, args.n_samples, output_path)
+    else:
+        # TensorFlow is not fork safe: the workers are spawned
+        n_threads = max(1, (os.cpu_count() or 1) // len(shards))
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(generate_shard, args, start, stop, output_path, n_threads) for start, stop in shards]
+            for future in as_completed(futures):
+                start, stop = future.result()
+                print("Chains {} - {} done".format(start, stop))
+    print("Done. Duration: {} seconds".format(round(time.time() - t0, 2)))
+    print("Shape: {}".format(trajectory_shape))
+    print("Generated Samples saved at {}".format(output_path))
 
 
 if __name__ == '__main__':
@@ -133,6 +211,30 @@ if __name__ == '__main__':
 
     parser.add_argument("--n_samples", type=int, default=32,
                         help="Number of samples to generate")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Number of chains run together by each worker. By default all of them")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        help="Number of processes the chains are sharded across (multi-core CPU hosts)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed. Each shard uses seed + index of its first chain")
+
+    # inference schedule
+    parser.add_argument("--n_levels", type=int, default=None,
+                        help="Number of noise levels visited (sub-sampled from the training schedule). By default all of them")
+    parser.add_argument("--spacing", type=str, default="uniform",
+                        help="uniform or quadratic (denser at the low noise levels)")
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedule (default: no bound)")
+
+    # sampler
+    parser.add_argument("--sampler", type=str, default="ald", choices=SAMPLERS,
+                        help="ald (annealed Langevin dynamics), pc (predictor-corrector) or cas (consistent annealed sampling)")
+    parser.add_argument("--n_corrector", type=int, default=1,
+                        help="Number of corrector steps per noise level (pc)")
+    parser.add_argument("--snr", type=float, default=0.16,
+                        help="Signal to noise ratio of the corrector steps (pc)")
+    parser.add_argument("--denoise", action="store_true",
+                        help="End with a denoising step x + sigma_L^2 * score(x)")
 
     # config
     parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
@@ -145,7 +247,7 @@ if __name__ == '__main__':
     parser.add_argument("--T", type=int, default=100,
                         help="Number of step for each sigma in the Langevin Dynamics")
     parser.add_argument("--step_lr", type=float, default=2e-5,
-                        help="learning rate in the lengevin dynamics")
+                        help="learning rate in the lengevin dynamics (ald sampler)")
     parser.add_argument("--return_last_point", action="store_false",
                         help="Either to return array of every steps or just the last point")
 
@@ -0,0 +1,158 @@
+import numpy as np
+import tensorflow as tf
+from ncsn.utils import *
+from ncsn.precision import get_bfloat16_model, representative_dataset_fn, convert_to_int8, TFLiteScoreModel, score_accuracy
+from datasets import data_loader
+from train_utils import *
+import argparse
+import time
+import os
+import csv
+
+
+"""
+Script to build the reduced precision variants of a trained NCSN model (bfloat16 or int8)
+and check their score field against the float32 model at every noise level
+"""
+
+
+def time_forward(model, x, labels, n_runs=10):
+    model([x, labels], training=True)
+    t0 = time.time()
+    for _ in range(n_runs):
+        model([x, labels], training=True).numpy()
+    return (time.time() - t0) / n_runs
+
+
+def main(args):
+
+    abs_restore_path = os.path.abspath(args.RESTORE)
+    dataset = os.path.abspath(args.dataset)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.dataset = args.dataset
+        new_args.precision = args.precision
+        new_args.output = args.output
+        new_args.n_calibration = args.n_calibration
+        new_args.n_eval = args.n_eval
+        args = new_args
+
+    args.data_shape = [args.height, args.width, 1]
+    if args.scale == 'power':
+        args.maxval = 100.
+        args.minval = 1e-10
+    elif args.scale == 'dB':
+        args.maxval = 20.
+        args.minval = -100.
+    else:
+        raise ValueError("scale should be 'power' or 'dB'")
+
+    sigmas_np = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+    sigmas_tf = tf.constant(sigmas_np, dtype=tf.float32)
+
+    ds_train, ds_test, _, _, _ = data_loader.load_melspec_ds(dataset + '/train', dataset + '/test',
+                                                             shuffle=True, batch_size=None, mirrored_strategy=None)
+
+    # float32 model
+    if args.version == 'v1':
+        model = get_uncompiled_model(args)
+    else:
+        model = get_uncompiled_model_v2(args, sigmas=sigmas_tf)
+    optimizer = setUp_optimizer(None, args)
+    ckpt = tf.train.Checkpoint(variables=model.variables, optimizer=optimizer)
+    status = ckpt.restore(abs_restore_path)
+    status.assert_existing_objects_matched()
+    print("Weights loaded from {}".format(abs_restore_path))
+
+    t0 = time.time()
+    if args.precision == 'bfloat16':
+        reduced_model = get_bfloat16_model(args, sigmas_tf, model)
+    elif args.precision == 'int8':
+        output = args.output
+        if output is None:
+            output = abs_restore_path + '_int8.tflite'
+        representative_dataset = representative_dataset_fn(ds_train, sigmas_np, args.n_calibration, args.minval, args.maxval,
+                                                           use_logit=args.use_logit, alpha=args.alpha, seed=0)
+        convert_to_int8(model, args.data_shape, representative_dataset, output_path=output)
+        print("Quantized model saved at {}".format(output))
+        reduced_model = TFLiteScoreModel(output)
+    else:
+        raise ValueError("precision should be 'bfloat16' or 'int8'")
+    print("{} model ready in {} seconds".format(args.precision, round(time.time() - t0, 3)))
+
+    # accuracy of the score field on test spectrograms
+    x = np.array(list(ds_test.take(args.n_eval).as_numpy_iterator()), dtype=np.float32)
+    x = (x - args.minval) / (args.maxval - args.minval)
+    if args.use_logit:
+        x = x * (1. - 2 * args.alpha) + args.alpha
+        x = np.log(x) - np.log(1. - x)
+    results = score_accuracy(model, reduced_model, x, sigmas_np, seed=1)
+
+    print("sigma_idx \t sigma \t relative_error \t cosine_similarity")
+    for row in results:
+        print("{sigma_idx} \t {sigma:.4f} \t {relative_error:.5f} \t {cosine_similarity:.5f}".format(**row))
+    errors = [row['relative_error'] for row in results]
+    print("Relative error: mean = {:.5f} \t max = {:.5f} (sigma_idx {})".format(np.mean(errors), np.max(errors), int(np.argmax(errors))))
+
+    labels = tf.zeros(len(x), dtype=tf.int32)
+    duration_float = time_forward(model, x, labels)
+    duration_reduced = time_forward(reduced_model, x, labels)
+    print("Forward pass of {} spectrograms: float32 = {:.4f} s \t {} = {:.4f} s".format(len(x), duration_float, args.precision,
+                                                                                        duration_reduced))
+
+    report_path = abs_restore_path + '_{}_accuracy.csv'.format(args.precision)
+    with open(report_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("Accuracy report saved at {}".format(report_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Reduced precision NCSN model')
+
+    parser.add_argument('RESTORE', type=str, help='checkpoint of the trained model')
+    parser.add_argument('--dataset', type=str, required=True,
+                        help="directory of the tfrecords (with train/ and test/ folders)")
+    parser.add_argument('--precision', type=str, default='int8', help="bfloat16 or int8")
+    parser.add_argument('--output', type=str, default=None,
+                        help="path of the TFLite model (int8). Default: RESTORE_int8.tflite")
+    parser.add_argument('--n_calibration', type=int, default=500,
+                        help="Number of training spectrograms used to calibrate the int8 quantization")
+    parser.add_argument('--n_eval', type=int, default=16,
+                        help="Number of test spectrograms used to compare the scores")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # Model hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # Optimization parameters
+    parser.add_argument("--optimizer", type=str,
+                        default="adam", help="adam or adamax")
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=10**(-6),
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
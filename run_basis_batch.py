@@ -0,0 +1,345 @@
+import numpy as np
+import tensorflow as tf
+from datasets import data_loader
+import argparse
+import time
+import os
+import sys
+import collections
+from train_utils import *
+from ncsn.utils import *
+from run_basis_sep import build_models, restore_models, basis_outer_loop, basis_inner_loop_fn, \
+    mixing_process, post_processing_fn, set_melspec_params, preprocess_mixture, min_steps, apply_precision, \
+    build_model_banks, close_model_banks
+
+
+"""
+Script for running the BASIS algorithm on many songs in one process
+
+The extracts of the songs listed in a manifest are packed into batches of fixed size.
+The models are built, restored and traced once, then every batch goes through the same BASIS engine.
+The separated extracts are scattered back and saved per song as soon as the song is complete.
+"""
+
+
+def read_manifest(manifest_path):
+    """
+    Read a manifest file: one song directory per line. Empty lines and lines starting with # are skipped
+    Relative paths are relative to the manifest directory
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    song_dirs = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            song_dirs.append(os.path.join(manifest_dir, line))
+    return song_dirs
+
+
+def song_output_names(song_dirs):
+    """
+    Name of the output directory of each song: its path relative to the common parent directory of the songs
+    (the song directory name if every name is unique). Raise a ValueError if a song is listed twice
+    """
+    song_dirs = [os.path.normpath(os.path.abspath(song_dir)) for song_dir in song_dirs]
+    duplicates = [song_dir for song_dir, count in collections.Counter(song_dirs).items() if count > 1]
+    if len(duplicates) > 0:
+        raise ValueError("Songs listed several times in the manifest: {}".format(duplicates))
+    names = [os.path.basename(song_dir) for song_dir in song_dirs]
+    if len(set(names)) < len(names):
+        parent = os.path.commonpath([os.path.dirname(song_dir) for song_dir in song_dirs])
+        names = [os.path.relpath(song_dir, parent) for song_dir in song_dirs]
+    return names
+
+
+class SongResults(object):
+    """
+    Separated extracts of one song, saved into its output directory once every extract is separated
+    """
+
+    def __init__(self, song_dir, output_dir, mel_mix, stft_mixture, gt):
+        self.song_dir = song_dir
+        self.output_dir = output_dir
+        self.mel_mix = mel_mix
+        self.stft_mixture = stft_mixture
+        self.gt = gt
+        self.n_extract = len(mel_mix)
+        self.separated = [None] * self.n_extract
+        self.n_done = 0
+
+    def add(self, extract_idx, x):
+        self.separated[extract_idx] = x
+        self.n_done += 1
+
+    def is_complete(self):
+        return self.n_done == self.n_extract
+
+    def save(self):
+        try:
+            os.makedirs(self.output_dir)
+        except FileExistsError:
+            pass
+        x = np.stack(self.separated, axis=1)
+        results = {'x{}'.format(k + 1): x[k] for k in range(len(x))}
+        if self.gt is not None:
+            results.update({'gt{}'.format(k + 1): gt_k for k, gt_k in enumerate(self.gt)})
+        np.savez(os.path.join(self.output_dir, 'results'), mixed=self.mel_mix, stft_mixture=self.stft_mixture, **results)
+
+
+def load_song(song_dir, args, spec_params):
+    """
+    Compute the melspectrograms of every extract of a song (at most args.n_mixed if given)
+    The ground truth is computed if every source wav file is in song_dir
+    """
+    n_extract = -1 if args.n_mixed is None else args.n_mixed
+    mix_extracts = data_loader.load_song_extracts(os.path.join(song_dir, 'mix.wav'), spec_params['length_sec'],
+                                                  sr=spec_params['sr'], n_extract=n_extract)
+    mel_mix, stft_mixture = data_loader.extracts_to_melspec(mix_extracts, **spec_params)
+
+    source_paths = [os.path.join(song_dir, source + '.wav') for source in args.sources]
+    gt = None
+    if all([os.path.exists(path) for path in source_paths]):
+        gt = []
+        for path in source_paths:
+            extracts = data_loader.load_song_extracts(path, spec_params['length_sec'], sr=spec_params['sr'], n_extract=len(mix_extracts))
+            gt.append(data_loader.extracts_to_melspec(extracts, **spec_params)[0])
+
+    return mel_mix, np.array(stft_mixture), gt
+
+
+def main(args):
+
+    song_dirs = read_manifest(args.manifest)
+    output_names = song_output_names(song_dirs)
+    output_dirpath = os.path.abspath(args.output)
+    n_sources = len(args.RESTORE)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.manifest = args.manifest
+        new_args.debug = args.debug
+        new_args.eager = args.eager
+        new_args.adaptive = args.adaptive
+        new_args.min_T = args.min_T
+        new_args.tol = args.tol
+        new_args.learned_gains = args.learned_gains
+        new_args.gain_steps = args.gain_steps
+        new_args.n_levels = args.n_levels
+        new_args.spacing = args.spacing
+        new_args.max_step_scale = args.max_step_scale
+        new_args.precision = args.precision
+        new_args.output = args.output
+        new_args.sources = args.sources
+        new_args.model_type = args.model_type
+        new_args.batch_size = args.batch_size
+        new_args.n_mixed = args.n_mixed
+        new_args.bank_size = args.bank_size
+        new_args.prefetch = args.prefetch
+        args = new_args
+
+    # the script works from the output directory
+    args.RESTORE = [os.path.abspath(restore_path) for restore_path in args.RESTORE]
+    if len(args.sources) != n_sources:
+        raise ValueError("{} sources given for {} models".format(len(args.sources), n_sources))
+
+    sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+    if args.model_type == "glow":
+        args.restore_dicts = [{sigma: os.path.join(os.path.abspath(restore_path), "sigma_" + str(round(sigma, 2)), "tf_ckpts")
+                               for sigma in sigmas} for restore_path in args.RESTORE]
+    elif args.model_type == "ncsn":
+        args.restore_dicts = None
+    else:
+        raise ValueError("model_type should be 'ncsn' or 'glow'")
+    args.dataset = "melspec"
+    args.data_type = "melspec"
+    args.data_shape = [args.height, args.width, 1]
+    spec_params = set_melspec_params(args)
+
+    try:
+        os.mkdir(output_dirpath)
+    except FileExistsError:
+        pass
+    os.chdir(output_dirpath)
+
+    log_file = open('out.log', 'w')
+    if args.debug is False:
+        sys.stdout = log_file
+
+    params_dict = vars(args)
+    template = 'BASIS Batch Separation \n\t '
+    for k, v in params_dict.items():
+        template += '{} = {} \n\t '.format(k, v)
+    print(template)
+    print("{} songs to separate".format(len(song_dirs)))
+
+    # build, restore and trace the models once for every song
+    t_init = time.time()
+    models = build_models(args, sigmas)
+    optimizer = setUp_optimizer(None, args)
+    ckpts = restore_models(models, optimizer, args)
+    models = apply_precision(models, args, sigmas)
+    model_banks = build_model_banks(models, args, sigmas)
+
+    post_processing = post_processing_fn(args)
+    mixing_op = mixing_process(args)
+    inner_loop = basis_inner_loop_fn(models, sigmas, mixing_op, model_type=args.model_type, delta=2e-5, T=args.T,
+                                     monitor=args.debug,
+                                     adaptive=args.adaptive, min_T=min_steps(args), tol=args.tol)
+    print("Models ready in {} seconds".format(round(time.time() - t_init, 3)))
+
+    songs = {}
+    pending = []
+
+    def separate_batch(batch):
+        n_valid = len(batch)
+        mel_batch = np.array([mel for _, _, mel in batch])
+        # pad the last batch to keep the same shape (and the same trace)
+        if n_valid < args.batch_size:
+            padding = np.repeat(mel_batch[-1:], args.batch_size - n_valid, axis=0)
+            mel_batch = np.concatenate((mel_batch, padding), axis=0)
+
+        mixed = preprocess_mixture(tf.cast(np.expand_dims(mel_batch, axis=-1), tf.float32), args)
+        x = tf.random.uniform([n_sources] + list(mixed.shape), dtype=tf.float32)
+        x, _ = basis_outer_loop(mixed, x, models, optimizer, sigmas, ckpts, args, None,
+                                return_arr=False, inner_loop=inner_loop, model_banks=model_banks,
+                                mixing_op=mixing_op)
+        x = post_processing(x.numpy().squeeze(axis=-1))
+
+        for i, (song_idx, extract_idx, _) in enumerate(batch):
+            song = songs[song_idx]
+            song.add(extract_idx, x[:, i])
+            if song.is_complete():
+                song.save()
+                print("Song {} saved at {}".format(song.song_dir, song.output_dir))
+                del songs[song_idx]
+
+    n_batches = 0
+    for song_idx, song_dir in enumerate(song_dirs):
+        t0 = time.time()
+        mel_mix, stft_mixture, gt = load_song(song_dir, args, spec_params)
+        if len(mel_mix) == 0:
+            print("{} is too short to be separated. Skipped".format(song_dir))
+            continue
+        output_dir = os.path.join(output_dirpath, output_names[song_idx])
+        # same scale as the mixture saved by run_basis_sep.py
+        mixed = post_processing(preprocess_mixture(tf.cast(mel_mix, tf.float32), args).numpy())
+        songs[song_idx] = SongResults(song_dir, output_dir, mixed, stft_mixture, gt)
+        pending += [(song_idx, i, mel) for i, mel in enumerate(mel_mix)]
+        print("{} extracts loaded from {} in {} seconds".format(len(mel_mix), song_dir, round(time.time() - t0, 3)))
+
+        while len(pending) >= args.batch_size:
+            t0 = time.time()
+            separate_batch(pending[:args.batch_size])
+            pending = pending[args.batch_size:]
+            n_batches += 1
+            print("Batch {} separated in {} seconds".format(n_batches, round(time.time() - t0, 3)))
+
+    if len(pending) > 0:
+        t0 = time.time()
+        separate_batch(pending)
+        n_batches += 1
+        print("Batch {} separated in {} seconds".format(n_batches, round(time.time() - t0, 3)))
+
+    close_model_banks(model_banks)
+
+    print("{} songs separated in {} batches. Duration: {} seconds".format(len(song_dirs), n_batches, round(time.time() - t_init, 3)))
+
+    log_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='BASIS Separation of many songs')
+    parser.add_argument('RESTORE', type=str, nargs='+',
+                        help='directories of the saved models: one per source')
+    parser.add_argument('--manifest', type=str, required=True,
+                        help='text file with one song directory per line. Each directory should contain mix.wav')
+
+    parser.add_argument('--output', type=str, default='basis_sep_batch',
+                        help='output dirpath for savings. The results of each song are saved in a sub-directory')
+    parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--eager', action="store_true",
+                        help="Run the inner loop eagerly instead of the graph-compiled tf.while_loop")
+
+    parser.add_argument("--sources", type=str, nargs='+', default=['piano', 'violin'],
+                        help="names of the sources, in the order of the models. Used as ground truth if the wav files exist")
+    # Model type
+    parser.add_argument("--model_type", type=str, default="ncsn")
+
+    # Batch parameters
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help="number of extracts separated at once (shared between songs)")
+    parser.add_argument('--n_mixed', type=int, default=None,
+                        help="maximum number of extracts per song. By default the whole songs are separated")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # BASIS hyperparameters
+    parser.add_argument("--T", type=int, default=100,
+                        help="Number of iteration in the inner loop")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Move to the next noise level once the residual and the update norm plateau")
+    parser.add_argument("--min_T", type=int, default=None,
+                        help="Minimum number of iterations per noise level with --adaptive (default: T // 10)")
+    parser.add_argument("--tol", type=float, default=1e-3,
+                        help="Relative change under which the statistics are considered on a plateau with --adaptive")
+    parser.add_argument("--learned_gains", action="store_true",
+                        help="Mix the sources with one gain per source, fitted to the mixture after every noise level")
+    parser.add_argument("--gain_steps", type=int, default=100,
+                        help="Number of Adam steps fitting the mixing gains after every noise level with --learned_gains")
+
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # inference schedule
+    parser.add_argument("--n_levels", type=int, default=None,
+                        help="Number of noise levels visited (sub-sampled from the training schedule). By default all of them")
+    parser.add_argument("--spacing", type=str, default="uniform",
+                        help="uniform or quadratic (denser at the low noise levels)")
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedule (default: no bound)")
+
+    # Model hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--precision', type=str, default='float32',
+                        help="float32, bfloat16 or int8 (RESTORE paths are TFLite files from quantize_ncsn.py)")
+
+    # Glow hyperparameters
+    parser.add_argument('--L', default=3, type=int,
+                        help='Depth level')
+    parser.add_argument('--K', type=int, default=32,
+                        help="Number of Step of Flow in each Block")
+    parser.add_argument('--l2_reg', type=float, default=None,
+                        help="L2 regularization for the coupling layer")
+    parser.add_argument("--bank_size", type=int, default=None,
+                        help="Number of noise levels kept in memory per model. By default every level is loaded at start")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Load the weights of the next noise level on a background thread")
+
+    # Optimization parameters
+    parser.add_argument("--optimizer", type=str,
+                        default="adam", help="adam or adamax")
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=10**(-6),
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
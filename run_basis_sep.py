@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
 from flow_models import flow_builder
+from flow_models.model_bank import ModelBank
 from datasets import data_loader
 from librosa.display import specshow
 import librosa
@@ -10,10 +11,19 @@ import argparse
 import time
 import os
 import sys
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import soundfile as sf
 from train_utils import *
 from ncsn.utils import *
+from ncsn.schedule import inference_schedule
+from ncsn.precision import get_bfloat16_model, TFLiteScoreModel
+from ncsn.export import ExportedScoreModel, is_exported_model
+from ncsn.grouped import grouped_score_fn
+from mixing_operators import get_mixing_operator, LearnedGainMixing
+from griffin_lim import GriffinLim
+from datasets.spectral import get_spectral_transform
+from ncsn.sampler import AnnealedLangevinSampler, PosteriorScore, get_sampler, SAMPLERS
 tfd = tfp.distributions
 tfb = tfp.bijectors
 tfk = tf.keras
@@ -38,40 +48,40 @@ def restore_checkpoint(ckpt, restore_path, model, optimizer, latest=True):
     return ckpt
 
 
-def image_grid(n_display, x, y, z, data_type="image", separation=True, **kwargs):
+def image_grid(n_display, *columns, data_type="image", separation=True, **kwargs):
     # Create a figure to contain the plot.
-    f, axes = plt.subplots(nrows=n_display, ncols=3, figsize=(6, 8))
-    if data_type == 'image' and x.shape[-1] == 1:
+    # The figure is not managed by pyplot: it can be rendered on the thread of train_utils.AsyncSummaryWriter
+    n_columns = len(columns)
+    f = Figure(figsize=(2 * n_columns, 8))
+    FigureCanvasAgg(f)
+    axes = f.subplots(nrows=n_display, ncols=n_columns, squeeze=False)
+    if data_type == 'image' and columns[0].shape[-1] == 1:
         cmap = 'binary'
     else:
         cmap = None
     for i in range(n_display):
-        ax1, ax2, ax3 = axes[i]
-        if data_type == "image":
-            ax1.imshow(x[i].squeeze(), cmap=cmap)
-            ax2.imshow(y[i].squeeze(), cmap=cmap)
-            ax3.imshow(z[i].squeeze(), cmap=cmap)
-            ax1.set_axis_off()
-            ax2.set_axis_off()
-            ax3.set_axis_off()
-        else:
-            specshow(x[i].squeeze(), sr=kwargs["sampling_rate"],
-                     ax=ax1, x_axis='off', y_axis='off', fmin=kwargs["fmin"], fmax=kwargs["fmax"])
-            specshow(y[i].squeeze(), sr=kwargs["sampling_rate"],
-                     ax=ax2, x_axis='off', y_axis='off', fmin=kwargs["fmin"], fmax=kwargs["fmax"])
-            specshow(z[i].squeeze(), sr=kwargs["sampling_rate"],
-                     ax=ax3, x_axis='off', y_axis='off', fmin=kwargs["fmin"], fmax=kwargs["fmax"])
-
+        for ax, column in zip(axes[i], columns):
+            if data_type == "image":
+                ax.imshow(column[i].squeeze(), cmap=cmap)
+                ax.set_axis_off()
+            else:
+                specshow(column[i].squeeze(), sr=kwargs["sampling_rate"],
+                         ax=ax, x_axis='off', y_axis='off', fmin=kwargs["fmin"], fmax=kwargs["fmax"])
+
+    components = ' + '.join(['Component {}'.format(k + 1) for k in range(n_columns - 1)])
     if separation:
-        title = "Separation: Mixture = Component 1 + Component 2"
+        title = "Separation: Mixture = " + components
     else:
-        title = "Mixing: Component 1 + Component 2 = Mixture"
+        title = "Mixing: " + components + " = Mixture"
     f.suptitle(title)
     return f
 
 
 @tf.function
 def compute_grad_logprob(inputs, model):
+    if isinstance(model, ExportedScoreModel):
+        # the gradient is part of the exported graph
+        return model.score(inputs)
     with tf.GradientTape() as tape:
         tape.watch(inputs)
         loss = model.log_prob(inputs)
@@ -96,195 +106,673 @@ def post_processing_fn(args):
     return post_processing
 
 
-def spectrogram_inversion(melspec, sr, fmin, fmax, use_db=True):
-    if use_db:
-        melspec = librosa.db_to_power(melspec)
-    inv_melspec = librosa.feature.inverse.mel_to_audio(melspec, sr=sr, fmin=fmin, fmax=fmax)
-    return inv_melspec
+def spectrogram_inversion(melspecs, sr, fmin, fmax, use_db=True, stft_mixture=None, n_iter=32, chunk_frames=512):
+    """
+    Inverse the melspectrograms [K, n_mels, frames] of the K sources in one batch
+    with the fast Griffin-Lim algorithm (see griffin_lim.py)
 
+    stft_mixture: STFT of the mixture [1 + n_fft // 2, frames]. Its phase is the initial phase of every source
+        (random phases if None)
+    chunk_frames: the spectrograms are inverted by overlapping chunks of chunk_frames frames
 
-def mixing_process(args):
-    if args.data_type == 'image':
-        def g(*sources):
-            sources = tf.stack(sources, axis=0)
-            return tf.reduce_mean(sources, axis=0, dtype=np.float32)
+    Returns:
+        ndarray [K, length]
+    """
+    if use_db:
+        melspecs = librosa.db_to_power(melspecs)
+    transform = get_spectral_transform(sr, n_mels=melspecs.shape[-2], fmin=fmin, fmax=fmax)
+    magnitudes = transform.mel_to_stft(melspecs)
+    init_phase = None if stft_mixture is None else np.angle(stft_mixture)
+    griffin_lim = GriffinLim(n_iter=n_iter, chunk_frames=chunk_frames, transform=transform)
+    audio, n_iter = griffin_lim(magnitudes, init_phase=init_phase)
+    print("Griffin-Lim iterations to convergence: {}".format(list(n_iter)))
+    return audio
 
-        def grad_g(*sources):
-            K = len(sources)
-            sources = tf.stack(sources, axis=0)
-            grad_sources = tf.ones_like(sources, dtype=np.float32) / float(K)
-            return tf.unstack(grad_sources, K, axis=0)
 
-    else:
-        if args.scale == 'power':
-            def g(*sources):
-                sources = tf.stack(sources, axis=0)
-                return tf.reduce_mean(tf.math.sqrt(sources), axis=0, dtype=np.float32)**2
-
-            def grad_g(*sources):
-                K = len(sources)
-                sources = tf.stack(sources, axis=0)
-                grad_sources = (1 / (tf.math.sqrt(sources) + 1e-8))
-                grad_sources *= tf.reduce_mean(tf.math.sqrt(sources), axis=0, dtype=np.float32, keepdims=True) ** 2
-                return tf.unstack(grad_sources, K, axis=0)
+def mixing_process(args):
+    """
+    Mixing operator of the data (see mixing_operators)
+
+    It takes the sources stacked in one [K, N, H, W, C] tensor and returns in one call the mixture [N, H, W, C],
+    the residual with the observed mixture and the gradient with respect to each source [K, N, H, W, C]
+    With args.learned_gains, the sources are mixed with one gain per source, fitted by basis_outer_loop
+    """
+    return get_mixing_operator(args.data_type, args.scale, n_sources=len(args.RESTORE),
+                               learned_gains=getattr(args, 'learned_gains', False))
+
+
+def stacked_score_fn(models, model_type='ncsn', grouped=False):
+    """
+    Evaluate K score models on sources packed into one tensor
+
+    If every source uses the same model (same restore path, see build_models), the sources are concatenated
+    along the batch axis and evaluated by that model in a single forward pass.
+    Otherwise the models are called one after the other, unless grouped is True: NCSN v2 models with the same
+    architecture are then evaluated as one grouped network on the packed [K * N, H, W, C] batch with their weights
+    stacked (see ncsn.grouped). The grouped convolutions are matmuls of image patches: they hold a patch tensor
+    9 times larger than the activations and do not use the Conv2D kernels, compare both with benchmark_grouped_score.py.
+
+    The conditioning of the models is computed once per noise level by conditioning, outside the Langevin steps.
+    For NCSN v1 models it holds the affine params of the conditional normalizations (see fixed_sigma_score_fn),
+    otherwise the sigma indices.
+
+    Parameters:
+        models: list of K models
+        model_type: 'ncsn' or 'glow'
+        grouped: evaluate distinct NCSN v2 models as one grouped network
+
+    Returns:
+        score: function
+            (x, cond) -> scores
+            x: [K, N, H, W, C] tensor, cond: output of conditioning
+        conditioning: function
+            (sigma_idx, n_mixed) -> cond
+    """
+    K = len(models)
+    shared_model = all(model is models[0] for model in models)
+    fixed_sigma = [fixed_sigma_score_fn(model) if model_type == 'ncsn' else None for model in models]
+    use_fixed_sigma = all(fs is not None for fs in fixed_sigma)
+    grouped_score = None
+    if grouped and model_type == 'ncsn' and not shared_model and not use_fixed_sigma:
+        grouped_score = grouped_score_fn(models)
+
+    def conditioning(sigma_idx, n_mixed):
+        if use_fixed_sigma:
+            if shared_model:
+                return [fixed_sigma[0][0](sigma_idx)] * K
+            return [prepare(sigma_idx) for prepare, _ in fixed_sigma]
+        return tf.ones(shape=(K, n_mixed), dtype=tf.int32) * sigma_idx
+
+    def score(x, cond):
+        if shared_model:
+            x_flat = tf.reshape(x, tf.concat([[-1], tf.shape(x)[2:]], axis=0))
+            if model_type != 'ncsn':
+                scores = compute_grad_logprob(x_flat, models[0])
+            elif use_fixed_sigma:
+                # the params broadcast over the concatenated batch
+                scores = fixed_sigma[0][1](x_flat, cond[0])
+            else:
+                scores = models[0]([x_flat, tf.reshape(cond, [-1])], training=True)
+            return tf.reshape(scores, tf.shape(x))
+
+        if grouped_score is not None:
+            return grouped_score(x, cond)
+
+        xs = tf.unstack(x, K, axis=0)
+        if model_type != 'ncsn':
+            scores = [compute_grad_logprob(x_k, model) for model, x_k in zip(models, xs)]
+        elif use_fixed_sigma:
+            scores = [fs[1](x_k, cond_k) for fs, x_k, cond_k in zip(fixed_sigma, xs, cond)]
         else:
-            def g(*sources):
-                K = len(sources)
-                sources = tf.stack(sources, axis=0)
-                # if sum in amplitude:
-                # mixing = (20. / tf.math.log(10.)) * (tf.math.reduce_logsumexp(sources * tf.math.log(10.) / 20., axis=0) - tf.math.log(float(K)))
-                # if sum in power:
-                mixing = (10. / tf.math.log(10.)) * (tf.math.reduce_logsumexp(sources * tf.math.log(10.) / 10., axis=0) - tf.math.log(float(K)))
-                return mixing
-
-            def grad_g(*sources):
-                K = len(sources)
-                sources = tf.stack(sources, axis=0)
-                # if sum in amplitude:
-                # grad_sources = tf.nn.softmax(sources * tf.math.log(10.) / 20., axis=0)
-                # if sum in power:
-                grad_sources = tf.nn.softmax(sources * tf.math.log(10.) / 10., axis=0)
-                return tf.unstack(grad_sources, K, axis=0)
-
-    return g, grad_g
-
-
-def basis_inner_loop(mixed, x1, x2, model1, model2, sigma_idx, sigmas, g, grad_g, post_processing,
+            labels = tf.unstack(cond, K, axis=0)
+            scores = [model([x_k, labels_k], training=True) for model, x_k, labels_k in zip(models, xs, labels)]
+        return tf.stack(scores, axis=0)
+
+    return score, conditioning
+
+
+def first_nan_step(nan_step, t, *tensors):
+    """
+    Fused on-device NaN check: return t if one of the tensors has a NaN and no NaN was found before, else nan_step
+    Reading the result is the only host sync, so it can be done once after the loop
+    """
+    has_nan = tf.reduce_any(tf.stack([tf.reduce_any(tf.math.is_nan(tensor)) for tensor in tensors]))
+    return tf.where(tf.logical_and(nan_step < 0, has_nan), tf.cast(t, tf.int32), nan_step)
+
+
+def components_summary(mixed, x, step, post_processing, n_display=5, **kwargs):
+    """
+    Plot the first n_display mixtures and separated sources into TensorBoard
+    Meant to be run by train_utils.AsyncSummaryWriter: the host transfers and the rendering happen on its thread
+    """
+    sample_mix = post_processing(mixed[:n_display].numpy())
+    samples = post_processing(x[:, :n_display].numpy())
+    figure = image_grid(min(n_display, len(sample_mix)), sample_mix, *samples, separation=True, **kwargs)
+    tf.summary.image("Components", train_utils.plot_to_image(figure),
+                     max_outputs=50, step=step)
+
+
+def components_stats(x, grad_mixing):
+    x_np = x.numpy()
+    grad_mixing_np = grad_mixing.numpy()
+    for k in range(len(x_np)):
+        print("x{} stats: mean = {} \t std = {} \t min = {} \t max = {}".format(k + 1, x_np[k].mean(), x_np[k].std(),
+                                                                             x_np[k].min(), x_np[k].max()))
+        print("grad_mixing_x{} stats: mean = {} \t std = {} \t min = {} \t max = {}".format(k + 1, grad_mixing_np[k].mean(),
+                                                                                           grad_mixing_np[k].std(),
+                                                                                           grad_mixing_np[k].min(),
+                                                                                           grad_mixing_np[k].max()))
+
+
+def convergence_update(t, stats, residual, update, min_T, tol, beta=0.9):
+    """
+    Plateau test of the adaptive inner loop
+
+    stats: [2] tensor, moving averages of the reconstruction residual mean(|mixed - g(x)|)
+        and of the drift norm mean(|x_{t+1} - x_t - noise|)
+    The level has converged once both moving averages change by less than tol (relative) in one step
+    and at least min_T steps were done.
+
+    Returns:
+        stats: updated moving averages
+        converged: bool tensor
+    """
+    new_stats = tf.stack([residual, update])
+    ema = tf.where(tf.equal(t, 0), new_stats, beta * stats + (1. - beta) * new_stats)
+    plateau = tf.reduce_all(tf.abs(ema - stats) <= tol * tf.abs(stats))
+    converged = tf.logical_and(tf.logical_and(t > 0, t + 1 >= min_T), plateau)
+    return ema, converged
+
+
+def basis_inner_loop(mixed, x, models, sigma_idx, sigmas, mixing_op, post_processing,
                      model_type='ncsn', delta=2e-5, T=100, debug=True,
-                     train_summary_writer=None, step=None, **kwargs):
-
-    full_data_shape = list(mixed.shape)
-    n_mixed = full_data_shape[0]
+                     summary=None, step=None, adaptive=False, min_T=1, tol=1e-3, step_scale=1., grouped=False, **kwargs):
+    """
+    Eager BASIS inner loop: T Langevin steps at the noise level sigmas[sigma_idx]
+
+    x: [K, N, H, W, C] tensor of the current source estimates
+    step_scale: scale of the step size (see ncsn.schedule.step_scales)
+    grouped: evaluate distinct NCSN v2 models as one grouped network (see stacked_score_fn)
+    summary: train_utils.AsyncSummaryWriter, the sources are plotted every T // 5 steps
+    adaptive: if True, stop before T steps once the loop has converged (see convergence_update)
+
+    Returns:
+        x: [K, N, H, W, C] tensor
+        nan_step: int32 tensor, first step with a NaN (-1 if none). Only computed in debug mode
+        n_steps: number of steps done
+    """
+    full_data_shape = list(x.shape)
+    n_mixed = full_data_shape[1]
     sigma = sigmas[sigma_idx]
     sigmaL = sigmas[-1]
-    eta = tf.constant(delta * (sigma / sigmaL) ** 2, dtype=tf.float32)
+    eta = tf.constant(step_scale * delta * (sigma / sigmaL) ** 2, dtype=tf.float32)
     lambda_recon = 1.0 / (sigma ** 2)
+    score, conditioning = stacked_score_fn(models, model_type=model_type, grouped=grouped)
+    cond = conditioning(sigma_idx, n_mixed)
+    summary_interval = max(T // 5, 1)
+    nan_step = tf.constant(-1, dtype=tf.int32)
+    stats = tf.zeros([2], dtype=tf.float32)
+    n_steps = T
     for t in range(T):
-        epsilon1 = tf.math.sqrt(2. * eta) * tf.random.normal(full_data_shape, dtype=tf.float32)
-        epsilon2 = tf.math.sqrt(2. * eta) * tf.random.normal(full_data_shape, dtype=tf.float32)
-
-        if model_type == 'ncsn':
-            inputs1 = [x1, tf.ones(shape=(n_mixed,), dtype=tf.int32) * sigma_idx]
-            inputs2 = [x2, tf.ones(shape=(n_mixed,), dtype=tf.int32) * sigma_idx]
-            grad_logprob1 = model1(inputs1, training=True)
-            grad_logprob2 = model2(inputs2, training=True)
-        else:
-            inputs1 = x1
-            inputs2 = x2
-            grad_logprob1 = compute_grad_logprob(inputs1, model1)
-            grad_logprob2 = compute_grad_logprob(inputs2, model2)
+        epsilon = tf.math.sqrt(2. * eta) * tf.random.normal(full_data_shape, dtype=tf.float32)
 
-        mixing = g(x1, x2)
-        grad_mixing_x1, grad_mixing_x2 = grad_g(x1, x2)
+        grad_logprob = score(x, cond)
+        mixing, residual, grad_mixing = mixing_op(x, mixed)
 
-        x1 = x1 + eta * (grad_logprob1 + lambda_recon * grad_mixing_x1 * (mixed - mixing)) + epsilon1
-        x2 = x2 + eta * (grad_logprob2 + lambda_recon * grad_mixing_x2 * (mixed - mixing)) + epsilon2
+        drift = eta * (grad_logprob + lambda_recon * grad_mixing * residual)
+        x = x + drift + epsilon
 
         if debug:
             print('step : {} / {}'.format(t, T))
-            assert bool(tf.math.is_nan(grad_logprob1).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(grad_logprob2).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(grad_mixing_x1).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(grad_mixing_x2).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(mixing).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(x1).numpy().any()) is False, (sigma, t)
-            assert bool(tf.math.is_nan(x2).numpy().any()) is False, (sigma, t)
-
-        if (train_summary_writer is not None) and (t % (T // 5) == 0):
+            nan_step = first_nan_step(nan_step, t, grad_logprob, grad_mixing, mixing, x)
+
+        if (summary is not None) and (t % summary_interval == 0):
             print('step : {} / {}'.format(t, T))
             if debug:
-                x1_np = x1.numpy()
-                x2_np = x2.numpy()
-                grad_mixing_x1_np = grad_mixing_x1.numpy()
-                grad_mixing_x2_np = grad_mixing_x2.numpy()
-                print("x1 stats: mean = {} \t std = {} \t min = {} \t max = {}".format(x1_np.mean(), x1_np.std(), x1_np.min(), x1_np.max()))
-                print("x2 stats: mean = {} \t std = {} \t min = {} \t max = {}".format(x2_np.mean(), x2_np.std(), x2_np.min(), x2_np.max()))
-                print("grad_mixing_x1 stats: mean = {} \t std = {} \t min = {} \t max = {}".format(grad_mixing_x1_np.mean(), grad_mixing_x1_np.std(),
-                                                                                                   grad_mixing_x1_np.min(), grad_mixing_x1_np.max()))
-                print("grad_mixing_x1 stats: mean = {} \t std = {} \t min = {} \t max = {}".format(grad_mixing_x2_np.mean(), grad_mixing_x2_np.std(),
-                                                                                                   grad_mixing_x2_np.min(), grad_mixing_x2_np.max()))
-            with train_summary_writer.as_default():
-                sample_mix = post_processing(mixed.numpy())
-                sample_x1 = post_processing(x1.numpy())
-                sample_x2 = post_processing(x2.numpy())
-                figure = image_grid(5, sample_mix, sample_x1, sample_x2, separation=True, **kwargs)
-                tf.summary.image("Components", train_utils.plot_to_image(figure),
-                                 max_outputs=50, step=step + t)
-
-    return x1, x2
-
-
-def basis_outer_loop(mixed, x1, x2, model1, model2, optimizer, sigmas,
-                     ckpt1, ckpt2, args, train_summary_writer):
-
+                summary.submit(components_stats, x, grad_mixing)
+            summary.submit(components_summary, mixed, x, step + t, post_processing, **kwargs)
+
+        if adaptive:
+            stats, converged = convergence_update(t, stats, tf.reduce_mean(tf.abs(residual)),
+                                                  tf.reduce_mean(tf.abs(drift)), min_T, tol)
+            if bool(converged):
+                n_steps = t + 1
+                break
+
+    return x, nan_step, n_steps
+
+
+def basis_inner_loop_fn(models, sigmas, mixing_op, model_type='ncsn', delta=2e-5, T=100, monitor=False, n_display=5,
+                        adaptive=False, min_T=1, tol=1e-3, grouped=False):
+    """
+    Graph-compiled version of basis_inner_loop
+
+    The T Langevin updates of one noise level run inside a single tf.while_loop.
+    sigma_idx and step_scale are given as tensors so the function is traced once and reused for every noise level.
+    The K sources are packed into one [K, N, H, W, C] tensor: the scores are computed by one call
+    of stacked_score_fn and the noise, mixing gradient and update are single batched ops.
+
+    If monitor is True, the loop also checks for NaNs on device and keeps the first n_display
+    sources every T // 5 steps, without any host sync inside the loop.
+    If adaptive is True, the loop stops between min_T and T steps once the
+    reconstruction residual and the drift norm plateau (see convergence_update).
+    If grouped is True, distinct NCSN v2 models are evaluated as one grouped network (see stacked_score_fn).
+
+    Returns:
+        inner_loop: tf.function
+            (mixed, x, sigma_idx, step_scale) -> x
+            if monitor or adaptive: (mixed, x, sigma_idx, step_scale) -> dict with keys
+                x: separated sources
+                n_steps: number of steps done
+                nan_step: first step with a NaN, -1 if none (monitor only)
+                snapshots: [ceil(T / (T // 5)), K, n_display, H, W, C] tensor (monitor only)
+                n_snapshots: number of snapshots written (monitor only). The adaptive loop can stop before T steps:
+                    the snapshots after the first n_snapshots are zeros
+    """
+    sigmas_tf = tf.constant(sigmas, dtype=tf.float32)
+    sigmaL = sigmas_tf[-1]
+    score, conditioning = stacked_score_fn(models, model_type=model_type, grouped=grouped)
+    summary_interval = max(T // 5, 1)
+    n_snapshots = (T + summary_interval - 1) // summary_interval
+
+    def langevin_step(mixed, x, eta, lambda_recon, cond):
+        epsilon = tf.math.sqrt(2. * eta) * tf.random.normal(tf.shape(x), dtype=tf.float32)
+        grad_logprob = score(x, cond)
+        mixing, residual, grad_mixing = mixing_op(x, mixed)
+
+        drift = eta * (grad_logprob + lambda_recon * grad_mixing * residual)
+        x = x + drift + epsilon
+        return x, (grad_logprob, grad_mixing, mixing, residual, drift)
+
+    @tf.function
+    def inner_loop(mixed, x, sigma_idx, step_scale):
+        sigma = tf.gather(sigmas_tf, sigma_idx)
+        eta = step_scale * delta * (sigma / sigmaL) ** 2
+        lambda_recon = 1.0 / (sigma ** 2)
+        # loop invariant: evaluated once per noise level
+        cond = conditioning(sigma_idx, tf.shape(mixed)[0])
+
+        if not (monitor or adaptive):
+            def body(t, x):
+                x, _ = langevin_step(mixed, x, eta, lambda_recon, cond)
+                return t + 1, x
+
+            _, x = tf.while_loop(lambda t, x: t < T, body, [tf.constant(0), x])
+            return x
+
+        # loop variables: step, sources, convergence flag, moving averages, first NaN step, snapshots
+        def loop_cond(t, x, converged, stats, nan_step, snapshots):
+            return tf.logical_and(t < T, tf.logical_not(converged))
+
+        def body(t, x, converged, stats, nan_step, snapshots):
+            if monitor:
+                snapshots = tf.cond(tf.equal(t % summary_interval, 0),
+                                    lambda: snapshots.write(t // summary_interval, x[:, :n_display]),
+                                    lambda: snapshots)
+            x, (grad_logprob, grad_mixing, mixing, residual, drift) = langevin_step(mixed, x, eta, lambda_recon, cond)
+            if monitor:
+                nan_step = first_nan_step(nan_step, t, grad_logprob, grad_mixing, mixing, x)
+            if adaptive:
+                stats, converged = convergence_update(t, stats, tf.reduce_mean(tf.abs(residual)),
+                                                      tf.reduce_mean(tf.abs(drift)), min_T, tol)
+            return t + 1, x, converged, stats, nan_step, snapshots
+
+        snapshots = tf.TensorArray(tf.float32, size=n_snapshots if monitor else 0)
+        loop_vars = [tf.constant(0), x, tf.constant(False), tf.zeros([2], dtype=tf.float32), tf.constant(-1), snapshots]
+        n_steps, x, _, _, nan_step, snapshots = tf.while_loop(loop_cond, body, loop_vars)
+
+        outputs = {'x': x, 'n_steps': n_steps}
+        if monitor:
+            outputs.update({'nan_step': nan_step, 'snapshots': snapshots.stack(),
+                            'n_snapshots': (n_steps + summary_interval - 1) // summary_interval})
+        return outputs
+
+    return inner_loop
+
+
+def basis_outer_loop(mixed, x, models, optimizer, sigmas,
+                     ckpts, args, train_summary_writer, return_arr=True, inner_loop=None, model_banks=None, sampler=None,
+                     mixing_op=None, posterior=None):
+    """
+    BASIS algorithm: anneal the Langevin dynamics of the K sources over the noise levels sigmas
+
+    The loop never waits for the host: the summaries are rendered on a background thread,
+    the NaN checks of the debug mode and the step counts are read once at the end
+    and the sources of every noise level stay on device.
+
+    Parameters:
+        mixed: [N, H, W, C] tensor of mixtures
+        x: [K, N, H, W, C] tensor, initial sources
+        models: list of K score models
+        ckpts: list of K checkpoints (used to restore the noise conditioned Glow models)
+        return_arr: if True, also return the sources after each noise level
+        inner_loop: compiled inner loop from basis_inner_loop_fn, to reuse one trace across calls
+        model_banks: list of K ModelBank (None for exported models, see build_model_banks).
+            If given, the Glow weights are swapped from memory instead of restoring ckpts
+        sampler: ncsn.sampler sampler (see basis_sampler). The levels of the predictor-corrector and consistent
+            annealed samplers run on the posterior score instead of the inner loop, and the sampler's
+            denoising step (if any) ends the separation
+        mixing_op: mixing operator of inner_loop (mixing_process(args) if None). The gains of a LearnedGainMixing
+            are reset to 1 / K, then fitted to the mixture from the sources at the end of every noise level
+            (args.gain_steps Adam steps): each call separates its mixtures with its own gains
+        posterior: ncsn.sampler.PosteriorScore of the sampler (built from models and mixing_op if None).
+            The compiled levels of the sampler are traced for one posterior object: pass the same one to reuse a trace
+
+    Returns:
+        x: [K, N, H, W, C] tensor, separated sources
+        x_arr: list of ndarray (None if not return_arr)
+    """
     step = 0
     post_processing = post_processing_fn(args)
-    g, grad_g = mixing_process(args)
-
-    x_arr = {'x1': [x1.numpy()], 'x2': [x2.numpy()]}
-
-    for sigma_idx, sigma in enumerate(sigmas):
-        print("Sigma = {} ({} / {})".format(sigma, sigma_idx + 1, len(sigmas)))
-        if args.model_type == 'glow':
-            restore_path_1 = args.restore_dict_1[sigma]
-            restore_checkpoint(ckpt1, restore_path_1, model1, optimizer)
-            print("Model 1 at noise level {} restored from {}".format(sigma, restore_path_1))
-            restore_path_2 = args.restore_dict_2[sigma]
-            restore_checkpoint(ckpt2, restore_path_2, model2, optimizer)
-            print("Model 2 at noise level {} restored from {}".format(sigma, restore_path_2))
+    if mixing_op is None:
+        mixing_op = mixing_process(args)
+    if isinstance(mixing_op, LearnedGainMixing):
+        mixing_op.reset()
+    plot_kwargs = {'data_type': args.data_type, 'fmin': args.fmin, 'fmax': args.fmax, 'sampling_rate': args.sampling_rate}
+    summary_interval = max(args.T // 5, 1)
+    min_T = min_steps(args)
+
+    use_graph = not args.eager
+    grouped = getattr(args, 'grouped_score', False)
+    use_sampler = sampler is not None and not isinstance(sampler, AnnealedLangevinSampler)
+    if sampler is not None and posterior is None:
+        posterior = PosteriorScore(*stacked_score_fn(models, model_type=args.model_type, grouped=grouped), mixing_op)
+    if use_graph and inner_loop is None and not use_sampler:
+        # NaN checks and snapshots of the sources for the debug mode and the summaries
+        inner_loop = basis_inner_loop_fn(models, sigmas, mixing_op, model_type=args.model_type, delta=2e-5, T=args.T,
+                                         monitor=args.debug or train_summary_writer is not None,
+                                         adaptive=args.adaptive, min_T=min_T, tol=args.tol, grouped=grouped)
+
+    summary = None
+    if train_summary_writer is not None:
+        summary = train_utils.AsyncSummaryWriter(train_summary_writer)
+
+    x_arr = [x] if return_arr else None
+    nan_steps = []
+    n_steps = []
+
+    # noise levels visited and step size scales (every level of the training schedule by default)
+    sigma_indices, step_scales = inference_schedule(sigmas, n_levels=args.n_levels, spacing=args.spacing,
+                                                    max_scale=args.max_step_scale)
+
+    for level, (sigma_idx, step_scale) in enumerate(zip(sigma_indices, step_scales)):
+        sigma_idx, step_scale = int(sigma_idx), float(step_scale)
+        sigma = sigmas[sigma_idx]
+        print("Sigma = {} ({} / {})".format(sigma, level + 1, len(sigma_indices)))
+        if args.model_type == 'glow' and model_banks is not None:
+            for bank in model_banks:
+                if bank is None:
+                    # exported model
+                    continue
+                bank.assign(sigma)
+                if level + 1 < len(sigma_indices):
+                    # load the next weights while the inner loop runs
+                    bank.prefetch(sigmas[sigma_indices[level + 1]])
+        elif args.model_type == 'glow':
+            for k, (model, ckpt, restore_dict) in enumerate(zip(models, ckpts, args.restore_dicts)):
+                if ckpt is None:
+                    # exported model
+                    continue
+                restore_checkpoint(ckpt, restore_dict[sigma], model, optimizer)
+                print("Model {} at noise level {} restored from {}".format(k + 1, sigma, restore_dict[sigma]))
+
+        nan_step, n_step = None, args.T
+        if use_sampler:
+            next_sigma_idx = int(sigma_indices[level + 1]) if level + 1 < len(sigma_indices) else -1
+            x = sampler.level(posterior, x, sigma_idx, next_sigma_idx, step_scale, context=mixed)
+            n_step = sampler.evals_per_level
+        elif use_graph:
+            outputs = inner_loop(mixed, x, tf.constant(sigma_idx, dtype=tf.int32), tf.constant(step_scale, dtype=tf.float32))
+            if isinstance(outputs, dict):
+                # monitored or adaptive inner loop
+                x, n_step = outputs['x'], outputs['n_steps']
+                nan_step = outputs.get('nan_step')
+                if summary is not None and 'snapshots' in outputs:
+                    # only the steps done by the loop have a snapshot
+                    snapshots = outputs['snapshots']
+                    for i in range(int(outputs['n_snapshots'])):
+                        summary.submit(components_summary, mixed, snapshots[i], step * args.T + i * summary_interval,
+                                       post_processing, **plot_kwargs)
+            else:
+                x = outputs
         else:
-            pass
-
-        x1, x2 = basis_inner_loop(mixed, x1, x2, model1, model2, sigma_idx, sigmas, g, grad_g, post_processing,
-                                  model_type=args.model_type, delta=2e-5, T=args.T, debug=args.debug,
-                                  train_summary_writer=train_summary_writer, step=step * args.T,
-                                  data_type=args.data_type, fmin=args.fmin, fmax=args.fmax, sampling_rate=args.sampling_rate)
-
-        x_arr['x1'].append(x1.numpy())
-        x_arr['x2'].append(x2.numpy())
+            x, nan_step, n_step = basis_inner_loop(mixed, x, models, sigma_idx, sigmas, mixing_op, post_processing,
+                                                   model_type=args.model_type, delta=2e-5, T=args.T, debug=args.debug,
+                                                   summary=summary, step=step * args.T, adaptive=args.adaptive,
+                                                   min_T=min_T, tol=args.tol, step_scale=step_scale, grouped=grouped,
+                                                   **plot_kwargs)
+        nan_steps.append(nan_step)
+        n_steps.append(n_step)
+
+        if isinstance(mixing_op, LearnedGainMixing):
+            # the sources are fixed: the next level runs with the gains that best explain the mixture
+            loss = mixing_op.fit(x, mixed, n_steps=args.gain_steps)
+            print("Mixing gains: {} (loss = {})".format(list(mixing_op.gains.numpy()), float(loss)))
+
+        if return_arr:
+            x_arr.append(x)
 
         step += 1
-        with train_summary_writer.as_default():
-
-            sample_mix = post_processing(mixed.numpy())
-            sample_x1 = post_processing(x1.numpy())
-            sample_x2 = post_processing(x2.numpy())
-            figure = image_grid(5, sample_mix, sample_x1, sample_x2, separation=True,
-                                data_type=args.data_type, fmin=args.fmin, fmax=args.fmax, sampling_rate=args.sampling_rate)
-            tf.summary.image("Components", train_utils.plot_to_image(figure),
-                             max_outputs=50, step=step * args.T)
+        if summary is not None:
+            summary.submit(components_summary, mixed, x, step * args.T, post_processing, **plot_kwargs)
 
         print("inner loop done")
         print("_" * 100)
 
-    return x1, x2, x_arr
+    if sampler is not None and sampler.denoise:
+        x = sampler.denoise_step(posterior, x, int(sigma_indices[-1]), context=mixed)
+        if return_arr:
+            x_arr[-1] = x
+
+    if args.debug:
+        for sigma, nan_step in zip(sigmas[sigma_indices], nan_steps):
+            assert nan_step is None or int(nan_step) < 0, (sigma, int(nan_step))
+
+    if args.adaptive:
+        n_steps = [int(n_step) for n_step in n_steps]
+        print("Steps per noise level: {}".format(n_steps))
+        print("Total steps: {} / {}".format(sum(n_steps), args.T * len(sigma_indices)))
+        if summary is not None:
+            for level, n_step in enumerate(n_steps):
+                summary.submit(tf.summary.scalar, "Steps per noise level", n_step, step=level)
+
+    if summary is not None:
+        summary.close()
+    if return_arr:
+        x_arr = [x_k.numpy() for x_k in x_arr]
+
+    return x, x_arr
+
+
+def basis_sampler(args, sigmas):
+    """
+    Sampler of the separation (args.sampler, see ncsn.sampler), on the inference schedule of args
+    The Langevin dynamics use the step size 2e-5 of the inner loop, the consistent annealed sampling the step size of the schedule
+    """
+    sigma_indices, step_scales = inference_schedule(sigmas, n_levels=args.n_levels, spacing=args.spacing,
+                                                    max_scale=args.max_step_scale)
+    return get_sampler(args.sampler, sigmas, n_steps_each=args.T, sigma_indices=sigma_indices,
+                       step_scales=step_scales, n_corrector=args.n_corrector, snr=args.snr, denoise=args.denoise)
+
+
+def min_steps(args):
+    """
+    Minimum number of steps per noise level of the adaptive inner loop (default: T // 10)
+    """
+    if args.min_T is None:
+        return max(args.T // 10, 1)
+    return min(args.min_T, args.T)
+
+
+def build_models(args, sigmas, minibatch=None):
+    """
+    Build one score model per restore path in args.RESTORE. Sources with the same restore path get the same model
+    Restore paths can also be exported models (export_score_model.py), for NCSN and Glow models,
+    or TFLite files (--precision int8) for NCSN models.
+    An exported Glow model holds the weights of one noise level: it can only be used with a single noise level
+    """
+    sigmas_tf = tf.constant(sigmas, dtype=tf.float32)
+    models = []
+    for k in range(len(args.RESTORE)):
+        if args.RESTORE[k] in args.RESTORE[:k]:
+            # sources with the same restore path share one model, evaluated in a single call (see stacked_score_fn)
+            models.append(models[args.RESTORE.index(args.RESTORE[k])])
+            continue
+        if is_exported_model(args.RESTORE[k]):
+            model = ExportedScoreModel(args.RESTORE[k])
+            if model.model_type == 'glow' and len(sigmas) > 1:
+                raise ValueError("The exported Glow model {} holds the weights of one noise level, "
+                                 "it can not be used with {} noise levels".format(args.RESTORE[k], len(sigmas)))
+        elif args.model_type == "glow":
+            model = flow_builder.build_glow(minibatch, args.data_shape, L=args.L, K=args.K, n_filters=args.n_filters, dataset=args.dataset,
+                                            l2_reg=args.l2_reg, mirrored_strategy=None)
+        elif args.precision == 'int8':
+            model = TFLiteScoreModel(args.RESTORE[k])
+        elif args.version == 'v1':
+            model = get_uncompiled_model(args, name="model{}".format(k + 1))
+        else:
+            model = get_uncompiled_model_v2(args, sigmas=sigmas_tf, name="model{}".format(k + 1))
+        models.append(model)
+    return models
+
+
+def restore_models(models, optimizer, args):
+    """
+    Create the checkpoints of the models. NCSN weights are restored from args.RESTORE,
+    Glow weights are restored at every noise level by basis_outer_loop
+    """
+    ckpts = []
+    for k, model in enumerate(models):
+        if model in models[:k]:
+            # shared model, restored once
+            ckpts.append(ckpts[models.index(model)])
+            continue
+        if isinstance(model, (TFLiteScoreModel, ExportedScoreModel)):
+            # TFLite and exported models have no variables
+            ckpts.append(None)
+            continue
+        ckpt, _ = train_utils.setUp_checkpoint(None, model, optimizer)
+        if args.model_type == "ncsn":
+            abs_restore_path = os.path.abspath(args.RESTORE[k])
+            restore_checkpoint(ckpt, abs_restore_path, model, optimizer, latest=False)
+            print("Model {} restored from {}".format(k + 1, abs_restore_path))
+        ckpts.append(ckpt)
+    return ckpts
+
+
+def build_model_banks(models, args, sigmas):
+    """
+    In-memory banks of the weights of the Glow models at every noise level (None for NCSN models)
+    Exported Glow models are frozen with the weights of one checkpoint (single noise level, see build_models) and get no bank
+    A model shared by several sources (see build_models) gets one bank
+    """
+    if args.model_type != "glow":
+        return None
+    model_banks = []
+    for k, (model, restore_dict) in enumerate(zip(models, args.restore_dicts)):
+        if isinstance(model, ExportedScoreModel) or any([model is other for other in models[:k]]):
+            # the weights of a shared model are swapped by the bank of its first source
+            model_banks.append(None)
+        else:
+            model_banks.append(ModelBank(model, restore_dict, max_size=args.bank_size, prefetch=args.prefetch))
+    if args.bank_size is None:
+        for bank in model_banks:
+            if bank is not None:
+                bank.preload(sigmas)
+    return model_banks
+
+
+def close_model_banks(model_banks):
+    if model_banks is not None:
+        for bank in model_banks:
+            if bank is not None:
+                bank.close()
+
+
+def apply_precision(models, args, sigmas):
+    """
+    Return the restored NCSN models in the inference precision of args.precision
+    float32 and int8 models are returned as built (int8 models are read from TFLite files, see quantize_ncsn.py)
+    """
+    if args.precision not in ['float32', 'bfloat16', 'int8']:
+        raise ValueError("precision should be 'float32', 'bfloat16' or 'int8'")
+    if args.model_type == 'glow' and args.precision != 'float32':
+        raise ValueError("Glow models only run in float32")
+    if args.precision != 'bfloat16':
+        return models
+    if any([isinstance(model, ExportedScoreModel) for model in models]):
+        raise ValueError("Exported models run in the precision they were exported in")
+    sigmas_tf = tf.constant(sigmas, dtype=tf.float32)
+    bfloat16_models = []
+    for k, model in enumerate(models):
+        shared = [other is model for other in models[:k]]
+        if any(shared):
+            # keep the sources of a shared model on one model
+            bfloat16_models.append(bfloat16_models[shared.index(True)])
+        else:
+            bfloat16_models.append(get_bfloat16_model(args, sigmas_tf, model, name="model{}_bfloat16".format(k + 1)))
+    return bfloat16_models
+
+
+def set_melspec_params(args):
+    """
+    Set the melspectrograms parameters of args (scale bounds, sampling rate, mel filter)
+
+    Returns:
+        spec_params: dict of the parameters used to compute the melspectrograms
+    """
+    args.fmin = 125
+    args.fmax = 7600
+    args.sampling_rate = 16000
+    if args.scale == 'power':
+        args.maxval = 100.
+        args.minval = 1e-10
+    elif args.scale == 'dB':
+        args.maxval = 20.
+        args.minval = -100.
+    else:
+        raise ValueError("scale should be 'power' or 'dB'")
+    args.use_dB = (args.scale == 'dB')
+
+    spec_params = {'length_sec': 2.04, 'dbmin': -100, 'dbmax': 20, 'fmin': args.fmin,
+                   'fmax': args.fmax, 'use_dB': args.use_dB, 'n_fft': 2048,
+                   'hop_length': 512, 'n_mels': 96, 'sr': args.sampling_rate}
+    return spec_params
+
+
+def preprocess_mixture(mixed, args):
+    mixed = (mixed - args.minval) / (args.maxval - args.minval)
+    if args.use_logit:
+        mixed = mixed * (1. - 2 * args.alpha) + args.alpha
+        mixed = tf.math.log(mixed) - tf.math.log(1. - mixed)
+    return mixed
 
 
 def main(args):
 
     # noise conditionned models
-    abs_restore_path_1 = os.path.abspath(args.RESTORE1)
-    abs_restore_path_2 = os.path.abspath(args.RESTORE2)
+    restore_paths = [os.path.abspath(restore_path) for restore_path in args.RESTORE]
 
     if args.config is not None:
         new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
         new_args.dataset = args.dataset
         new_args.debug = args.debug
+        new_args.eager = args.eager
+        new_args.adaptive = args.adaptive
+        new_args.learned_gains = args.learned_gains
+        new_args.grouped_score = args.grouped_score
+        new_args.gain_steps = args.gain_steps
+        new_args.min_T = args.min_T
+        new_args.tol = args.tol
+        new_args.sampler = args.sampler
+        new_args.n_corrector = args.n_corrector
+        new_args.snr = args.snr
+        new_args.denoise = args.denoise
+        new_args.n_levels = args.n_levels
+        new_args.spacing = args.spacing
+        new_args.max_step_scale = args.max_step_scale
+        new_args.precision = args.precision
         new_args.output = args.output
         new_args.song_dir = args.song_dir
+        new_args.sources = args.sources
         new_args.inverse = args.inverse
+        new_args.griffin_iter = args.griffin_iter
         new_args.model_type = args.model_type
         new_args.n_mixed = args.n_mixed
+        new_args.bank_size = args.bank_size
+        new_args.prefetch = args.prefetch
         args = new_args
 
+    args.RESTORE = restore_paths
+    n_sources = len(restore_paths)
     sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
-    sigmas_tf = tf.constant(sigmas, dtype=tf.float32)
 
     if args.model_type == "glow":
-        args.restore_dict_1 = {sigma: os.path.join(abs_restore_path_1, "sigma_" + str(round(sigma, 2)), "tf_ckpts") for sigma in sigmas}
-        args.restore_dict_2 = {sigma: os.path.join(abs_restore_path_2, "sigma_" + str(round(sigma, 2)), "tf_ckpts") for sigma in sigmas}
+        args.restore_dicts = [{sigma: os.path.join(restore_path, "sigma_" + str(round(sigma, 2)), "tf_ckpts") for sigma in sigmas}
+                              for restore_path in restore_paths]
     elif args.model_type == "ncsn":
-        args.restore_dict_1 = args.restore_dict_2 = None
+        args.restore_dicts = None
     else:
         raise ValueError("model_type should be 'ncsn' or 'glow'")
 
@@ -301,6 +789,11 @@ def main(args):
         args.data_shape = [args.height, args.width, 1]
         args.data_type = "melspec"
 
+    if args.data_type == "image" and n_sources != 2:
+        raise ValueError("mnist and cifar10 mixtures have 2 sources, got {} models".format(n_sources))
+    if args.data_type == "melspec" and len(args.sources) != n_sources:
+        raise ValueError("{} sources given for {} models".format(len(args.sources), n_sources))
+
     try:
         os.mkdir(args.output)
         os.chdir(args.output)
@@ -320,6 +813,8 @@ def main(args):
         mixed, x1, x2, gt1, gt2, minibatch = data_loader.get_mixture_toydata(dataset=args.dataset, n_mixed=args.n_mixed,
                                                                              use_logit=args.use_logit, alpha=args.alpha,
                                                                              noise=None, mirrored_strategy=None)
+        x = tf.stack([x1, x2], axis=0)
+        gt = [gt1, gt2]
         args.minval = 0.
         args.maxval = 256.
         args.sampling_rate, args.fmin, args.fmax = None, None, None
@@ -327,43 +822,23 @@ def main(args):
         if args.song_dir is None:
             raise ValueError("song directory path is None")
 
-        args.fmin = 125
-        args.fmax = 7600
-        args.sampling_rate = 16000
-        if args.scale == 'power':
-            args.maxval = 100.
-            args.minval = 1e-10
-        elif args.scale == 'dB':
-            args.maxval = 20.
-            args.minval = -100.
-        else:
-            raise ValueError("scale should be 'power' or 'dB'")
+        spec_params = set_melspec_params(args)
 
         mix_path = os.path.join(song_dir_abspath, 'mix.wav')
-        piano_path = os.path.join(song_dir_abspath, 'piano.wav')
-        violin_path = os.path.join(song_dir_abspath, 'violin.wav')
-        args.use_dB = (args.scale == 'dB')
-        spec_params = {'length_sec': 2.04, 'dbmin': -100, 'dbmax': 20, 'fmin': 125,
-                       'fmax': 7600, 'use_dB': args.use_dB, 'n_fft': 2048,
-                       'hop_length': 512, 'n_mels': 96, 'sr': 16000}
+        source_paths = [os.path.join(song_dir_abspath, source + '.wav') for source in args.sources]
         duration = 2.04 * args.n_mixed
 
-        mel_spec, raw_audio, stft_mixture = data_loader.get_song_extract(mix_path, piano_path, violin_path, duration, **spec_params)
+        mel_spec, raw_audio, stft_mixture = data_loader.get_song_extract(mix_path, source_paths, duration, **spec_params)
 
-        mixed, gt1, gt2 = mel_spec[0], mel_spec[1], mel_spec[2]
+        mixed, gt = mel_spec[0], mel_spec[1:]
+        minibatch = None
         # preprocessing mixture
-        mixed = (mixed - args.minval) / (args.maxval - args.minval)
-        if args.use_logit:
-            mixed = mixed * (1. - 2 * args.alpha) + args.alpha
-            mixed = tf.math.log(mixed) - tf.math.log(1. - mixed)
+        mixed = preprocess_mixture(mixed, args)
 
-        x1 = tf.random.uniform(mixed.shape, dtype=tf.float32)
-        x2 = tf.random.uniform(mixed.shape, dtype=tf.float32)
+        x = tf.random.uniform([n_sources] + list(mixed.shape), dtype=tf.float32)
 
         # wiener filter:
-        # p_x1, p_x2 = tf.unstack(tf.nn.softmax(tf.stack([x1, x2], axis=0), axis=0), axis=0)
-        # x1 = p_x1 * mixed
-        # x2 = p_x2 * mixed
+        # x = tf.nn.softmax(x, axis=0) * mixed
 
     print("Data Loaded in {} seconds".format(round(time.time() - t0, 3)))
 
@@ -373,39 +848,28 @@ def main(args):
     # display originals
     with train_summary_writer.as_default():
         mix_post_process = post_processing(mixed.numpy())
-        figure = image_grid(5, gt1.numpy(), gt2.numpy(), mix_post_process, data_type=args.data_type,
+        figure = image_grid(5, *[gt_k.numpy() for gt_k in gt], mix_post_process, data_type=args.data_type,
                             separation=False, fmin=args.fmin, fmax=args.fmax, sampling_rate=args.sampling_rate)
         tf.summary.image("Originals", train_utils.plot_to_image(figure), max_outputs=1, step=0)
         if args.data_type == "melspec":
-            tf.summary.audio("Original Audio", np.reshape(raw_audio, (3, -1, 1)), sample_rate=args.sampling_rate, encoding='wav', step=0)
-            sf.write("ground_truth1.wav", data=raw_audio[1], samplerate=args.sampling_rate)
-            sf.write("ground_truth2.wav", data=raw_audio[2], samplerate=args.sampling_rate)
+            tf.summary.audio("Original Audio", np.reshape(raw_audio, (n_sources + 1, -1, 1)), sample_rate=args.sampling_rate,
+                             encoding='wav', step=0)
+            for k in range(n_sources):
+                sf.write("ground_truth{}.wav".format(k + 1), data=raw_audio[k + 1], samplerate=args.sampling_rate)
             sf.write("mix.wav", data=raw_audio[0], samplerate=args.sampling_rate)
 
-    # build model
-    if args.model_type == "glow":
-        model1 = flow_builder.build_glow(minibatch, L=args.L, K=args.K, n_filters=args.n_filters, dataset=args.dataset,
-                                         l2_reg=args.l2_reg, mirrored_strategy=None)
-        model2 = flow_builder.build_glow(minibatch, L=args.L, K=args.K, n_filters=args.n_filters, dataset=args.dataset,
-                                         l2_reg=args.l2_reg, mirrored_strategy=None)
-    else:
-        if args.version == 'v1':
-            model1 = get_uncompiled_model(args, name="model1")
-            model2 = get_uncompiled_model(args, name="model2")
-        else:
-            model1 = get_uncompiled_model_v2(args, sigmas=sigmas_tf, name="model1")
-            model2 = get_uncompiled_model_v2(args, sigmas=sigmas_tf, name="model2")
+    # build models
+    models = build_models(args, sigmas, minibatch=minibatch)
 
     # set up optimizer
     optimizer = train_utils.setUp_optimizer(None, args)
-    # checkpoint
-    ckpt1, _ = train_utils.setUp_checkpoint(None, model1, optimizer)
-    ckpt2, _ = train_utils.setUp_checkpoint(None, model2, optimizer)
-    if args.model_type == "ncsn":
-        restore_checkpoint(ckpt1, abs_restore_path_1, model1, optimizer, latest=False)
-        print("Model 1 restore from {}".format(abs_restore_path_1))
-        restore_checkpoint(ckpt2, abs_restore_path_2, model2, optimizer, latest=False)
-        print("Model 2 restored from {}".format(abs_restore_path_2))
+    # checkpoints
+    ckpts = restore_models(models, optimizer, args)
+    models = apply_precision(models, args, sigmas)
+    t0 = time.time()
+    model_banks = build_model_banks(models, args, sigmas)
+    if model_banks is not None and args.bank_size is None:
+        print("Weights of every noise level loaded in {} seconds".format(round(time.time() - t0, 3)))
 
     # print parameters
     params_dict = vars(args)
@@ -418,32 +882,34 @@ def main(args):
                         data=tf.constant(template), step=0)
     # run BASIS separation
     t0 = time.time()
-    x1, x2, x_arr = basis_outer_loop(mixed, x1, x2, model1, model2, optimizer, sigmas,
-                                     ckpt1, ckpt2, args, train_summary_writer)
+    sampler = basis_sampler(args, sigmas)
+    print("Score evaluations per source: {}".format(sampler.n_evals()))
+    x, x_arr = basis_outer_loop(mixed, x, models, optimizer, sigmas,
+                                ckpts, args, train_summary_writer, model_banks=model_banks, sampler=sampler)
+    close_model_banks(model_banks)
 
     t1 = time.time()
     print("Duration: {} seconds".format(round(t1 - t0, 3)))
 
     # Save results
-    x1 = post_processing(x1.numpy().squeeze())
-    x2 = post_processing(x2.numpy().squeeze())
+    x = [post_processing(x_k.squeeze()) for x_k in x.numpy()]
     mixed = post_processing(mixed.numpy().squeeze())
-    gt1 = gt1.numpy().squeeze()
-    gt2 = gt2.numpy().squeeze()
-    x_arr['x1'] = post_processing(np.array(x_arr['x1']))
-    x_arr['x2'] = post_processing(np.array(x_arr['x2']))
-    np.savez('results', x1=x1, x2=x2, gt1=gt1.squeeze(), gt2=gt2.squeeze(), mixed=mixed, stft_mixture=stft_mixture)
-    np.savez('results_convergence', x1=x_arr['x1'], x2=x_arr['x2'])
+    gt = [gt_k.numpy().squeeze() for gt_k in gt]
+    x_arr = post_processing(np.array(x_arr))
+    results = {'x{}'.format(k + 1): x[k] for k in range(n_sources)}
+    results.update({'gt{}'.format(k + 1): gt[k] for k in range(n_sources)})
+    np.savez('results', mixed=mixed, stft_mixture=stft_mixture, **results)
+    np.savez('results_convergence', **{'x{}'.format(k + 1): x_arr[:, k] for k in range(n_sources)})
 
     # Inverse mel spec
     if args.data_type == "melspec" and args.inverse:
-        x1_concat = np.concatenate(list(x1), axis=-1)
-        x2_concat = np.concatenate(list(x2), axis=-1)
-        x1_audio = spectrogram_inversion(x1_concat, sr=args.sampling_rate, fmin=args.fmin, fmax=args.fmax, use_db=args.use_dB)
-        x2_audio = spectrogram_inversion(x2_concat, sr=args.sampling_rate, fmin=args.fmin, fmax=args.fmax, use_db=args.use_dB)
-        sep_audio = np.reshape(np.array([x1_audio, x2_audio]), (2, -1, 1))
-        sf.write("sep1.wav", data=x1_audio, samplerate=args.sampling_rate)
-        sf.write("sep2.wav", data=x2_audio, samplerate=args.sampling_rate)
+        x_concat = np.array([np.concatenate(list(x_k), axis=-1) for x_k in x])
+        sep_audio = spectrogram_inversion(x_concat, sr=args.sampling_rate, fmin=args.fmin, fmax=args.fmax,
+                                          use_db=args.use_dB, stft_mixture=np.concatenate(list(stft_mixture), axis=-1),
+                                          n_iter=args.griffin_iter)
+        for k in range(n_sources):
+            sf.write("sep{}.wav".format(k + 1), data=sep_audio[k], samplerate=args.sampling_rate)
+        sep_audio = np.reshape(sep_audio, (n_sources, -1, 1))
         with train_summary_writer.as_default():
             tf.summary.audio("Separated Audio", sep_audio, sample_rate=args.sampling_rate, encoding='wav', step=1000)
 
@@ -453,14 +919,14 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='BASIS Separatation')
-    parser.add_argument('RESTORE1', type=str, default=None,
-                        help='directory of saved model1')
-    parser.add_argument('RESTORE2', type=str, default=None,
-                        help='directory of saved model2')
+    parser.add_argument('RESTORE', type=str, nargs='+',
+                        help='directories of the saved models: one per source')
 
     parser.add_argument('--output', type=str, default='basis_sep',
                         help='output dirpath for savings')
     parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--eager', action="store_true",
+                        help="Run the inner loop eagerly instead of the graph-compiled tf.while_loop")
 
     # dataset parameters
     parser.add_argument('--dataset', type=str, default="melspec",
@@ -469,9 +935,13 @@ if __name__ == "__main__":
     # song directory path to separate
     parser.add_argument("--song_dir", type=str, default=None,
                         help="song directory path to separate: should contain\
-                        3 songs: mix.wav, piano.wav and violin.wav")
+                        mix.wav and one wav file per source")
+    parser.add_argument("--sources", type=str, nargs='+', default=['piano', 'violin'],
+                        help="names of the sources (wav files in song_dir), in the order of the models")
 
     parser.add_argument("--inverse", action="store_true", help="Inverse spectrograms")
+    parser.add_argument("--griffin_iter", type=int, default=32,
+                        help="Maximum number of fast Griffin-Lim iterations of the inversion (warm start from the mixture phase)")
     # Model type
     parser.add_argument("--model_type", type=str, default="ncsn")
 
@@ -488,15 +958,46 @@ if __name__ == "__main__":
     # BASIS hyperparameters
     parser.add_argument("--T", type=int, default=100,
                         help="Number of iteration in the inner loop")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Move to the next noise level once the residual and the update norm plateau")
+    parser.add_argument("--min_T", type=int, default=None,
+                        help="Minimum number of iterations per noise level with --adaptive (default: T // 10)")
+    parser.add_argument("--tol", type=float, default=1e-3,
+                        help="Relative change under which the statistics are considered on a plateau with --adaptive")
+    parser.add_argument("--learned_gains", action="store_true",
+                        help="Mix the sources with one gain per source, fitted to the mixture after every noise level")
+    parser.add_argument("--gain_steps", type=int, default=100,
+                        help="Number of Adam steps fitting the mixing gains after every noise level with --learned_gains")
+    parser.add_argument("--sampler", type=str, default="ald", choices=SAMPLERS,
+                        help="ald (annealed Langevin dynamics), pc (predictor-corrector) or cas (consistent annealed sampling)")
+    parser.add_argument("--n_corrector", type=int, default=1,
+                        help="Number of corrector steps per noise level (pc)")
+    parser.add_argument("--snr", type=float, default=0.16,
+                        help="Signal to noise ratio of the corrector steps (pc)")
+    parser.add_argument("--denoise", action="store_true",
+                        help="End with a denoising step x + sigma_L^2 * posterior score(x)")
 
     parser.add_argument('--sigma1', type=float, default=1.0)
     parser.add_argument('--sigmaL', type=float, default=0.01)
     parser.add_argument('--num_classes', type=float, default=10)
     parser.add_argument('--progression', type=str, default='geometric')
 
+    # inference schedule
+    parser.add_argument("--n_levels", type=int, default=None,
+                        help="Number of noise levels visited (sub-sampled from the training schedule). By default all of them")
+    parser.add_argument("--spacing", type=str, default="uniform",
+                        help="uniform or quadratic (denser at the low noise levels)")
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedule (default: no bound)")
+
     # Model hyperparameters
     parser.add_argument('--n_filters', type=int, default=192,
                         help="number of filters in the Network")
+    parser.add_argument('--grouped_score', action="store_true",
+                        help="Evaluate distinct NCSN v2 models as one network with stacked weights "
+                             "(patch matmuls instead of Conv2D, see benchmark_grouped_score.py)")
+    parser.add_argument('--precision', type=str, default='float32',
+                        help="float32, bfloat16 or int8 (RESTORE paths are TFLite files from quantize_ncsn.py)")
 
     # Glow hyperparameters
     parser.add_argument('--L', default=3, type=int,
@@ -507,6 +1008,10 @@ if __name__ == "__main__":
                         help="L2 regularization for the coupling layer")
     parser.add_argument("--learntop", action="store_true",
                         help="learnable prior distribution")
+    parser.add_argument("--bank_size", type=int, default=None,
+                        help="Number of noise levels kept in memory per model. By default every level is loaded at start")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Load the weights of the next noise level on a background thread")
 
     # Optimization parameters
     parser.add_argument("--optimizer", type=str,
@@ -0,0 +1,283 @@
+import numpy as np
+import tensorflow as tf
+from datasets import data_loader
+from datasets.spectral import get_spectral_transform
+import librosa
+import argparse
+import time
+import os
+import sys
+import soundfile as sf
+from train_utils import *
+from ncsn.utils import *
+from run_basis_sep import build_models, restore_models, basis_outer_loop, basis_inner_loop_fn, \
+    mixing_process, post_processing_fn, set_melspec_params, preprocess_mixture, min_steps, apply_precision
+
+
+"""
+Script for running the BASIS algorithm on recordings of any length
+
+The mixture is read by chunks of n_mixed overlapping extracts.
+Each chunk is separated, saved and inverted before reading the next one so memory does not grow with the track length.
+The separated audio is written incrementally with overlap-add between consecutive extracts.
+"""
+
+
+class OverlapAddWriter(object):
+    """
+    Write audio extracts into wav files (one per source) with overlap-add
+
+    Consecutive extracts overlap by length - hop samples and are cross-faded with linear ramps.
+    The ramps are normalized by their sum so the first and last extracts keep their amplitude.
+    """
+
+    def __init__(self, paths, sr, length, hop):
+        self.files = [sf.SoundFile(path, mode='w', samplerate=sr, channels=1) for path in paths]
+        self.length = length
+        self.hop = hop
+        self.overlap = length - hop
+        ramp = np.linspace(0., 1., self.overlap + 2)[1:-1]
+        self.window = np.ones(length)
+        if self.overlap > 0:
+            self.window[:self.overlap] = ramp
+            self.window[-self.overlap:] = ramp[::-1]
+        self.tail = np.zeros((len(paths), self.overlap))
+        self.tail_weights = np.zeros(self.overlap)
+
+    def write(self, audio, n_samples):
+        """
+        audio: ndarray [K, n_extract, length], separated audio of one chunk
+        n_samples: number of samples of the song in the chunk
+        """
+        n_sources, n_extract, _ = audio.shape
+        chunk_size = (n_extract - 1) * self.hop + self.length
+        chunk_hop = n_extract * self.hop
+        acc = np.zeros((n_sources, chunk_size))
+        weights = np.zeros(chunk_size)
+        for i in range(n_extract):
+            acc[:, i * self.hop: i * self.hop + self.length] += self.window * audio[:, i]
+            weights[i * self.hop: i * self.hop + self.length] += self.window
+        acc[:, :self.overlap] += self.tail
+        weights[:self.overlap] += self.tail_weights
+
+        if n_samples < chunk_size:
+            # last chunk of the song
+            n_final = n_samples
+            self.tail = np.zeros((n_sources, self.overlap))
+            self.tail_weights = np.zeros(self.overlap)
+        else:
+            n_final = chunk_hop
+            self.tail = acc[:, chunk_hop:]
+            self.tail_weights = weights[chunk_hop:]
+
+        for f, y in zip(self.files, acc[:, :n_final] / weights[:n_final]):
+            f.write(y)
+
+    def close(self):
+        if np.any(self.tail_weights > 0):
+            for f, y in zip(self.files, self.tail / np.maximum(self.tail_weights, 1e-8)):
+                f.write(y)
+        for f in self.files:
+            f.close()
+
+
+def reuse_phase_inversion(melspecs, stfts, length, sr=16000, fmin=125, fmax=7600, n_fft=2048, hop_length=512, **kwargs):
+    """
+    Inverse dB melspectrograms by reusing the phase of the mixture STFT
+
+    Parameters:
+        melspecs: ndarray [..., n_extract, n_mels, frames] in dB (for instance the K sources [K, n_extract, n_mels, frames])
+        stfts: ndarray [n_extract, 1 + n_fft // 2, frames] of the STFT of the mixture
+        length: number of samples of each extract
+
+    Returns:
+        ndarray [..., n_extract, length]
+    """
+    transform = get_spectral_transform(sr, n_fft, hop_length, n_mels=melspecs.shape[-2], fmin=fmin, fmax=fmax)
+    mel_stfts = transform.mel_to_stft(librosa.db_to_power(melspecs))
+    return transform.istft(mel_stfts * np.exp(1j * np.angle(stfts)), length=length)
+
+
+def main(args):
+
+    abs_mix_path = os.path.abspath(args.mix)
+    n_sources = len(args.RESTORE)
+
+    if args.config is not None:
+        new_args = get_config(args.config)
+        new_args.RESTORE = args.RESTORE
+        new_args.mix = args.mix
+        new_args.debug = args.debug
+        new_args.eager = args.eager
+        new_args.adaptive = args.adaptive
+        new_args.min_T = args.min_T
+        new_args.tol = args.tol
+        new_args.learned_gains = args.learned_gains
+        new_args.gain_steps = args.gain_steps
+        new_args.n_levels = args.n_levels
+        new_args.spacing = args.spacing
+        new_args.max_step_scale = args.max_step_scale
+        new_args.precision = args.precision
+        new_args.output = args.output
+        new_args.model_type = args.model_type
+        new_args.n_mixed = args.n_mixed
+        new_args.overlap = args.overlap
+        new_args.block_sec = args.block_sec
+        args = new_args
+
+    # the script works from the output directory
+    args.RESTORE = [os.path.abspath(restore_path) for restore_path in args.RESTORE]
+    if args.model_type == "glow":
+        raise ValueError("Streaming separation is only implemented for model_type 'ncsn'")
+
+    sigmas = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
+    args.restore_dicts = None
+    args.dataset = "melspec"
+    args.data_type = "melspec"
+    args.data_shape = [args.height, args.width, 1]
+    spec_params = set_melspec_params(args)
+    length = int(spec_params['length_sec'] * args.sampling_rate)
+    hop = length - int(args.overlap * args.sampling_rate)
+
+    try:
+        os.mkdir(args.output)
+        os.chdir(args.output)
+    except FileExistsError:
+        os.chdir(args.output)
+    try:
+        os.mkdir('spectrograms')
+    except FileExistsError:
+        pass
+
+    log_file = open('out.log', 'w')
+    if args.debug is False:
+        sys.stdout = log_file
+
+    params_dict = vars(args)
+    template = 'BASIS Streaming Separation \n\t '
+    for k, v in params_dict.items():
+        template += '{} = {} \n\t '.format(k, v)
+    print(template)
+
+    # build and restore the models once for the whole track
+    models = build_models(args, sigmas)
+    optimizer = setUp_optimizer(None, args)
+    ckpts = restore_models(models, optimizer, args)
+    models = apply_precision(models, args, sigmas)
+
+    post_processing = post_processing_fn(args)
+    mixing_op = mixing_process(args)
+    inner_loop = basis_inner_loop_fn(models, sigmas, mixing_op, model_type=args.model_type, delta=2e-5, T=args.T,
+                                     monitor=args.debug,
+                                     adaptive=args.adaptive, min_T=min_steps(args), tol=args.tol)
+
+    writer = OverlapAddWriter(["sep{}.wav".format(k + 1) for k in range(n_sources)], args.sampling_rate, length, hop)
+
+    t_init = time.time()
+    chunks = data_loader.stream_song_extracts(abs_mix_path, spec_params['length_sec'], args.n_mixed,
+                                              sr=args.sampling_rate, overlap_sec=args.overlap, block_sec=args.block_sec)
+    for c, (extracts, n_samples) in enumerate(chunks):
+        t0 = time.time()
+        mel_mix, stft_mixture = data_loader.extracts_to_melspec(extracts, **spec_params)
+        mixed = preprocess_mixture(tf.cast(np.expand_dims(mel_mix, axis=-1), tf.float32), args)
+        x = tf.random.uniform([n_sources] + list(mixed.shape), dtype=tf.float32)
+
+        x, _ = basis_outer_loop(mixed, x, models, optimizer, sigmas, ckpts, args, None,
+                                return_arr=False, inner_loop=inner_loop, mixing_op=mixing_op)
+
+        x = post_processing(x.numpy().squeeze(axis=-1))
+        results = {'x{}'.format(k + 1): x[k] for k in range(n_sources)}
+        np.savez(os.path.join('spectrograms', 'chunk_{:05d}'.format(c)), mixed=mel_mix, n_samples=n_samples, **results)
+
+        # the K sources are inverted in one batch
+        audio = reuse_phase_inversion(x, stft_mixture, length, **spec_params)
+        writer.write(audio, n_samples)
+        print("Chunk {} separated in {} seconds".format(c + 1, round(time.time() - t0, 3)))
+
+    writer.close()
+    print("Duration: {} seconds".format(round(time.time() - t_init, 3)))
+
+    log_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Streaming BASIS Separation')
+    parser.add_argument('RESTORE', type=str, nargs='+',
+                        help='directories of the saved models: one per source')
+    parser.add_argument('--mix', type=str, required=True,
+                        help='path of the wav file to separate')
+
+    parser.add_argument('--output', type=str, default='basis_sep_stream',
+                        help='output dirpath for savings')
+    parser.add_argument('--debug', action="store_true")
+    parser.add_argument('--eager', action="store_true",
+                        help="Run the inner loop eagerly instead of the graph-compiled tf.while_loop")
+
+    # Model type
+    parser.add_argument("--model_type", type=str, default="ncsn")
+
+    # Streaming parameters
+    parser.add_argument('--n_mixed', type=int, default=16,
+                        help="number of extracts separated at once")
+    parser.add_argument('--overlap', type=float, default=0.25,
+                        help="overlap in seconds between consecutive extracts")
+    parser.add_argument('--block_sec', type=float, default=60.,
+                        help="length in seconds of the blocks read from the wav file")
+
+    # config
+    parser.add_argument('--config', type=str, help='path to the config file. Overwrite all other parameters below')
+
+    # Spectrograms Parameters
+    parser.add_argument("--height", type=int, default=96)
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--scale", type=str, default="dB", help="power or dB")
+
+    # BASIS hyperparameters
+    parser.add_argument("--T", type=int, default=100,
+                        help="Number of iteration in the inner loop")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Move to the next noise level once the residual and the update norm plateau")
+    parser.add_argument("--min_T", type=int, default=None,
+                        help="Minimum number of iterations per noise level with --adaptive (default: T // 10)")
+    parser.add_argument("--tol", type=float, default=1e-3,
+                        help="Relative change under which the statistics are considered on a plateau with --adaptive")
+    parser.add_argument("--learned_gains", action="store_true",
+                        help="Mix the sources with one gain per source, fitted to the mixture after every noise level")
+    parser.add_argument("--gain_steps", type=int, default=100,
+                        help="Number of Adam steps fitting the mixing gains after every noise level with --learned_gains")
+
+    parser.add_argument('--sigma1', type=float, default=1.0)
+    parser.add_argument('--sigmaL', type=float, default=0.01)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--progression', type=str, default='geometric')
+
+    # inference schedule
+    parser.add_argument("--n_levels", type=int, default=None,
+                        help="Number of noise levels visited (sub-sampled from the training schedule). By default all of them")
+    parser.add_argument("--spacing", type=str, default="uniform",
+                        help="uniform or quadratic (denser at the low noise levels)")
+    parser.add_argument("--max_step_scale", type=float, default=None,
+                        help="Upper bound of the step size scales of the sub-sampled schedule (default: no bound)")
+
+    # Model hyperparameters
+    parser.add_argument('--version', type=str, default='v2', help='Version of NCSN')
+    parser.add_argument('--n_filters', type=int, default=192,
+                        help="number of filters in the Network")
+    parser.add_argument('--precision', type=str, default='float32',
+                        help="float32, bfloat16 or int8 (RESTORE paths are TFLite files from quantize_ncsn.py)")
+
+    # Optimization parameters
+    parser.add_argument("--optimizer", type=str,
+                        default="adam", help="adam or adamax")
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+
+    # preprocessing parameters
+    parser.add_argument('--use_logit', action="store_true",
+                        help="Either to use logit function to preprocess the data")
+    parser.add_argument('--alpha', type=float, default=10**(-6),
+                        help='preprocessing parameter: x = logit(alpha + (1 - alpha) * z / 256.). Only if use logit')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -187,6 +187,7 @@ def main(args):
         new_args.output = args.output
         new_args.debug = args.debug
         new_args.restore = args.restore
+        new_args.from_wav = args.from_wav
         args = new_args
 
     sigmas_np = get_sigmas(args.sigma1, args.sigmaL, args.num_classes, progression=args.progression)
@@ -265,8 +266,16 @@ def main(args):
         args.sampling_rate, args.fmin, args.fmax = None, None, None
 
     else:
-        ds_train, ds_test, _, n_train, n_test = data_loader.load_melspec_ds(args.dataset + '/train', args.dataset + '/test',
-                                                                            shuffle=True, batch_size=None, mirrored_strategy=None)
+        if args.from_wav:
+            # spectrograms computed on the fly from the wav files of the train and test folders
+            spec_params = {'length_sec': 2.04, 'sr': 16000, 'n_fft': 2048, 'hop_length': 512, 'n_mels': args.height,
+                           'fmin': 125, 'fmax': 7600, 'dbmin': -100, 'dbmax': 20, 'use_dB': args.scale == 'dB'}
+            ds_train, ds_test, _, n_train, n_test = data_loader.load_wav_melspec_ds(args.dataset + '/train',
+                                                                                    args.dataset + '/test', spec_params,
+                                                                                    shuffle=True, batch_size=None)
+        else:
+            ds_train, ds_test, _, n_train, n_test = data_loader.load_melspec_ds(args.dataset + '/train', args.dataset + '/test',
+                                                                                shuffle=True, batch_size=None, mirrored_strategy=None)
         args.fmin = 125
         args.fmax = 7600
         args.sampling_rate = 16000
@@ -377,6 +386,8 @@ if __name__ == '__main__':
     # dataset parameters
     parser.add_argument('--dataset', type=str, default="mnist",
                         help="mnist or cifar10 or directory to tfrecords")
+    parser.add_argument('--from_wav', action="store_true",
+                        help="Compute the spectrograms on the fly from the wav files of the dataset train and test directories")
 
     # Output and Restore Directory
     parser.add_argument('--output', type=str, default='trained_ncsn',
@@ -6,6 +6,8 @@ import datetime
 import matplotlib.pyplot as plt
 import io
 import os
+import threading
+import queue
 import librosa
 from librosa.display import specshow
 import argparse
@@ -80,10 +82,11 @@ def plot_to_image(figure):
     returns it. The supplied figure is closed and inaccessible after this call."""
     # Save the plot to a PNG in memory.
     buf = io.BytesIO()
-    plt.savefig(buf, format='png')
+    figure.savefig(buf, format='png')
     # Closing the figure prevents it from being displayed directly inside
-    # the notebook.
-    plt.close(figure)
+    # the notebook. Figures created without pyplot (Figure with an Agg canvas) are not managed by it
+    if figure.canvas.manager is not None:
+        plt.close(figure)
     buf.seek(0)
     # Convert PNG buffer to TF image
     image = tf.image.decode_png(buf.getvalue(), channels=4)
@@ -92,6 +95,62 @@ def plot_to_image(figure):
     return image
 
 
+class AsyncSummaryWriter(object):
+    """
+    Run summary functions (figure rendering, PNG encoding, host transfers) on a background thread
+
+    Functions are queued with submit() and called with the summary writer as default writer.
+    The queue is bounded: when it is full the new summary is dropped so the caller never waits.
+    pyplot is not thread safe: the functions must draw on matplotlib.figure.Figure objects with an Agg canvas
+    (see run_basis_sep.image_grid), converted with plot_to_image.
+    """
+
+    def __init__(self, summary_writer, max_queue=16):
+        self.summary_writer = summary_writer
+        self.n_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            fn, args, kwargs = item
+            try:
+                with self.summary_writer.as_default():
+                    fn(*args, **kwargs)
+            except Exception as e:
+                print("Summary {} failed: {}".format(fn.__name__, e))
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except queue.Full:
+            self.n_dropped += 1
+
+    def flush(self):
+        """
+        Wait for the queued summaries and flush the summary writer
+        """
+        self._queue.join()
+        self.summary_writer.flush()
+
+    def close(self):
+        """
+        Run the queued summaries, stop the thread and flush the summary writer
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self.summary_writer.flush()
+        if self.n_dropped > 0:
+            print("{} summaries dropped (queue full)".format(self.n_dropped))
+
+
 def image_grid(sample, data_shape, data_type="image", **kwargs):
     # Create a figure to contain the plot.
     f, axes = plt.subplots(4, 8, figsize=(12, 6))
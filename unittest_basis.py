@@ -0,0 +1,119 @@
+from run_basis_sep import basis_inner_loop_fn, stacked_score_fn
+from mixing_operators import LinearMixing
+from ncsn.utils import get_uncompiled_model, get_uncompiled_model_v2, fixed_sigma_score_fn
+from ncsn.score_network import ConditionalInstanceNorm2dPlus
+import argparse
+import unittest
+import tensorflow as tf
+import numpy as np
+
+
+class TestBasisInnerLoop(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        tf.random.set_seed(0)
+        cls.shape = (4, 8, 6, 1)
+        # score of a standard normal prior, conditioned on the noise level labels as the NCSN models
+        x_input = tf.keras.Input(shape=cls.shape[1:])
+        labels_input = tf.keras.Input(shape=(), dtype=tf.int32)
+        cls.model = tf.keras.Model([x_input, labels_input], -x_input)
+        cls.sigmas = np.geomspace(1., 0.01, 5).astype(np.float32)
+        cls.mixed = tf.random.uniform(cls.shape)
+        cls.x = tf.random.uniform((2,) + cls.shape)
+
+    def run_inner_loop(self, T=10, **kwargs):
+        inner_loop = basis_inner_loop_fn([self.model, self.model], self.sigmas, LinearMixing(), T=T, **kwargs)
+        return inner_loop(self.mixed, self.x, tf.constant(2), tf.constant(1.))
+
+    def test_default(self):
+        x = self.run_inner_loop()
+        self.assertEqual(x.shape, (2,) + self.shape)
+
+    def test_monitor(self):
+        outputs = self.run_inner_loop(monitor=True, n_display=3)
+        self.assertEqual(outputs['x'].shape, (2,) + self.shape)
+        self.assertEqual(int(outputs['n_steps']), 10)
+        self.assertEqual(int(outputs['nan_step']), -1)
+        self.assertEqual(outputs['snapshots'].shape, (5, 2, 3) + self.shape[1:])
+        self.assertEqual(int(outputs['n_snapshots']), 5)
+
+    def test_adaptive(self):
+        outputs = self.run_inner_loop(T=50, adaptive=True, min_T=5, tol=1e-1, monitor=True, n_display=3)
+        self.assertEqual(outputs['x'].shape, (2,) + self.shape)
+        n_steps = int(outputs['n_steps'])
+        self.assertGreaterEqual(n_steps, 5)
+        self.assertLessEqual(n_steps, 50)
+        # one snapshot every 10 steps, only for the steps done
+        n_snapshots = int(outputs['n_snapshots'])
+        self.assertEqual(n_snapshots, (n_steps + 9) // 10)
+        self.assertEqual(outputs['snapshots'].shape, (5, 2, 3) + self.shape[1:])
+        snapshots = outputs['snapshots'].numpy()
+        self.assertTrue(np.all(np.any(snapshots[:n_snapshots] != 0., axis=(1, 2, 3, 4, 5))))
+        self.assertTrue(np.all(snapshots[n_snapshots:] == 0.))
+
+
+class TestStackedScore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        tf.random.set_seed(0)
+        args = argparse.Namespace(data_shape=[8, 8, 1], n_filters=4, use_logit=False)
+        cls.sigmas = tf.constant(np.geomspace(1., 0.01, 5).astype(np.float32))
+        cls.models = [get_uncompiled_model_v2(args, sigmas=cls.sigmas, name="model{}".format(k + 1)) for k in range(3)]
+        cls.x = tf.random.normal((3, 4, 8, 8, 1))
+
+    def separate_scores(self, models, sigma_idx):
+        labels = tf.ones(self.x.shape[1], dtype=tf.int32) * sigma_idx
+        return np.stack([model([x_k, labels], training=True).numpy() for model, x_k in zip(models, self.x)])
+
+    def stacked_scores(self, models, sigma_idx, grouped=False):
+        score, conditioning = stacked_score_fn(models, model_type='ncsn', grouped=grouped)
+        return tf.function(score)(self.x, conditioning(tf.constant(sigma_idx), self.x.shape[1])).numpy()
+
+    def test_distinct(self):
+        # different weights: the networks are called one after the other, or run as one grouped network
+        for grouped in [False, True]:
+            for sigma_idx in [0, 3]:
+                expected = self.separate_scores(self.models, sigma_idx)
+                scores = self.stacked_scores(self.models, sigma_idx, grouped=grouped)
+                self.assertEqual(scores.shape, self.x.shape)
+                self.assertTrue(np.allclose(scores, expected, rtol=1e-4, atol=1e-5))
+
+    def test_shared(self):
+        models = [self.models[0]] * 3
+        self.assertTrue(np.allclose(self.stacked_scores(models, 2), self.separate_scores(models, 2), rtol=1e-4, atol=1e-5))
+
+
+
+class TestFixedSigmaScore(TestStackedScore):
+    """
+    NCSN v1 models: the stacked score uses the affine params precomputed per noise level (fixed_sigma_score_fn).
+    test_distinct and test_shared compare it with the models called on the sigma indices
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        tf.random.set_seed(0)
+        args = argparse.Namespace(data_shape=[16, 16, 1], n_filters=4, num_classes=5, use_logit=False)
+        cls.models = [get_uncompiled_model(args, name="model{}".format(k + 1)) for k in range(3)]
+        for model in cls.models:
+            # distinct affine params at every noise level
+            for layer in model.submodules:
+                if isinstance(layer, ConditionalInstanceNorm2dPlus):
+                    embeddings = layer.embed.embeddings
+                    embeddings.assign(tf.random.normal(embeddings.shape, mean=1., stddev=0.5))
+        cls.x = tf.random.normal((3, 4, 16, 16, 1))
+
+    def test_fixed_sigma(self):
+        for model, x_k in zip(self.models, self.x):
+            prepare, score = fixed_sigma_score_fn(model)
+            for sigma_idx in [0, 2, 4]:
+                labels = tf.ones(x_k.shape[0], dtype=tf.int32) * sigma_idx
+                expected = model([x_k, labels], training=True).numpy()
+                scores = score(x_k, prepare(tf.constant(sigma_idx))).numpy()
+                self.assertTrue(np.allclose(scores, expected, rtol=1e-4, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+from griffin_lim import *
+import unittest
+import numpy as np
+
+
+class TestGriffinLim(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        t = np.arange(2 * 16000) / 16000.
+        cls.audio = np.stack([np.sin(2 * np.pi * 440. * t), np.sin(2 * np.pi * 660. * t) * np.linspace(0., 1., len(t))])
+        cls.audio = (cls.audio + 0.01 * rng.normal(size=cls.audio.shape)).astype(np.float32)
+        cls.audio = cls.audio[:, :512 * 62]
+
+    def test_stft_istft(self):
+        transform = GriffinLim().transform
+        stfts = transform.stft(self.audio)
+        self.assertEqual(stfts.shape, (2, 1025, 63))
+        self.assertTrue(np.allclose(transform.istft(stfts), self.audio, atol=1e-4))
+
+    def test_warm_start(self):
+        griffin_lim = GriffinLim(n_iter=50)
+        stfts = griffin_lim.transform.stft(self.audio)
+        audio, n_iter = griffin_lim(np.abs(stfts), init_phase=np.angle(stfts))
+        self.assertTrue(np.allclose(audio, self.audio, atol=1e-3))
+        self.assertTrue(np.all(n_iter < 50))
+
+    def test_chunks(self):
+        griffin_lim = GriffinLim(chunk_frames=24, overlap_frames=8)
+        self.assertEqual(griffin_lim.chunk_starts(63), [0, 16, 32, 39])
+        stfts = griffin_lim.transform.stft(self.audio)
+        audio, _ = griffin_lim(np.abs(stfts), init_phase=np.angle(stfts))
+        self.assertEqual(audio.shape, self.audio.shape)
+        # the chunks start from the true phase: the stitched audio is the original audio
+        self.assertTrue(np.allclose(audio[:, 2048:-2048], self.audio[:, 2048:-2048], atol=5e-2))
+
+
+if __name__ == '__main__':
+    unittest.main()
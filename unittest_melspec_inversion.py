@@ -0,0 +1,40 @@
+from melspec_inversion_basis import *
+import unittest
+import numpy as np
+
+
+class TestStreamingInversion(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.RandomState(0)
+        cls.transform = get_spectral_transform(sr=16000, n_fft=512, hop_length=128, n_mels=32, fmin=125, fmax=7600)
+        A = cls.transform.mel_basis
+        # power spectrograms A^T m: their melspectrograms are inverted exactly by the pseudo-inverse starting point of the NNLS
+        power = np.einsum('mf,semt->seft', A, rng.uniform(0.1, 1., size=(5, 2, A.shape[0], 20)))
+        cls.melspecs = np.einsum('mf,seft->semt', A, power).astype(np.float32)
+        cls.stft_mixture = (rng.normal(size=(2, A.shape[1], 20)) + 1j * rng.normal(size=(2, A.shape[1], 20))).astype(np.complex64)
+
+    def expected_audio(self, wiener_iter):
+        n_signals, n_extract = self.melspecs.shape[:2]
+        magnitudes = mel_to_stft_batch(np.reshape(self.melspecs, (-1,) + self.melspecs.shape[2:]), self.transform)
+        magnitudes = np.reshape(magnitudes, (n_signals, n_extract) + magnitudes.shape[1:])
+        stfts = complex_array(magnitudes, np.angle(self.stft_mixture))
+        for group in [slice(0, 2), slice(2, 4)]:
+            stfts[group] = single_channel_wiener_filter(magnitudes[group] ** 2, self.stft_mixture, n_iter=wiener_iter)
+        audio = self.transform.istft(stfts)
+        return np.reshape(audio, (n_signals, -1))
+
+    def test_same_as_wiener_filter(self):
+        # blocks of 7 frames of both extracts, then of one extract
+        for wiener_iter, block_columns in [(0, 16384), (2, 16384), (2, 5 * 7)]:
+            audio = invert_melspecs(self.melspecs, self.stft_mixture, 2, self.transform, scale='power',
+                                    wiener_filter=True, wiener_iter=wiener_iter, block_frames=7,
+                                    block_columns=block_columns)
+            expected = self.expected_audio(wiener_iter)
+            self.assertEqual(audio.shape, expected.shape)
+            self.assertTrue(np.allclose(audio, expected, atol=1e-5 * np.abs(expected).max()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+from mixing_operators import *
+import unittest
+import tensorflow as tf
+import numpy as np
+
+
+class TestMixingOperators(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        tf.random.set_seed(0)
+        cls.shape = (3, 4, 8, 6, 1)
+        cls.sources_image = tf.random.uniform(cls.shape, dtype=tf.float32)
+        cls.sources_power = tf.random.uniform(cls.shape, minval=1e-3, maxval=10., dtype=tf.float32)
+        cls.sources_db = tf.random.uniform(cls.shape, minval=-100., maxval=20., dtype=tf.float32)
+        cls.mixed = tf.random.uniform(cls.shape[1:], dtype=tf.float32)
+
+    def check_gradient(self, mixing_op, sources, rtol=1e-4, atol=1e-5):
+        with tf.GradientTape() as tape:
+            tape.watch(sources)
+            mixture, residual, grad = mixing_op(sources, self.mixed)
+        # the mixture of each bin only depends on the sources at that bin: the gradient of the sum is elementwise
+        expected_grad = tape.gradient(tf.reduce_sum(mixture), sources)
+
+        self.assertEqual(mixture.shape, self.shape[1:])
+        self.assertEqual(grad.shape, self.shape)
+        self.assertTrue(np.allclose(residual.numpy(), (self.mixed - mixture).numpy()))
+        self.assertTrue(np.allclose(grad.numpy(), expected_grad.numpy(), rtol=rtol, atol=atol))
+
+    def test_linear(self):
+        mixing_op = LinearMixing()
+        self.check_gradient(mixing_op, self.sources_image)
+        self.assertTrue(np.allclose(mixing_op.mix(self.sources_image).numpy(),
+                                    np.mean(self.sources_image.numpy(), axis=0)))
+
+    def test_amplitude(self):
+        mixing_op = AmplitudeMixing()
+        self.check_gradient(mixing_op, self.sources_power)
+        expected = np.mean(np.sqrt(self.sources_power.numpy()), axis=0) ** 2
+        self.assertTrue(np.allclose(mixing_op.mix(self.sources_power).numpy(), expected, rtol=1e-5))
+
+    def test_decibel(self):
+        for domain, db_factor in [('power', 10.), ('amplitude', 20.)]:
+            mixing_op = DecibelMixing(domain=domain)
+            self.check_gradient(mixing_op, self.sources_db)
+            linear = 10. ** (self.sources_db.numpy().astype(np.float64) / db_factor)
+            expected = db_factor * np.log10(np.mean(linear, axis=0))
+            self.assertTrue(np.allclose(mixing_op.mix(self.sources_db).numpy(), expected, atol=1e-3))
+
+    def test_learned_gains(self):
+        for domain, sources in [('linear', self.sources_image), ('power', self.sources_db)]:
+            mixing_op = LearnedGainMixing(self.shape[0], domain=domain)
+            mixing_op.log_gains.assign(tf.math.log([0.2, 0.5, 1.5]))
+            self.check_gradient(mixing_op, sources, atol=1e-4)
+
+        # the initial gains give the mean mixture
+        mixing_op = LearnedGainMixing(self.shape[0], domain='power')
+        self.assertTrue(np.allclose(mixing_op.mix(self.sources_db).numpy(),
+                                    DecibelMixing().mix(self.sources_db).numpy(), atol=1e-4))
+
+    def test_fit_gains(self):
+        gains = np.array([0.2, 0.5, 1.5], dtype=np.float32)
+        mixed = tf.reduce_sum(gains[:, None, None, None, None] * self.sources_image, axis=0)
+        mixing_op = LearnedGainMixing(self.shape[0], domain='linear', learning_rate=5e-2)
+        loss = mixing_op.fit(self.sources_image, mixed, n_steps=500)
+        self.assertLess(float(loss), 1e-4)
+        self.assertTrue(np.allclose(mixing_op.gains.numpy(), gains, atol=5e-2))
+
+        # the gains restart from the mean mixture and are fitted again without a new trace
+        mixing_op.reset()
+        self.assertTrue(np.allclose(mixing_op.gains.numpy(), 1. / self.shape[0]))
+        loss = mixing_op.fit(self.sources_image, mixed, n_steps=500)
+        self.assertLess(float(loss), 1e-4)
+        self.assertEqual(mixing_op._fit.experimental_get_tracing_count(), 1)
+
+    def test_get_mixing_operator(self):
+        self.assertIsInstance(get_mixing_operator('melspec', 'dB'), DecibelMixing)
+        mixing_op = get_mixing_operator('melspec', 'dB', n_sources=3, learned_gains=True)
+        self.assertIsInstance(mixing_op, LearnedGainMixing)
+        self.assertEqual(mixing_op.domain, 'power')
+        self.assertEqual(mixing_op.gains.shape, (3,))
+        with self.assertRaises(ValueError):
+            get_mixing_operator('melspec', 'dB', learned_gains=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
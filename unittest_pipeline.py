@@ -1,4 +1,8 @@
 from datasets.preprocessing import *
+from datasets.spec_store import *
+from datasets.data_loader import extracts_to_melspec, load_melspec_split
+from datasets.spectral import get_spectral_transform
+import librosa
 import unittest
 import tensorflow as tf
 import shutil
@@ -48,6 +52,151 @@ class TestLoadAndSaveTFRecords(unittest.TestCase):
 
         shutil.rmtree('test_files')
 
+    def test_sidecar_index(self):
+        try:
+            os.mkdir("test_files")
+        except FileExistsError:
+            pass
+
+        arrays = np.random.normal(size=(30, 16, 8)).astype(np.float32)
+        # 16 * 8 * 4 bytes per array: 8 arrays per shard of 4KB
+        filenames = save_tf_records_shards(arrays, os.path.join('test_files', 'indexed'), shard_size_mb=4. / 1024)
+        self.assertEqual(read_tf_records_index(filenames[0])['count'], 8)
+        self.assertEqual(read_tf_records_index(filenames[0])['shape'], [16, 8])
+        self.assertEqual(count_tf_records(filenames), 30)
+
+        stats = tf_records_statistics(filenames)
+        self.assertEqual(stats['count'], 30)
+        self.assertAlmostEqual(stats['min'], float(arrays.min()), places=5)
+        self.assertAlmostEqual(stats['max'], float(arrays.max()), places=5)
+        self.assertAlmostEqual(stats['mean'], float(arrays.mean()), places=5)
+        self.assertAlmostEqual(stats['std'], float(arrays.std()), places=5)
+
+        # without index, the records are counted by a scan
+        os.remove(filenames[1] + INDEX_SUFFIX)
+        self.assertIsNone(tf_records_statistics(filenames))
+        self.assertEqual(count_tf_records(filenames), 30)
+
+        shutil.rmtree('test_files')
+
+
+class TestSpecStore(unittest.TestCase):
+
+    def test_save_and_load(self):
+
+        try:
+            os.mkdir("test_files")
+        except FileExistsError:
+            pass
+
+        arrays = np.random.uniform(-100., 20., size=(30, 16, 8)).astype(np.float32)
+        # 4 KB shards: 8 spectrograms of 512 bytes (float32) per shard
+        filenames = save_spec_store_shards(arrays, os.path.join('test_files', 'store'), shard_size_mb=4. / 1024.,
+                                           dtype='float32')
+        self.assertEqual(len(filenames), 4)
+        self.assertEqual(store_size(filenames), 30)
+        self.assertTrue(np.array_equal(open_shard(filenames[1]), arrays[8:16]))
+
+        loaded = np.array(list(load_spec_store(filenames).as_numpy_iterator()))
+        self.assertTrue(np.array_equal(loaded, arrays))
+
+        batches = list(load_spec_store(filenames, batch_size=7, shuffle=True, seed=0).as_numpy_iterator())
+        self.assertEqual([len(batch) for batch in batches], [7, 7, 7, 7, 2])
+        shuffled = np.concatenate(batches)
+        self.assertTrue(np.array_equal(np.sort(shuffled, axis=0), np.sort(arrays, axis=0)))
+        # the spectrograms of a batch are drawn across the shards
+        shard_ids = [{int(np.flatnonzero(np.all(arrays == x, axis=(1, 2)))[0]) // 8 for x in batch} for batch in batches]
+        self.assertGreater(max(len(ids) for ids in shard_ids), 2)
+
+        # a split of store shards only is read by training batches
+        batches = list(load_melspec_split([], filenames, batch_size=7, shuffle=False).as_numpy_iterator())
+        self.assertEqual([batch.shape for batch in batches], [(7, 16, 8, 1)] * 4)
+        self.assertTrue(np.array_equal(np.concatenate(batches)[..., 0], arrays[:28]))
+
+        # float16 shards are read as float32
+        filenames = save_spec_store_shards(arrays, os.path.join('test_files', 'store_f16'), dtype='float16')
+        loaded = np.array(list(load_spec_store(filenames).as_numpy_iterator()))
+        self.assertEqual(loaded.dtype, np.float32)
+        self.assertTrue(np.allclose(loaded, arrays, atol=0.1))
+
+        # power spectrograms (floored at 1e-10) round trip through the default float32 shards
+        powers = np.exp(np.random.uniform(np.log(1e-10), np.log(100.), size=(30, 16, 8))).astype(np.float32)
+        filenames = save_spec_store_shards(powers, os.path.join('test_files', 'store_power'))
+        loaded = np.array(list(load_spec_store(filenames).as_numpy_iterator()))
+        self.assertTrue(np.array_equal(loaded, powers))
+        self.assertTrue(np.all(loaded > 0))
+
+        shutil.rmtree('test_files')
+
+
+class TestBatchedMelspec(unittest.TestCase):
+
+    def test_same_as_librosa(self):
+        spec_params = {'sr': 16000, 'n_fft': 2048, 'hop_length': 512, 'n_mels': 96, 'fmin': 125, 'fmax': 7600,
+                       'dbmin': -100, 'dbmax': 20}
+        extracts = np.random.uniform(-1., 1., size=(5, 16000)).astype(np.float32)
+        for use_dB in [False, True]:
+            mel_extracts, stfts = extracts_to_melspec(extracts, chunk_size=2, use_dB=use_dB, **spec_params)
+            for extract, mel_extract, stft in zip(extracts, mel_extracts, stfts):
+                expected_stft = librosa.stft(extract, n_fft=2048, hop_length=512)
+                expected = librosa.feature.melspectrogram(S=np.abs(expected_stft) ** 2, sr=16000, fmin=125, fmax=7600,
+                                                          n_mels=96, power=2.0)
+                if use_dB:
+                    expected = np.clip(librosa.power_to_db(expected), -100, 20)
+                    self.assertTrue(np.allclose(mel_extract, expected, atol=1e-3))
+                else:
+                    expected = np.clip(expected, 1e-10, 100.)
+                    self.assertTrue(np.allclose(mel_extract, expected, rtol=1e-3, atol=1e-6))
+                self.assertTrue(np.allclose(stft, expected_stft, atol=1e-3))
+
+
+class TestSpectralTransform(unittest.TestCase):
+
+    def test_shared_transform(self):
+        transform = get_spectral_transform(16000, 2048, 512, 96, 125, 7600)
+        self.assertIs(transform, get_spectral_transform(sr=16000., n_mels=96, fmin=125., fmax=7600.))
+        self.assertIsNot(transform, get_spectral_transform(16000, 2048, 512, 128, 125, 7600))
+
+    def test_same_as_librosa(self):
+        transform = get_spectral_transform(16000, 2048, 512, 96, 125, 7600)
+        audio = np.random.uniform(-1., 1., size=(2, 3, 8192)).astype(np.float32)
+        melspecs = transform.melspectrogram(audio)
+        self.assertEqual(melspecs.shape, (2, 3, 96, 17))
+        expected = librosa.feature.melspectrogram(y=audio[1, 2], sr=16000, n_fft=2048, hop_length=512, n_mels=96,
+                                                  fmin=125, fmax=7600)
+        self.assertTrue(np.allclose(melspecs[1, 2], expected, rtol=1e-3, atol=1e-6))
+
+        mel_stfts = transform.mel_to_stft(melspecs[:, :2])
+        self.assertEqual(mel_stfts.shape, (2, 2, 1025, 17))
+        # the NNLS solutions are not unique: check that they are non-negative and reproduce the melspectrograms
+        self.assertTrue(np.all(mel_stfts >= 0.))
+        self.assertTrue(np.allclose(transform.mel(mel_stfts ** 2), melspecs[:, :2], rtol=1e-2, atol=1e-3))
+
+        stfts = transform.stft(audio)
+        self.assertTrue(np.allclose(transform.istft(stfts, length=8192), audio, atol=1e-4))
+
+
+class TestTFMelSpectrogram(unittest.TestCase):
+
+    def test_same_as_librosa(self):
+        audio = np.random.uniform(-1., 1., size=(3, 16000)).astype(np.float32)
+        for use_dB in [False, True]:
+            mel_spectrogram = tf_mel_spectrogram_fn(16000, n_fft=2048, hop_length=512, n_mels=96, fmin=125, fmax=7600,
+                                                    use_dB=use_dB)
+            ds = mel_spectrograms_from_ds(tf.data.Dataset.from_tensor_slices(audio), 16000, n_mels=96, use_dB=use_dB)
+            from_ds = np.array(list(ds.as_numpy_iterator()))
+            batched = mel_spectrogram(audio).numpy()
+            self.assertEqual(batched.shape, (3, 96, 32))
+            self.assertTrue(np.allclose(from_ds, batched))
+            for x, mel_spect in zip(audio, batched):
+                expected = librosa.feature.melspectrogram(y=x, sr=16000, n_fft=2048, hop_length=512, n_mels=96,
+                                                          fmin=125, fmax=7600)
+                expected = np.clip(expected, 1e-10, 100.)
+                if use_dB:
+                    self.assertTrue(np.allclose(mel_spect, 10. * np.log10(expected), atol=1e-2))
+                else:
+                    self.assertTrue(np.allclose(mel_spect, expected, rtol=1e-3, atol=1e-6))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,64 @@
+from train_utils import AsyncSummaryWriter, plot_to_image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import unittest
+import threading
+import tempfile
+import shutil
+import time
+import tensorflow as tf
+import numpy as np
+
+
+class TestAsyncSummaryWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.summary_writer = tf.summary.create_file_writer(self.log_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_drop_and_drain(self):
+        summary = AsyncSummaryWriter(self.summary_writer, max_queue=3)
+        started, release = threading.Event(), threading.Event()
+        done = []
+
+        def blocking():
+            started.set()
+            release.wait()
+
+        summary.submit(blocking)
+        self.assertTrue(started.wait(10.))
+        # the thread is blocked: 3 summaries are queued, the others are dropped without waiting
+        t0 = time.time()
+        for i in range(10):
+            summary.submit(done.append, i)
+        self.assertLess(time.time() - t0, 1.)
+        self.assertEqual(summary.n_dropped, 7)
+
+        release.set()
+        summary.close()
+        self.assertEqual(done, [0, 1, 2])
+        self.assertFalse(summary._thread.is_alive())
+
+    def test_render_figure(self):
+        summary = AsyncSummaryWriter(self.summary_writer)
+        images = []
+
+        def render():
+            # drawn without pyplot on the thread of the writer
+            figure = Figure(figsize=(2, 2))
+            FigureCanvasAgg(figure)
+            figure.subplots().imshow(np.random.uniform(size=(8, 8)))
+            images.append(plot_to_image(figure))
+
+        summary.submit(render)
+        summary.close()
+        self.assertEqual(len(images), 1)
+        self.assertEqual(images[0].shape[0], 1)
+        self.assertEqual(images[0].shape[-1], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()